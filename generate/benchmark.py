@@ -0,0 +1,253 @@
+"""Benchmarks of the toolchain on synthetic MLPs of increasing size.
+
+Each model is inputs -> hidden (DenseLogLayer, bias, ReLU) -> 10 (DenseLogLayer, bias),
+with random normal weights scaled by 1/sqrt(inputs) like a trained network's, log-quantized
+at each precision. For every model this times:
+
+    decompose      torch2mlgen.make_log_mult_layer() on both weight matrices
+    save, load     mlgenfile.save_model() and load_model()
+    eval           Model.eval_batch() on --samples random inputs
+    eval_interval  Model.eval_interval_batch() on boxes around them
+    apply          the hidden layer's DenseLogLayer.apply() into a fresh module
+    hdl            that module's hdl()
+
+Timings are the best of --repeat runs (but anything taking over a second only runs once),
+alongside how much each stage raised the process's peak memory, and sizes (fragments,
+instances, bytes) so that runs of different models can be lined up.
+
+Results are written as JSON with -o. Given --baseline, they're compared with an earlier
+run's, and any stage more than --tolerance slower is flagged as a regression (the exit
+status is 1 if there are any). --compare checks two saved runs without running anything."""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import fp as fp
+import hdlgen
+import mlgen
+import mlgenfile
+import profiling
+from torch2mlgen import make_log_mult_layer
+
+SIZES = ["784x128", "784x512", "1024x1024", "2048x2048", "4096x4096"]
+PRECISIONS = [0.1, 0.01, 0.001]
+STAGES = ["decompose", "save", "load", "eval", "eval_interval", "apply", "hdl"]
+OUTPUT_COUNT = 10
+
+# Stages that take longer than this aren't repeated
+REPEAT_SECONDS = 1.0
+
+
+def parse_size(size: str) -> tuple[int, int]:
+    "(inputs, hidden) from e.g. 784x128"
+    inputs, hidden = size.lower().split("x")
+    return int(inputs), int(hidden)
+
+
+def synthetic_weights(size: str, seed: int = 0) -> list[tuple[np.ndarray, np.ndarray]]:
+    "(weight, bias) of both layers, as float32 like torch's"
+    inputs, hidden = parse_size(size)
+    rng = np.random.default_rng(seed)
+    return [
+        (
+            rng.normal(0, 1 / np.sqrt(fan_in), (fan_out, fan_in)).astype(np.float32),
+            rng.normal(0, 0.1, fan_out).astype(np.float32),
+        )
+        for fan_in, fan_out in [(inputs, hidden), (hidden, OUTPUT_COUNT)]
+    ]
+
+
+def build_model(fragments: list[mlgen.FragmentStore], weights) -> mlgen.Model:
+    hidden_fragments, output_fragments = fragments
+    (_, hidden_bias), (_, output_bias) = weights
+    layers = [
+        mlgen.DenseLogLayer(hidden_fragments),
+        mlgen.BiasStep(hidden_bias),
+        mlgen.ReLUStep(),
+        mlgen.DenseLogLayer(output_fragments),
+        mlgen.BiasStep(output_bias),
+    ]
+    return mlgen.Model(layers, hidden_fragments.shape[1], OUTPUT_COUNT)
+
+
+def timed(function, repeat: int):
+    "(best seconds, how much the peak RSS grew, what the last call returned)"
+    best = np.inf
+    peak_before = profiling.peak_rss_bytes()
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+        if best > REPEAT_SECONDS:
+            break
+    peak_after = profiling.peak_rss_bytes()
+    growth = None if peak_before is None else peak_after - peak_before
+    return best, growth, result
+
+
+def apply_layer(layer: mlgen.DenseLogLayer, float_environment: fp.FloatEnvironment) -> hdlgen.Module:
+    module = hdlgen.Module("benchmark")
+    inputs = [module.AddWire(float_environment.float_size, f"in_{index}") for index in range(layer.fragments.shape[1])]
+    layer.apply(inputs, module, float_environment)
+    return module
+
+
+def run_model(size: str, precision: float, stages: list[str], args, directory: str) -> list[dict]:
+    float_environment = fp.FloatEnvironment("binary16")
+    weights = synthetic_weights(size, args.seed)
+    inputs, hidden = parse_size(size)
+    results = []
+
+    def run(stage, function, sizes=lambda result: {}):
+        "Time a stage if it's wanted, otherwise just run it, returning what it did"
+        if stage not in stages:
+            return function()
+        seconds, growth, result = timed(function, args.repeat)
+        results.append({
+            "model": size, "precision": precision, "stage": stage,
+            "seconds": seconds, "peak_rss_growth": growth, **sizes(result),
+        })
+        print(f"    {stage:14} {seconds:10.4f}s" + ("" if growth is None else f"  +{growth / 2**20:8.1f} MB peak"), flush=True)
+        return result
+
+    # Everything else needs the fragments, so they're made even if not timed
+    fragments = run(
+        "decompose",
+        lambda: [make_log_mult_layer(weight, precision) for weight, _ in weights],
+        lambda fragments: {"weights": inputs * hidden + hidden * OUTPUT_COUNT, "fragments": sum(map(len, fragments))},
+    )
+    model = build_model(fragments, weights)
+    fragment_count = sum(map(len, fragments))
+
+    if "save" in stages or "load" in stages:
+        path = os.path.join(directory, f"{size}_{precision}.mlgen")
+        run("save", lambda: mlgenfile.save_model(model, path), lambda _: {"bytes": os.path.getsize(path)})
+        if "load" in stages:
+            run("load", lambda: mlgenfile.load_model(path), lambda _: {"bytes": os.path.getsize(path)})
+        os.remove(path)
+
+    samples = np.random.default_rng(args.seed).uniform(0, 1, (args.samples, inputs))
+    if "eval" in stages:
+        run("eval", lambda: model.eval_batch(samples), lambda _: {"samples": args.samples, "fragments": fragment_count})
+    if "eval_interval" in stages:
+        run(
+            "eval_interval",
+            lambda: model.eval_interval_batch(samples - args.epsilon, samples + args.epsilon),
+            lambda _: {"samples": args.samples, "fragments": fragment_count},
+        )
+
+    if "apply" in stages or "hdl" in stages:
+        layer = model.layers[0]
+        module = run(
+            "apply",
+            lambda: apply_layer(layer, float_environment),
+            lambda module: {"fragments": len(layer.fragments), **profiling.module_counts(module)},
+        )
+        if "hdl" in stages:
+            # Only its length is kept, as it can run to gigabytes
+            run("hdl", lambda: len(module.hdl()), lambda length: {"bytes": length})
+        del module
+
+    return results
+
+
+def compare(results: list[dict], baseline: list[dict], tolerance: float, min_seconds: float) -> list[dict]:
+    """Every stage of every model both have, with how much slower it is now. Ones more than
+    tolerance (a fraction) and min_seconds slower are regressions"""
+    earlier = {(result["model"], result["precision"], result["stage"]): result for result in baseline}
+    comparisons = []
+    for result in results:
+        key = (result["model"], result["precision"], result["stage"])
+        if key not in earlier:
+            continue
+        before = earlier[key]["seconds"]
+        ratio = result["seconds"] / before if before > 0 else np.inf
+        comparisons.append({
+            "model": result["model"],
+            "precision": result["precision"],
+            "stage": result["stage"],
+            "baseline_seconds": before,
+            "seconds": result["seconds"],
+            "ratio": ratio,
+            "regression": bool(ratio > 1 + tolerance and result["seconds"] - before > min_seconds),
+        })
+    return comparisons
+
+
+def format_comparisons(comparisons: list[dict]) -> str:
+    lines = [f"{'model':>10} {'precision':>9} {'stage':14} {'baseline':>10} {'now':>10} {'ratio':>7}"]
+    for comparison in comparisons:
+        lines.append(
+            f"{comparison['model']:>10} {comparison['precision']:9g} {comparison['stage']:14} "
+            f"{comparison['baseline_seconds']:10.4f} {comparison['seconds']:10.4f} {comparison['ratio']:7.2f}"
+            + ("  REGRESSION" if comparison["regression"] else "")
+        )
+    regressions = sum(comparison["regression"] for comparison in comparisons)
+    lines.append(f"{regressions} of {len(comparisons)} stages regressed")
+    return "\n".join(lines)
+
+
+def environment() -> dict:
+    "What the results were measured on, as they only compare on the same machine"
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def load_results(path) -> list[dict]:
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the toolchain's stages on synthetic MLPs of increasing size")
+    parser.add_argument("--sizes", nargs="+", default=SIZES, metavar="INPUTSxHIDDEN", help="models to build, each with a hidden layer of HIDDEN neurons and 10 outputs")
+    parser.add_argument("--precisions", type=float, nargs="+", default=PRECISIONS, help="log-quantization precisions to build each model at")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="stages to time")
+    parser.add_argument("--samples", type=int, default=256, help="inputs to evaluate at once")
+    parser.add_argument("--epsilon", type=float, default=0.01, help="half-width of the boxes eval_interval is timed on")
+    parser.add_argument("--repeat", type=int, default=3, help="best of this many runs (stages over a second only run once)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", "-o", help="write the results to this JSON file")
+    parser.add_argument("--baseline", "-b", help="compare with the results in this JSON file, flagging regressions")
+    parser.add_argument("--compare", metavar="RESULTS", help="with --baseline, compare these saved results instead of running anything")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="how much slower (as a fraction) a stage can get before it counts as a regression")
+    parser.add_argument("--min-seconds", type=float, default=0.01, help="and by how many seconds, so noise in tiny timings doesn't")
+
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        if args.baseline is None:
+            raise ValueError("--compare needs a --baseline to compare with")
+        results = load_results(args.compare)
+    else:
+        results = []
+        with tempfile.TemporaryDirectory() as directory:
+            for size in args.sizes:
+                for precision in args.precisions:
+                    print(f"{size} at precision {precision}:", flush=True)
+                    results.extend(run_model(size, precision, args.stages, args, directory))
+                    gc.collect()
+
+        if args.output is not None:
+            with open(args.output, "w") as f:
+                json.dump({"environment": environment(), "arguments": sys.argv[1:], "results": results}, f, indent=2)
+
+    if args.baseline is not None:
+        comparisons = compare(results, load_results(args.baseline), args.tolerance, args.min_seconds)
+        print(format_comparisons(comparisons))
+        if any(comparison["regression"] for comparison in comparisons):
+            raise SystemExit(1)
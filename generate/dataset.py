@@ -0,0 +1,100 @@
+import itertools
+import os
+from typing import Iterator, Optional
+
+import numpy as np
+
+# Anything not listed here is treated as a raw, headerless array of --dtype values
+CSV_EXTENSIONS = [".csv", ".txt"]
+NPY_EXTENSIONS = [".npy"]
+
+
+def _open_rows(path, row_length: Optional[int], dtype) -> np.ndarray:
+    """Open a .npy or raw binary file as a memory-mapped 2D array without reading it in"""
+    if os.path.splitext(path)[1] in NPY_EXTENSIONS:
+        rows = np.load(path, mmap_mode="r")
+    else:
+        rows = np.memmap(path, dtype=dtype, mode="r")
+        if row_length is not None:
+            if len(rows) % row_length != 0:
+                raise ValueError(
+                    f"{path} holds {len(rows)} values, which isn't a whole number of rows of {row_length}"
+                )
+            rows = rows.reshape(-1, row_length)
+
+    if rows.ndim == 1 and row_length is not None:
+        rows = rows.reshape(-1, row_length)
+    return rows
+
+
+def _iter_csv_chunks(path, chunk_size: int) -> Iterator[np.ndarray]:
+    with open(path, "r") as f:
+        lines = (line for line in f if len(line.strip()) > 0)
+        while True:
+            chunk_lines = list(itertools.islice(lines, chunk_size))
+            if len(chunk_lines) == 0:
+                return
+            yield np.loadtxt(chunk_lines, delimiter=",", ndmin=2)
+
+
+def iter_array_chunks(
+    path, chunk_size: int, row_length: Optional[int] = None, dtype="float32"
+) -> Iterator[np.ndarray]:
+    """Yield consecutive chunks of at most chunk_size rows from a CSV, .npy or raw binary
+    file, only ever holding one chunk in memory"""
+    if os.path.splitext(path)[1] in CSV_EXTENSIONS:
+        yield from _iter_csv_chunks(path, chunk_size)
+        return
+
+    rows = _open_rows(path, row_length, dtype)
+    for start in range(0, len(rows), chunk_size):
+        # Copy out of the memory map so pages can be dropped once we move on
+        yield np.array(rows[start : start + chunk_size])
+
+
+def iter_dataset(
+    inputs_path,
+    input_count: int,
+    chunk_size: int = 1024,
+    labels_path=None,
+    label_column: Optional[int] = None,
+    dtype="float32",
+    label_dtype="uint8",
+) -> Iterator[tuple[np.ndarray, Optional[np.ndarray]]]:
+    """Stream (inputs, labels) chunks of a dataset. Labels either come from their own
+    file (one per row), from a column of the inputs file (e.g. MNIST CSVs put the label
+    first), or not at all, in which case None is yielded in their place"""
+    if labels_path is not None and label_column is not None:
+        raise ValueError("Give either a separate labels file or a label column, not both")
+
+    row_length = input_count + (0 if label_column is None else 1)
+    input_chunks = iter_array_chunks(inputs_path, chunk_size, row_length, dtype)
+
+    if labels_path is None:
+        chunks = zip(input_chunks, itertools.repeat(None))
+    else:
+        label_chunks = (
+            chunk.reshape(-1)
+            for chunk in iter_array_chunks(labels_path, chunk_size, None, label_dtype)
+        )
+        # Either running out first means the files don't match, not that the dataset ended
+        chunks = itertools.zip_longest(input_chunks, label_chunks)
+
+    for inputs, labels in chunks:
+        if inputs is None or (labels_path is not None and labels is None):
+            raise ValueError("Inputs and labels have different numbers of rows")
+        if inputs.shape[1] != row_length:
+            raise ValueError(
+                f"Expected rows of {row_length} values in {inputs_path}, got {inputs.shape[1]}"
+            )
+
+        if label_column is not None:
+            labels = inputs[:, label_column]
+            inputs = np.delete(inputs, label_column, axis=1)
+
+        if labels is not None:
+            if len(labels) != len(inputs):
+                raise ValueError("Inputs and labels have different numbers of rows")
+            labels = np.asarray(labels).astype(np.int64)
+
+        yield inputs, labels
@@ -0,0 +1,412 @@
+"""Differential testing of the generated RTL against the Python model.
+
+Random vectors, and optionally vectors from a dataset, are run through a built batch
+testbench (see rtlbatch and test/nn_tb_batch.cpp) in several worker processes, each
+running its own testbench process per chunk and comparing every output word with the
+reference: mlgen.Model.eval_hardware(), which should match the RTL bit for bit, or
+eval_batch() in doubles to see how far the hardware is from the unquantised network.
+Differences are measured in units in the last place (ULPs) and summarised as a
+distribution, and vectors with outputs further out than allowed are shrunk to a minimal
+failing input: as few nonzero inputs as possible, with as many as possible set to +/-1.
+
+    make obj_dir/nn_tb_batch
+    python generate/difftest.py model.mlgen obj_dir/nn_tb_batch --random 50000 --generated-with "--fold 4"
+"""
+
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import shlex
+import time
+from dataclasses import dataclass, field
+from typing import Any, Iterator, NamedTuple, Optional
+
+import numpy as np
+
+import dataset
+import fp as fp
+import ipsim
+import mlgen
+import mlgen2hdl
+import mlgenfile
+import parallel
+import rtlbatch
+
+# ULP differences are binned by bit length (0, 1, 2-3, 4-7, ...), with a last bin for
+# NaN on one side only
+NAN_BIN = 18
+BIN_COUNT = NAN_BIN + 1
+
+# Failing vectors kept per chunk, and overall, to shrink and report
+MAX_FAILURES = 100
+
+# Rounds of trying to set inputs to +/-1 once as few as possible are nonzero
+MAX_SIMPLIFY_ROUNDS = 64
+
+
+def bin_label(index: int) -> str:
+    if index == NAN_BIN:
+        return "NaN"
+    if index <= 1:
+        return str(index)
+    return f"{1 << (index - 1)}-{(1 << index) - 1}"
+
+
+def ulp_distance(float_environment: fp.FloatEnvironment, a, b) -> np.ndarray:
+    """Representable values between two arrays of words, with +0 and -0 the same. NaN
+    against anything but NaN is -1"""
+    magnitude_mask = (1 << (float_environment.float_size - 1)) - 1
+    infinity = ((1 << float_environment.exponent_size) - 1) << float_environment.significand_size
+
+    def ordered(words):
+        words = np.asarray(words).astype(np.int64)
+        magnitude = words & magnitude_mask
+        return np.where(words >> (float_environment.float_size - 1), -magnitude, magnitude), magnitude > infinity
+
+    a, a_nan = ordered(a)
+    b, b_nan = ordered(b)
+    distance = np.abs(a - b)
+    distance[a_nan & b_nan] = 0
+    distance[a_nan != b_nan] = -1
+    return distance
+
+
+def ulp_bins(distance: np.ndarray) -> np.ndarray:
+    # frexp's exponent is the bit length, for integers
+    return np.where(distance < 0, NAN_BIN, np.frexp(np.maximum(distance, 0))[1])
+
+
+class Reference(NamedTuple):
+    "What the RTL is compared with"
+    float_environment: fp.FloatEnvironment
+    # "hardware" or "float"
+    kind: str = "hardware"
+    folded: bool = False
+    reduction: Optional[mlgen.ReductionPlanner] = None
+    # Each layer's own format, for networks generated with mlgen2hdl --formats
+    layer_environments: Optional[list[Optional[fp.FloatEnvironment]]] = None
+
+    def outputs(self, model: mlgen.Model, words: np.ndarray) -> np.ndarray:
+        "Expected output words for input words"
+        if self.kind == "float":
+            outputs = model.eval_batch(ipsim.bits_to_float(self.float_environment, words))
+            return ipsim.float_to_bits(self.float_environment, outputs)
+
+        return model.eval_hardware_words(
+            words, self.float_environment, self.folded, self.reduction, self.layer_environments
+        )
+
+
+class Failure(NamedTuple):
+    source: str
+    index: int
+    inputs: np.ndarray
+    got: np.ndarray
+    expected: np.ndarray
+
+
+@dataclass
+class DiffReport:
+    output_count: int
+    # Per output, how many differences fell in each ulp_bins() bin
+    histogram: np.ndarray = field(init=False)
+    max_ulp: np.ndarray = field(init=False)
+    nan_mismatches: np.ndarray = field(init=False)
+    failing_outputs: np.ndarray = field(init=False)
+    failures: list = field(default_factory=list)
+    failing_vectors: int = 0
+    vectors: collections.Counter = field(default_factory=collections.Counter)
+    seconds: float = 0.0
+
+    def __post_init__(self):
+        self.histogram = np.zeros((self.output_count, BIN_COUNT), dtype=np.int64)
+        self.max_ulp = np.zeros(self.output_count, dtype=np.int64)
+        self.nan_mismatches = np.zeros(self.output_count, dtype=np.int64)
+        self.failing_outputs = np.zeros(self.output_count, dtype=np.int64)
+
+    def update(self, source: str, start: int, words, got, expected, distance, failing):
+        self.vectors[source] += len(words)
+        for output, bins in enumerate(ulp_bins(distance).T):
+            self.histogram[output] += np.bincount(bins, minlength=BIN_COUNT)
+        self.max_ulp = np.maximum(self.max_ulp, distance.max(axis=0, initial=0))
+        self.nan_mismatches += (distance < 0).sum(axis=0)
+        self.failing_outputs += failing.sum(axis=0)
+
+        failing_rows = np.flatnonzero(failing.any(axis=1))
+        self.failing_vectors += len(failing_rows)
+        for row in failing_rows[:MAX_FAILURES - len(self.failures)]:
+            self.failures.append(Failure(source, start + int(row), words[row].copy(), got[row].copy(), expected[row].copy()))
+
+    def merge(self, other: "DiffReport"):
+        self.histogram += other.histogram
+        self.max_ulp = np.maximum(self.max_ulp, other.max_ulp)
+        self.nan_mismatches += other.nan_mismatches
+        self.failing_outputs += other.failing_outputs
+        self.failures.extend(other.failures[:MAX_FAILURES - len(self.failures)])
+        self.failing_vectors += other.failing_vectors
+        self.vectors.update(other.vectors)
+
+    @property
+    def total_vectors(self) -> int:
+        return sum(self.vectors.values())
+
+    def format(self, reference_kind: str) -> str:
+        total = self.total_vectors
+        compared = total * self.output_count
+        sources = ", ".join(f"{count} {source}" for source, count in self.vectors.items())
+        rate = total / self.seconds if self.seconds > 0 else float("inf")
+        lines = [
+            f"{total} vectors ({sources}) in {self.seconds:.2f}s ({rate:.1f} vectors/s)",
+            f"Outputs out of tolerance against the {reference_kind} model: {self.failing_outputs.sum()} of {compared} ({self.failing_vectors} vectors)",
+            "ULP differences:",
+        ]
+        overall = self.histogram.sum(axis=0)
+        for index in np.flatnonzero(overall):
+            lines.append(f"    {bin_label(index):>11}: {overall[index]} ({overall[index] / compared * 100:.3f}%)")
+
+        inexact = np.flatnonzero(self.histogram[:, 0] < total)
+        if len(inexact) > 0:
+            lines.append("Outputs that differ (max ULPs, NaN mismatches, out of tolerance):")
+            worst = sorted(inexact, key=lambda o: (self.nan_mismatches[o], self.max_ulp[o]), reverse=True)
+            for output in worst[:16]:
+                lines.append(f"    {output:4d}: {self.max_ulp[output]}, {self.nan_mismatches[output]}, {self.failing_outputs[output]}")
+            if len(worst) > 16:
+                lines.append(f"    ... and {len(worst) - 16} more")
+        return "\n".join(lines)
+
+    def to_json(self) -> dict:
+        return {
+            "vectors": dict(self.vectors),
+            "seconds": self.seconds,
+            "failing_vectors": self.failing_vectors,
+            "failing_outputs": self.failing_outputs.tolist(),
+            "max_ulp": self.max_ulp.tolist(),
+            "nan_mismatches": self.nan_mismatches.tolist(),
+            "ulp_histogram": {
+                bin_label(index): self.histogram[:, index].tolist()
+                for index in range(BIN_COUNT) if self.histogram[:, index].any()
+            },
+        }
+
+
+def compare(model, reference: Reference, testbench: rtlbatch.BatchTestbench, words: np.ndarray, max_ulp: Optional[int]):
+    "(RTL outputs, expected outputs, ULP distances, which outputs are out of tolerance)"
+    got = testbench.run(words)
+    expected = reference.outputs(model, words)
+    distance = ulp_distance(reference.float_environment, got, expected)
+    if max_ulp is None:
+        failing = np.zeros(distance.shape, dtype=bool)
+    else:
+        failing = (distance < 0) | (distance > max_ulp)
+    return got, expected, distance, failing
+
+
+def check_chunk(model, reference, testbench, max_ulp, words, source, start) -> DiffReport:
+    report = DiffReport(model.output_count)
+    got, expected, distance, failing = compare(model, reference, testbench, words, max_ulp)
+    report.update(source, start, words, got, expected, distance, failing)
+    return report
+
+
+_worker_state: dict = {}
+
+
+def _init_worker(spec, reference, testbench_path, max_ulp):
+    model, shm = parallel.attach_model(spec)
+    _worker_state.update(
+        model=model, shm=shm, reference=reference, testbench=rtlbatch.BatchTestbench(testbench_path), max_ulp=max_ulp
+    )
+
+
+def _run_chunk(words, source, start):
+    state = _worker_state
+    return check_chunk(state["model"], state["reference"], state["testbench"], state["max_ulp"], words, source, start)
+
+
+def random_chunks(
+    float_environment: fp.FloatEnvironment, input_count: int, count: int, chunk_size: int, seed: int, scale: float, zeros: float
+) -> Iterator[tuple[np.ndarray, tuple[str, int]]]:
+    "(words, (source, index of first vector)) chunks of normally distributed inputs, some zeroed"
+    rng = np.random.default_rng(seed)
+    for start in range(0, count, chunk_size):
+        size = min(chunk_size, count - start)
+        inputs = rng.standard_normal((size, input_count)) * scale
+        inputs[rng.random(inputs.shape) < zeros] = 0
+        yield ipsim.float_to_bits(float_environment, inputs), ("random", start)
+
+
+def dataset_chunks(args, float_environment: fp.FloatEnvironment, input_count: int):
+    chunks = dataset.iter_dataset(args.dataset, input_count, args.chunk_size, dtype=args.dtype)
+    start = 0
+    for inputs, _ in chunks:
+        if args.samples is not None and start >= args.samples:
+            break
+        if args.samples is not None:
+            inputs = inputs[:args.samples - start]
+        yield ipsim.float_to_bits(float_environment, inputs * args.input_scale + args.input_offset), ("dataset", start)
+        start += len(inputs)
+
+
+def run(model, reference, testbench_path, max_ulp, chunks, processes: int) -> DiffReport:
+    """Check every (words, (source, start)) chunk, spread over worker processes that each
+    run the testbench themselves"""
+    report = DiffReport(model.output_count)
+    start_time = time.perf_counter()
+
+    if processes == 1:
+        testbench = rtlbatch.BatchTestbench(testbench_path)
+        for words, (source, start) in chunks:
+            report.merge(check_chunk(model, reference, testbench, max_ulp, words, source, start))
+    else:
+        shared = parallel.SharedModel(model)
+        try:
+            with multiprocessing.Pool(processes, _init_worker, (shared.spec, reference, testbench_path, max_ulp)) as pool:
+                in_flight = collections.deque()
+                for words, (source, start) in chunks:
+                    in_flight.append(pool.apply_async(_run_chunk, (words, source, start)))
+                    if len(in_flight) >= processes * parallel.CHUNKS_PER_WORKER:
+                        report.merge(in_flight.popleft().get())
+                while len(in_flight) > 0:
+                    report.merge(in_flight.popleft().get())
+        finally:
+            shared.close()
+
+    report.seconds = time.perf_counter() - start_time
+    return report
+
+
+def shrink(fails, inputs: np.ndarray, one: int) -> np.ndarray:
+    """A minimal failing variant of a failing input vector, as judged by `fails`, which
+    takes an (N, input_count) array of candidates and says which fail. Inputs are zeroed
+    by delta debugging, every candidate of a round going through the RTL in one batch,
+    then the rest are set to +/-`one` (a word) wherever the vector still fails"""
+    inputs = inputs.copy()
+    sign = np.uint16(1 << 15)
+
+    positions = np.flatnonzero(inputs)
+    granularity = 2
+    while len(positions) > 1:
+        subsets = np.array_split(positions, min(granularity, len(positions)))
+        candidates = []
+        for subset in subsets:
+            only = np.zeros_like(inputs)
+            only[subset] = inputs[subset]
+            without = inputs.copy()
+            without[subset] = 0
+            candidates += [only, without]
+
+        failing = np.flatnonzero(fails(np.array(candidates)))
+        if len(failing) > 0:
+            inputs = candidates[failing[0]]
+            kept_only = failing[0] % 2 == 0
+            positions = np.flatnonzero(inputs)
+            granularity = 2 if kept_only else max(granularity - 1, 2)
+        elif granularity >= len(positions):
+            break
+        else:
+            granularity = min(granularity * 2, len(positions))
+
+    for _ in range(MAX_SIMPLIFY_ROUNDS):
+        positions = [p for p in np.flatnonzero(inputs) if inputs[p] & ~sign != one]
+        if len(positions) == 0:
+            break
+        candidates = np.repeat(inputs[None, :], len(positions), axis=0)
+        candidates[np.arange(len(positions)), positions] = (inputs[positions] & sign) | one
+        failing = np.flatnonzero(fails(candidates))
+        if len(failing) == 0:
+            break
+        inputs = candidates[failing[0]]
+
+    return inputs
+
+
+def format_failure(float_environment: fp.FloatEnvironment, failure: Failure, shrunk: np.ndarray, got, expected) -> str:
+    def values(words, positions):
+        floats = ipsim.bits_to_float(float_environment, words[positions])
+        return ", ".join(f"[{p}] {v:g} (0x{w:04x})" for p, v, w in zip(positions, floats, words[positions]))
+
+    distance = ulp_distance(float_environment, got, expected)
+    outputs = np.flatnonzero(distance != 0)
+    nonzero = np.flatnonzero(shrunk)
+    return "\n".join([
+        f"{failure.source} vector {failure.index}: {np.count_nonzero(failure.inputs)} nonzero inputs, shrunk to {len(nonzero)}",
+        f"    inputs: {values(shrunk, nonzero) or 'all zero'}",
+        f"    RTL:      {values(got, outputs)}",
+        f"    expected: {values(expected, outputs)}",
+    ])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the generated RTL with the Python model on random and dataset vectors")
+    parser.add_argument("model", help="the .mlgen model the RTL was generated from")
+    parser.add_argument("testbench", help="the built batch testbench (e.g. obj_dir/nn_tb_batch)")
+    parser.add_argument("--generated-with", default="", metavar="ARGS", help="the mlgen2hdl options the RTL was generated with, e.g. \"--fold 4\" or \"--adder tree\", so the reference matches it")
+    parser.add_argument("--reference", choices=["hardware", "float"], default="hardware", help="compare with the bit-accurate hardware model, or with the network in doubles (rounded to binary16)")
+    parser.add_argument("--max-ulp", type=int, help="ULPs an output may be off by before its vector fails (default 0 against the hardware model, and no limit against floats)")
+    parser.add_argument("--random", "-n", type=int, default=10000, help="random vectors to run")
+    parser.add_argument("--random-scale", type=float, default=1.0, help="standard deviation of random inputs")
+    parser.add_argument("--random-zeros", type=float, default=0.0, help="fraction of random inputs to zero")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dataset", "-d", help="also run inputs from this CSV, .npy or raw binary file")
+    parser.add_argument("--samples", type=int, help="dataset rows to use (default all)")
+    parser.add_argument("--dtype", default="float32", help="element type of raw binary --dataset files")
+    parser.add_argument("--input-scale", type=float, default=1.0, help="multiply dataset inputs by this before evaluating")
+    parser.add_argument("--input-offset", type=float, default=0.0, help="then add this to dataset inputs")
+    parser.add_argument("--chunk-size", type=int, default=2048, help="vectors per testbench run")
+    parser.add_argument("--processes", "-j", type=int, default=0, help="worker processes (0 for one per core)")
+    parser.add_argument("--shrink", type=int, default=3, help="failing vectors to shrink to a minimal input and print")
+    parser.add_argument("--output", "-o", help="write the ULP statistics and shrunk failures to this JSON file")
+
+    args = parser.parse_args()
+
+    float_environment = fp.FloatEnvironment("binary16")
+    generator_args = mlgen2hdl.parser.parse_args(["difftest.mlgen", "difftest.sv", *shlex.split(args.generated_with)])
+    mlgen_model = mlgenfile.load_model(args.model)
+    reference = Reference(
+        float_environment,
+        args.reference,
+        generator_args.fold is not None,
+        mlgen.ReductionPlanner(generator_args.adder, generator_args.max_fan_in, generator_args.max_adder_depth, generator_args.adder_objective),
+        None if generator_args.formats is None else mlgenfile.load_formats(generator_args.formats, mlgen_model, float_environment),
+    )
+    max_ulp = args.max_ulp if args.max_ulp is not None or args.reference == "float" else 0
+
+    testbench = rtlbatch.BatchTestbench(args.testbench)
+    if (testbench.input_count, testbench.output_count) != (mlgen_model.input_count, mlgen_model.output_count):
+        raise ValueError(
+            f"{args.testbench} has {testbench.input_count} inputs and {testbench.output_count} outputs, "
+            f"but {args.model} has {mlgen_model.input_count} and {mlgen_model.output_count}"
+        )
+
+    def all_chunks() -> Iterator[tuple[np.ndarray, Any]]:
+        yield from random_chunks(
+            float_environment, mlgen_model.input_count, args.random, args.chunk_size, args.seed, args.random_scale, args.random_zeros
+        )
+        if args.dataset is not None:
+            yield from dataset_chunks(args, float_environment, mlgen_model.input_count)
+
+    report = run(mlgen_model, reference, args.testbench, max_ulp, all_chunks(), args.processes or os.cpu_count() or 1)
+    print(report.format(args.reference))
+
+    one = int(ipsim.float_to_bits(float_environment, [1.0])[0])
+    shrunk_failures = []
+    for failure in report.failures[:args.shrink]:
+        shrunk = shrink(lambda words: compare(mlgen_model, reference, testbench, words, max_ulp)[3].any(axis=1), failure.inputs, one)
+        got, expected, _, _ = compare(mlgen_model, reference, testbench, shrunk[None, :], max_ulp)
+        print(format_failure(float_environment, failure, shrunk, got[0], expected[0]))
+        shrunk_failures.append({
+            "source": failure.source,
+            "index": failure.index,
+            "inputs": shrunk.tolist(),
+            "got": got[0].tolist(),
+            "expected": expected[0].tolist(),
+        })
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({**report.to_json(), "shrunk_failures": shrunk_failures}, f, indent=2)
+
+    if report.failing_vectors > 0:
+        raise SystemExit(1)
@@ -0,0 +1,316 @@
+"""Design-space exploration: convert a torch model to MAC layers or log-quantised ones
+at several precisions, generate each with several adder topologies or folds, and score
+every design by bit-accurate accuracy on a calibration set and hdlestimate's estimates
+of LUTs and time per input. Then print the designs nobody should pick over another
+(the Pareto front).
+
+Designs are evaluated in a process pool. With --cache-dir, each result is cached under a
+hash of the design's settings, the weights, the calibration set and the generator's
+source, so running again with more settings only evaluates the new designs."""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+import warnings
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+import dataset
+import fp as fp
+import hdlcache
+import hdlestimate
+import hdlgen
+import ipcost
+import ipsim
+import mlgen
+import mlgen2hdl
+import torch2mlgen
+
+# Part of every cache key, so bump it whenever results would come out differently
+EXPLORE_VERSION = 1
+
+# What the Pareto front trades off, and whether each is maximised
+OBJECTIVES = {"accuracy": True, "luts": False, "time_per_input": False}
+
+
+class DesignPoint(NamedTuple):
+    "One design to try: how to convert the weights, then mlgen2hdl flags"
+    quantize: str
+    precision: Optional[float]
+    generator_args: tuple[str, ...]
+
+    def label(self) -> str:
+        quantize = "mac" if self.quantize == "mac" else f"log {self.precision}"
+        return f"{quantize} {' '.join(self.generator_args)}".strip()
+
+
+def design_points(
+    precisions: list[float], mac: bool, adders: list[str], folds: list[int], max_fan_in: Optional[int] = None
+) -> list[DesignPoint]:
+    """Every combination of the settings. MAC layers only have folded hardware, so only
+    get folded designs"""
+    if mac and len(folds) == 0:
+        raise ValueError("MAC layers only have folded hardware, so --mac needs some --folds to try")
+    fan_in_args = () if max_fan_in is None else ("--max-fan-in", str(max_fan_in))
+    quantizations = [("log", precision) for precision in precisions] + ([("mac", None)] if mac else [])
+
+    points = []
+    for quantize, precision in quantizations:
+        if quantize == "log":
+            points.extend(DesignPoint(quantize, precision, ("--adder", adder, *fan_in_args)) for adder in adders)
+        points.extend(DesignPoint(quantize, precision, ("--fold", str(units))) for units in folds)
+    return points
+
+
+def digest_arrays(arrays) -> str:
+    digest = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(f"{array.dtype.str}{array.shape}".encode("utf-8"))
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def digest_sources() -> str:
+    "Of everything a design's scores come out of, so cached ones go stale when any of it changes"
+    return hdlcache.digest_sources([torch2mlgen, mlgen, mlgen2hdl, hdlgen, hdlgen.helpers, hdlestimate, ipcost, ipsim, fp])
+
+
+def point_key(point: DesignPoint, weights_digest: str, calibration_digest: str, sources_digest: str) -> str:
+    key = {
+        "version": EXPLORE_VERSION,
+        "sources": sources_digest,
+        "point": point._asdict(),
+        "weights": weights_digest,
+        "calibration": calibration_digest,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def evaluate_point(
+    point: DesignPoint,
+    linear_layers: list[tuple[np.ndarray, np.ndarray]],
+    inputs: np.ndarray,
+    labels: np.ndarray,
+    float_environment: fp.FloatEnvironment,
+    chunk_size: int = 1024,
+) -> dict:
+    "Convert, generate (in memory) and simulate one design, returning its scores"
+    start = time.perf_counter()
+    # Neurons whose weights all quantize away warn, which is just noise with many designs at once
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        model = torch2mlgen.linear_layers_to_mlgen(
+            linear_layers, point.quantize == "log", point.precision or 0.1, verbose=False
+        )
+        args = mlgen2hdl.parser.parse_args(["explore.mlgen", "explore.sv", *point.generator_args])
+        module = mlgen2hdl.build_module(model, args, float_environment, "explore", verbose=False)
+        report = hdlestimate.estimate_module(module, float_environment)
+    del module
+
+    reduction = mlgen.ReductionPlanner(args.adder, args.max_fan_in, args.max_adder_depth, args.adder_objective)
+    correct = 0
+    software_correct = 0
+    for chunk_start in range(0, len(inputs), chunk_size):
+        chunk = inputs[chunk_start : chunk_start + chunk_size]
+        chunk_labels = labels[chunk_start : chunk_start + chunk_size]
+        outputs = model.eval_hardware(chunk, float_environment, args.fold is not None, reduction)
+        correct += int((outputs.argmax(axis=1) == chunk_labels).sum())
+        software_correct += int((model.eval_batch(chunk).argmax(axis=1) == chunk_labels).sum())
+
+    clocks = 1 if args.fold is None else model.folded_clocks(float_environment, args.fold)
+    lut_levels = report["critical_path"]["lut_levels"]
+    return {
+        "point": point._asdict(),
+        "label": point.label(),
+        "accuracy": correct / len(inputs),
+        "software_accuracy": software_correct / len(inputs),
+        "luts": report["luts"],
+        "register_bits": report["register_bits"],
+        "rom_bits": report["rom_bits"],
+        "lut_levels": lut_levels,
+        "clocks_per_input": clocks,
+        # The clock period is set by the longest path, so this is proportional to the
+        # time each input takes
+        "time_per_input": lut_levels * clocks,
+        "instances": {name: entry["count"] for name, entry in report["instances"].items()},
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def pareto_front(results: list[dict], objectives: dict[str, bool] = OBJECTIVES) -> list[dict]:
+    "The results no other result is at least as good as on every objective and better on one"
+    scores = np.array([[r[name] if maximise else -r[name] for name, maximise in objectives.items()] for r in results])
+    if len(scores) == 0:
+        return []
+    at_least_as_good = (scores[None, :, :] >= scores[:, None, :]).all(axis=2)
+    better = (scores[None, :, :] > scores[:, None, :]).any(axis=2)
+    dominated = (at_least_as_good & better).any(axis=1)
+    return [r for r, d in zip(results, dominated) if not d]
+
+
+_worker_state: dict = {}
+
+
+def _init_worker(linear_layers, inputs, labels, float_environment, chunk_size):
+    _worker_state.update(
+        linear_layers=linear_layers, inputs=inputs, labels=labels, float_environment=float_environment, chunk_size=chunk_size
+    )
+
+
+def _run_point(item):
+    key, point = item
+    state = _worker_state
+    return key, evaluate_point(
+        point, state["linear_layers"], state["inputs"], state["labels"], state["float_environment"], state["chunk_size"]
+    )
+
+
+def explore(
+    points: list[DesignPoint],
+    linear_layers: list[tuple[np.ndarray, np.ndarray]],
+    inputs: np.ndarray,
+    labels: np.ndarray,
+    float_environment: fp.FloatEnvironment,
+    cache_dir: Optional[str] = None,
+    processes: int = 1,
+    chunk_size: int = 1024,
+) -> list[dict]:
+    """Results for every point, in order, from the cache where possible and otherwise
+    evaluated `processes` at a time (and cached)"""
+    weights_digest = digest_arrays(array for layer in linear_layers for array in layer)
+    calibration_digest = digest_arrays([inputs, labels])
+    sources_digest = digest_sources()
+    keys = [point_key(point, weights_digest, calibration_digest, sources_digest) for point in points]
+
+    results = {}
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        for key in keys:
+            path = os.path.join(cache_dir, f"{key}.json")
+            if os.path.exists(path):
+                with open(path) as f:
+                    results[key] = json.load(f)
+    print(f"{len(results)} of {len(points)} designs already cached")
+
+    # The same point given twice only needs evaluating once
+    missing = list(dict((key, point) for key, point in zip(keys, points) if key not in results).items())
+    initargs = (linear_layers, inputs, labels, float_environment, chunk_size)
+    if processes == 1 or len(missing) <= 1:
+        _init_worker(*initargs)
+        evaluated = map(_run_point, missing)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(min(processes, len(missing)), _init_worker, initargs)
+        evaluated = pool.imap_unordered(_run_point, missing)
+
+    try:
+        for key, result in evaluated:
+            print(f"{result['label']}: {result['accuracy'] * 100:.2f}% accurate, ~{result['luts']:.0f} LUTs, ~{result['time_per_input']:.0f} LUT levels per input ({result['seconds']:.1f}s)")
+            results[key] = result
+            if cache_dir is not None:
+                with open(os.path.join(cache_dir, f"{key}.json"), "w") as f:
+                    json.dump(result, f, indent=2)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _worker_state.clear()
+
+    return [results[key] for key in keys]
+
+
+def load_calibration(args, input_count: int) -> tuple[np.ndarray, np.ndarray]:
+    "Up to args.samples labelled rows of the calibration set"
+    inputs = []
+    labels = []
+    rows = 0
+    for chunk_inputs, chunk_labels in dataset.iter_dataset(
+        args.calibration,
+        input_count,
+        args.chunk_size,
+        labels_path=args.labels,
+        label_column=args.label_column,
+        dtype=args.dtype,
+        label_dtype=args.label_dtype,
+    ):
+        if chunk_labels is None:
+            raise ValueError("The calibration set needs labels (--labels or --label-column) to score accuracy")
+        inputs.append(chunk_inputs)
+        labels.append(chunk_labels)
+        rows += len(chunk_inputs)
+        if args.samples is not None and rows >= args.samples:
+            break
+
+    inputs = np.concatenate(inputs)[: args.samples] * args.input_scale + args.input_offset
+    return inputs, np.concatenate(labels)[: args.samples]
+
+
+def format_results(results: list[dict]) -> str:
+    lines = [f"{'design':40} {'accuracy':>9} {'(software)':>10} {'LUTs':>10} {'LUT levels':>10} {'clocks':>7} {'time':>9}"]
+    for r in sorted(results, key=lambda r: r["luts"]):
+        lines.append(
+            f"{r['label']:40} {r['accuracy'] * 100:8.2f}% {r['software_accuracy'] * 100:9.2f}% {r['luts']:10.0f} "
+            f"{r['lut_levels']:10.0f} {r['clocks_per_input']:7d} {r['time_per_input']:9.0f}"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Explore conversion and generation settings for a torch model, printing the best trade-offs between accuracy, area and speed")
+    parser.add_argument("model", help="the input torchfile")
+    parser.add_argument("calibration", help="inputs to score accuracy on, as a CSV, .npy or raw binary file")
+    parser.add_argument("--labels", "-l", help="labels for the calibration inputs, one per row, in any of the same formats")
+    parser.add_argument("--label-column", type=int, help="take labels from this column of the calibration file instead (MNIST CSVs use 0)")
+    parser.add_argument("--dtype", default="float32", help="element type of raw binary calibration files")
+    parser.add_argument("--label-dtype", default="uint8", help="element type of raw binary --labels files")
+    parser.add_argument("--samples", "-n", type=int, default=1000, help="calibration rows to use")
+    parser.add_argument("--input-scale", type=float, default=1.0, help="multiply calibration inputs by this before evaluating")
+    parser.add_argument("--input-offset", type=float, default=0.0, help="then add this to calibration inputs")
+    parser.add_argument("--precisions", "-lp", type=float, nargs="*", default=[0.2, 0.1, 0.05, 0.025], help="log-quantisation precisions to try (see torch2mlgen's --log-quantize-precision)")
+    parser.add_argument("--mac", action="store_true", help="also try MAC layers (which are only generated folded)")
+    parser.add_argument("--adders", nargs="*", choices=mlgen.REDUCTION_TOPOLOGIES, default=["aio", "hierarchical"], help="adder topologies to try for unfolded log-quantised designs (see mlgen2hdl's --adder)")
+    parser.add_argument("--max-fan-in", type=int, help="the most inputs any fp_sum may have, for --adders")
+    parser.add_argument("--folds", type=int, nargs="*", default=[], help="units per layer to try folded designs with (see mlgen2hdl's --fold)")
+    parser.add_argument("--chunk-size", type=int, default=1024, help="number of samples to evaluate at once")
+    parser.add_argument("--processes", "-j", type=int, default=0, help="designs to evaluate at once (0 for one per core)")
+    parser.add_argument("--cache-dir", metavar="DIR", help="keep results in DIR (e.g. .explore_cache) between runs, only evaluating designs not already there")
+    parser.add_argument("--output", "-o", help="write every result, marking the Pareto front, to this JSON file")
+
+    args = parser.parse_args()
+
+    float_environment = fp.FloatEnvironment("binary16")
+
+    # do this late to avoid ridiculous time to show --help
+    import torch
+    linear_layers = torch2mlgen.torch_linear_layers(torch.jit.load(args.model, map_location="cpu"))
+
+    inputs, labels = load_calibration(args, linear_layers[0][0].shape[1])
+    points = design_points(args.precisions, args.mac, args.adders, args.folds, args.max_fan_in)
+    print(f"Exploring {len(points)} designs on {len(inputs)} calibration samples")
+
+    results = explore(
+        points,
+        linear_layers,
+        inputs,
+        labels,
+        float_environment,
+        args.cache_dir,
+        args.processes or os.cpu_count() or 1,
+        args.chunk_size,
+    )
+    front = pareto_front(results)
+
+    print("All designs:")
+    print(format_results(results))
+    print("Pareto front (accuracy against LUTs and time per input):")
+    print(format_results(front))
+
+    if args.output is not None:
+        front_ids = {id(r) for r in front}
+        with open(args.output, "w") as f:
+            json.dump([dict(r, pareto=id(r) in front_ids) for r in results], f, indent=2)
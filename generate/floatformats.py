@@ -0,0 +1,264 @@
+"""Narrower float formats for each layer, picked from intervals propagated from the
+inputs' domain.
+
+Every wire is binary16 by default, but most layers only ever see a few binades of its
+range. The network is split into blocks: a dense layer and the steps after it up to the
+next one. Everything in a block is bounded by the intervals, including its inputs, each
+shifted or multiplied term, any partial sum of those terms, and each step's outputs. The
+block's format gets the fewest exponent bits whose largest binade is --headroom above
+its largest bound, with --dynamic-range binades below that. Anything smaller than that
+flushes to zero, as it would mostly be shifted out adding it to the block's largest
+values anyway. Significands can be narrowed too. Either they get a fixed width, or
+they are narrowed greedily block by block for as long as the network's argmax agrees
+with binary16 hardware's on samples from the domain.
+
+mlgen2hdl --formats generates each block in its format, with fp_convert between blocks;
+the ports stay binary16. The formats are checked with the same model of that hardware
+(mlgen.Model.eval_hardware() with layer_environments), which simulatemlgen --hardware
+--formats runs over whole datasets."""
+
+import argparse
+import math
+import shlex
+from typing import Optional
+
+import numpy as np
+
+import fp as fp
+import hdlestimate
+from ipsim import clog2
+import mlgen
+import mlgenfile
+import mlgen2hdl
+import prune
+
+
+def blocks(model: mlgen.Model) -> list[range]:
+    "Layer indices of each dense layer and the steps after it, up to the next dense layer"
+    starts = [index for index, layer in enumerate(model.layers) if isinstance(layer, prune.DENSE_TYPES)]
+    return [range(start, stop) for start, stop in zip(starts, starts[1:] + [len(model.layers)])]
+
+
+def _magnitude(lower, upper) -> np.ndarray:
+    return np.maximum(np.abs(lower), np.abs(upper))
+
+
+def dense_bound(layer, inputs: np.ndarray) -> float:
+    """Largest magnitude of any term of a dense layer, or sum of some of its terms, for
+    inputs of at most the given magnitudes"""
+    if isinstance(layer, mlgen.DenseLogLayer):
+        input_index, exponents, _, offsets = layer.hardware_fragments()
+        terms = inputs[input_index] * np.exp2(exponents.astype(np.float64))
+        nonempty = np.diff(offsets) > 0
+        if not nonempty.any():
+            return 0.0
+        sums = np.add.reduceat(terms, offsets[:-1][nonempty])
+        return float(max(terms.max(), sums.max()))
+
+    weights = np.abs(layer.weight_array())
+    return float(max((weights * inputs).max(initial=0), (weights @ inputs).max(initial=0)))
+
+
+def block_bounds(model: mlgen.Model, lower, upper, domain: str = "box") -> list[float]:
+    "The largest magnitude anything in each of blocks() can reach"
+    bounds = prune.layer_intervals(model, lower, upper, domain)
+    input_bounds = [(np.asarray(lower, dtype=np.float64).reshape(-1), np.asarray(upper, dtype=np.float64).reshape(-1))] + bounds[:-1]
+
+    largest = []
+    for block in blocks(model):
+        inputs = _magnitude(*input_bounds[block.start])
+        magnitudes = [inputs.max(initial=0), dense_bound(model.layers[block.start], inputs)]
+        magnitudes += [_magnitude(*bounds[index]).max(initial=0) for index in block]
+        largest.append(float(max(magnitudes)))
+    return largest
+
+
+def exponent_size_for(largest: float, headroom: int, dynamic_range: int) -> int:
+    """Fewest exponent bits whose normal range reaches `headroom` binades above `largest`
+    and `dynamic_range` binades below it"""
+    if not largest > 0:
+        return 2
+    if not math.isfinite(largest):
+        raise ValueError("Can't pick a format for unbounded values")
+    top = math.floor(math.log2(largest))
+    # With bias b, normal values are in [2**(1 - b), 2**(b + 1))
+    bias = max(top + headroom, 1 - (top - dynamic_range), 1)
+    return max(math.ceil(math.log2(bias + 1)) + 1, 2)
+
+
+def min_exponent_size(model: mlgen.Model, block: range, significand_size: int) -> int:
+    """Fewest exponent bits the block's IP works with. fp_adder and fp_sum keep their
+    output exponent in at least as many bits as counting their normalising shifts takes,
+    and the sign is lost if that's more than the exponent field"""
+    size = clog2(significand_size + 1)
+    layer = model.layers[block.start]
+    if isinstance(layer, mlgen.DenseLogLayer):
+        term_count = int(np.diff(layer.hardware_fragments()[3]).max(initial=0))
+    else:
+        term_count = int(np.count_nonzero(layer.weight_array(), axis=1).max(initial=0))
+    return max(size, clog2(significand_size + 3 + clog2(max(term_count, 1))), 2)
+
+
+def block_environment(
+    model: mlgen.Model, block: range, range_exponent_size: int, significand_size: int
+) -> fp.FloatEnvironment:
+    exponent_size = max(range_exponent_size, min_exponent_size(model, block, significand_size))
+    return fp.FloatEnvironment.from_sizes(1 + exponent_size + significand_size, exponent_size)
+
+
+def choose_formats(
+    model: mlgen.Model,
+    lower,
+    upper,
+    float_environment: fp.FloatEnvironment,
+    headroom: int = 1,
+    dynamic_range: int = 12,
+    significand_size: Optional[int] = None,
+    domain: str = "box",
+) -> tuple[list[Optional[fp.FloatEnvironment]], list[float], list[int]]:
+    """Each layer's format (None for layers before the first dense layer, which stay in
+    the float environment's), and each block's largest bound and the exponent bits its
+    range needs. Ranges never get more exponent bits than the float environment has"""
+    largest = block_bounds(model, lower, upper, domain)
+    significand_size = min(significand_size or float_environment.significand_size, float_environment.significand_size)
+
+    layer_environments: list[Optional[fp.FloatEnvironment]] = [None] * len(model.layers)
+    range_exponent_sizes = []
+    for block, block_largest in zip(blocks(model), largest):
+        range_exponent_size = min(exponent_size_for(block_largest, headroom, dynamic_range), float_environment.exponent_size)
+        range_exponent_sizes.append(range_exponent_size)
+        layer_environments[block.start:block.stop] = [block_environment(model, block, range_exponent_size, significand_size)] * len(block)
+    return layer_environments, largest, range_exponent_sizes
+
+
+def agreement(outputs: np.ndarray, reference: np.ndarray) -> float:
+    "Fraction of rows whose argmax is the same"
+    if len(outputs) == 0:
+        return 1.0
+    return float(np.mean(np.argmax(outputs, axis=1) == np.argmax(reference, axis=1)))
+
+
+def narrow_significands(
+    model: mlgen.Model,
+    layer_environments: list[Optional[fp.FloatEnvironment]],
+    range_exponent_sizes: list[int],
+    float_environment: fp.FloatEnvironment,
+    samples: np.ndarray,
+    min_agreement: float,
+    folded: bool = False,
+    reduction: Optional[mlgen.ReductionPlanner] = None,
+) -> list[Optional[fp.FloatEnvironment]]:
+    """Take a bit off each block's significand in turn for as long as the argmax on the
+    samples agrees with the float environment's hardware at least min_agreement of the
+    time"""
+    reference = model.eval_hardware(samples, float_environment, folded, reduction)
+    layer_environments = list(layer_environments)
+
+    for block, range_exponent_size in zip(blocks(model), range_exponent_sizes):
+        while True:
+            environment = layer_environments[block.start]
+            if environment.significand_size <= 2:
+                break
+            narrower = block_environment(model, block, range_exponent_size, environment.significand_size - 1)
+            candidate = list(layer_environments)
+            candidate[block.start:block.stop] = [narrower] * len(block)
+            outputs = model.eval_hardware(samples, float_environment, folded, reduction, candidate)
+            if agreement(outputs, reference) < min_agreement:
+                break
+            layer_environments = candidate
+    return layer_environments
+
+
+def check(
+    model: mlgen.Model,
+    layer_environments: list[Optional[fp.FloatEnvironment]],
+    float_environment: fp.FloatEnvironment,
+    samples: np.ndarray,
+    folded: bool = False,
+    reduction: Optional[mlgen.ReductionPlanner] = None,
+) -> dict:
+    "How the hardware with the formats compares with the float environment's throughout"
+    reference = model.eval_hardware(samples, float_environment, folded, reduction)
+    outputs = model.eval_hardware(samples, float_environment, folded, reduction, layer_environments)
+    finite = np.isfinite(reference) & np.isfinite(outputs)
+    scale = np.abs(reference).max(initial=0)
+    return {
+        "agreement": agreement(outputs, reference),
+        "non_finite": int((np.isfinite(reference) != np.isfinite(outputs)).sum()),
+        "max_error": float(np.abs(outputs - reference)[finite].max(initial=0)),
+        "max_error_of_range": float(np.abs(outputs - reference)[finite].max(initial=0) / scale) if scale > 0 else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pick a narrower float format for each layer from the intervals its values are in, for mlgen2hdl --formats")
+    parser.add_argument("model", help="the input .mlgen model")
+    parser.add_argument("destination", help="where to write the formats, as JSON")
+    parser.add_argument("--input-range", type=float, nargs=2, metavar=("LOW", "HIGH"), help="every input's domain")
+    parser.add_argument("--dataset", "-d", help="take each input's domain as its range over this CSV, .npy or raw binary file instead")
+    parser.add_argument("--dtype", default="float32", help="element type of raw binary --dataset files")
+    parser.add_argument("--input-scale", type=float, default=1.0, help="multiply dataset inputs by this first")
+    parser.add_argument("--input-offset", type=float, default=0.0, help="then add this to dataset inputs")
+    parser.add_argument("--chunk-size", type=int, default=1024, help="dataset rows to read at once")
+    parser.add_argument("--domain", choices=["box", "zonotope"], default="zonotope", help="propagate the input domain as boxes, or as zonotopes (tighter after a few layers)")
+    parser.add_argument("--check", type=int, default=2000, help="inputs from the domain to check the formats (and search significands) on")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--headroom", type=int, default=1, help="binades to keep above each block's largest bound")
+    parser.add_argument("--dynamic-range", type=int, default=12, help="binades below each block's largest bound that must stay representable")
+    parser.add_argument("--significand", type=int, metavar="BITS", help="significand bits for every block (default: the float environment's)")
+    parser.add_argument("--search-significands", action="store_true", help="then narrow each block's significand for as long as the argmax still agrees on the --check inputs")
+    parser.add_argument("--min-agreement", type=float, default=0.99, help="with --search-significands, the fraction of argmaxes that must agree")
+    parser.add_argument("--generated-with", default="", metavar="ARGS", help="mlgen2hdl options to check the formats as, and estimate the area saved with, given with = as they start with -, e.g. --generated-with=\"--adder tree\"")
+    parser.add_argument("--no-estimate", action="store_true", help="skip generating the network both ways to estimate the area saved")
+
+    args = parser.parse_args()
+
+    if (args.input_range is None) == (args.dataset is None):
+        raise ValueError("Give the input domain with either --input-range or --dataset")
+
+    float_environment = fp.FloatEnvironment("binary16")
+    generator_args = mlgen2hdl.parser.parse_args(["formats.mlgen", "formats.sv", *shlex.split(args.generated_with)])
+    folded = generator_args.fold is not None
+    reduction = mlgen.ReductionPlanner(generator_args.adder, generator_args.max_fan_in, generator_args.max_adder_depth, generator_args.adder_objective)
+
+    mlgen_model = mlgenfile.load_model(args.model)
+    prune.require_hardware(mlgen_model, generator_args)
+    if args.dataset is not None:
+        lower, upper, samples = prune.domain_from_dataset(args, mlgen_model.input_count)
+    else:
+        lower = np.full(mlgen_model.input_count, args.input_range[0])
+        upper = np.full(mlgen_model.input_count, args.input_range[1])
+        samples = np.random.default_rng(args.seed).uniform(lower, upper, (args.check, mlgen_model.input_count))
+
+    layer_environments, largest, range_exponent_sizes = choose_formats(
+        mlgen_model, lower, upper, float_environment, args.headroom, args.dynamic_range, args.significand, args.domain
+    )
+    if args.search_significands:
+        layer_environments = narrow_significands(
+            mlgen_model, layer_environments, range_exponent_sizes, float_environment, samples, args.min_agreement, folded, reduction
+        )
+
+    for block, block_largest in zip(blocks(mlgen_model), largest):
+        environment = layer_environments[block.start]
+        print(
+            f"Layers #{block.start}-#{block.stop - 1}: largest value {block_largest:.4g}, "
+            f"{environment.name} ({environment.exponent_size} exponent and {environment.significand_size} significand bits)"
+        )
+
+    result = check(mlgen_model, layer_environments, float_environment, samples, folded, reduction)
+    print(f"On {len(samples)} inputs from the domain, against {float_environment.name} hardware:")
+    print(f"    argmax agrees on {result['agreement'] * 100:.2f}%")
+    print(f"    outputs are off by at most {result['max_error']:.4g} ({result['max_error_of_range'] * 100:.3f}% of their range)")
+    if result["non_finite"] > 0:
+        print(f"    {result['non_finite']} outputs are infinite or NaN in only one of them")
+
+    extra = {"largest": largest, "check": result}
+    if not args.no_estimate:
+        before = prune.estimate(mlgen_model, generator_args, float_environment)
+        mlgenfile.save_formats(layer_environments, float_environment, args.destination)
+        generator_args.formats = args.destination
+        after = prune.estimate(mlgen_model, generator_args, float_environment)
+        print(hdlestimate.format_saving(before, after))
+        extra["estimate"] = {"luts": [before["luts"], after["luts"]], "lut_levels": [before["critical_path"]["lut_levels"], after["critical_path"]["lut_levels"]]}
+
+    mlgenfile.save_formats(layer_environments, float_environment, args.destination, **extra)
@@ -1,12 +1,14 @@
 from dataclasses import dataclass
 from decimal import Decimal
+import re
 import struct
 
 @dataclass
 class FloatDefinition:
     float_size: int
     exponent_size: int
-    struct_format: str
+    # None for formats Python has no native type for
+    struct_format: str | None
 
 # https://docs.python.org/3/library/struct.html#format-characters
 
@@ -20,15 +22,50 @@ FLOAT_DEFINITIONS = {
 }
 
 
+def custom_float_definition(float_type: str) -> FloatDefinition:
+    "A format named like e4m7: 4 exponent bits and 7 significand bits, IEEE 754 style"
+    match = re.fullmatch(r"e(\d+)m(\d+)", float_type)
+    if match is None:
+        raise ValueError(f"Unknown float type `{float_type}`, expected one of {list(FLOAT_DEFINITIONS)} or e.g. e4m7")
+    exponent_size, significand_size = int(match[1]), int(match[2])
+    if exponent_size < 2 or significand_size < 2 or 1 + exponent_size + significand_size > 64:
+        raise ValueError(f"Float type `{float_type}` needs at least 2 exponent and 2 significand bits, in at most 64 bits")
+    return FloatDefinition(1 + exponent_size + significand_size, exponent_size, None)
+
+
 class FloatEnvironment:
     def __init__(self, float_type="binary16"):
-        float_info = FLOAT_DEFINITIONS[float_type]
+        if float_type in FLOAT_DEFINITIONS:
+            float_info = FLOAT_DEFINITIONS[float_type]
+        else:
+            float_info = custom_float_definition(float_type)
+        self.name = float_type
         self.float_info = float_info
         self.float_size = float_info.float_size
         self.exponent_size = float_info.exponent_size
         self.significand_size = float_info.float_size - float_info.exponent_size - 1
+        self.exponent_bias = (1 << (float_info.exponent_size - 1)) - 1
         self.base_parameters = {"floatsize": float_info.float_size, "exponentsize": float_info.exponent_size}
 
+    @classmethod
+    def from_sizes(cls, float_size: int, exponent_size: int) -> "FloatEnvironment":
+        "The standard format of those sizes if there is one, otherwise a custom one"
+        for name, definition in FLOAT_DEFINITIONS.items():
+            if (definition.float_size, definition.exponent_size) == (float_size, exponent_size):
+                return cls(name)
+        return cls(f"e{exponent_size}m{float_size - exponent_size - 1}")
+
+    def __eq__(self, other):
+        if not isinstance(other, FloatEnvironment):
+            return NotImplemented
+        return (self.float_size, self.exponent_size) == (other.float_size, other.exponent_size)
+
+    def __hash__(self):
+        return hash((self.float_size, self.exponent_size))
+
+    def __repr__(self):
+        return f"FloatEnvironment({self.name!r})"
+
     def add_ip(self, module, ip_name, connections, parameters={}):
         module.AddExternalModule(ip_name,
             connections,
@@ -36,4 +73,7 @@ class FloatEnvironment:
         
     # Thanks to https://stackoverflow.com/questions/16444726/binary-representation-of-float-in-python-bits-not-hex
     def float_to_hexstring(self, value):
+        if self.float_info.struct_format is None:
+            import ipsim
+            return f"{int(ipsim.float_to_bits(self, value)):0{-(-self.float_size // 4)}x}"
         return ''.join('{:0>2x}'.format(c) for c in struct.pack(f'!{self.float_info.struct_format}', value))
\ No newline at end of file
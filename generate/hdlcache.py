@@ -0,0 +1,195 @@
+"""Content-addressed cache of each layer's generated HDL, for mlgen2hdl.
+
+A layer's entry is keyed by a hash of its arrays, the float environment, the generator
+(GENERATOR_VERSION and the source of the modules that generate HDL), the settings that
+change what layers generate, and everything about the module at the point the layer is
+added that ends up in its text: the wire, instance and ROM counters, its input wires and
+their pipeline stages, and the folded design's start pulse. If all of those match, so
+does the text, so a hit puts the layer's declarations, instances and assignments back as
+hdlgen.Verbatim text instead of building them again, and restores what later layers and
+the pipeline or sequencer need: the output wires and their stages, the counters, and
+registers and clocks added.
+
+Cached text can't be analysed, so hdlestimate needs a module built without hits."""
+
+import hashlib
+import json
+import os
+from typing import Callable, Optional
+
+import numpy as np
+
+import fp as fp
+import hdlgen
+import ipcost
+import mlgen
+
+# Bump when generation changes in a way the source digest below wouldn't notice
+GENERATOR_VERSION = 1
+
+# Module lists layers add to, in the order Module.write_hdl() writes them
+SECTIONS = ("roms", "wires", "external_modules", "assignments", "always_blocks")
+
+
+def digest_sources(modules) -> str:
+    "Of the modules' source files, so anything keyed on it goes stale when they change"
+    digest = hashlib.sha256()
+    for module in modules:
+        with open(module.__file__, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _digest_layer(layer: mlgen.SequentialStepHDL) -> str:
+    digest = hashlib.sha256(type(layer).__name__.encode("utf-8"))
+    for name, array in sorted(layer.to_arrays().items()):
+        array = np.ascontiguousarray(array)
+        digest.update(f"{name}{array.dtype.str}{array.shape}".encode("utf-8"))
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def _describe_wire(wire) -> dict:
+    if isinstance(wire, hdlgen.Wire):
+        return {"id": wire.id, "size": wire.size, "type": wire.type.name, "length": wire.length}
+    return {"expression": wire.hdl_expression()}
+
+
+class LayerCache:
+    def __init__(self, directory: str, float_environment: fp.FloatEnvironment, settings: dict):
+        """`settings` are whatever generation options layers see (e.g. the adder and
+        reduction stages), which go into every key"""
+        self.directory = directory
+        self.float_environment = float_environment
+        self.common = {
+            "version": GENERATOR_VERSION,
+            "generator": digest_sources([mlgen, hdlgen, fp, ipcost]),
+            "float_environment": float_environment.base_parameters,
+            "settings": settings,
+        }
+        self.hits = 0
+        self.misses = 0
+        # (key, module list lengths before and after, restore data) per layer generated
+        # this time, to be stored by save()
+        self.pending: list[tuple[str, dict, dict, dict]] = []
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def key(self, layer, module: hdlgen.Module, inputs, pipeline=None, sequencer=None, float_environment=None) -> str:
+        key = {
+            **self.common,
+            "layer": _digest_layer(layer),
+            "layer_environment": None if float_environment is None else float_environment.base_parameters,
+            "counters": [module.wire_counter, module.module_counter, len(module.roms)],
+            "inputs": [
+                [_describe_wire(wire), None if pipeline is None else pipeline.latency(wire)] for wire in inputs
+            ],
+            "start": None if sequencer is None else sequencer.start.hdl_expression(),
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def apply(
+        self,
+        layer,
+        inputs,
+        module: hdlgen.Module,
+        generate: Callable[[], list],
+        pipeline: Optional[hdlgen.Pipeline] = None,
+        sequencer: Optional[hdlgen.Sequencer] = None,
+        reduction: Optional[mlgen.ReductionPlanner] = None,
+        float_environment: Optional[fp.FloatEnvironment] = None,
+    ) -> list:
+        """The layer's output wires, from the cache if it has them, otherwise from
+        generate(). float_environment is the layer's own, if it isn't the cache's"""
+        if float_environment == self.float_environment:
+            float_environment = None
+        key = self.key(layer, module, inputs, pipeline, sequencer, float_environment)
+        try:
+            with open(self._path(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+
+        if entry is not None:
+            self.hits += 1
+            return self._restore(entry, module, pipeline, sequencer, reduction, float_environment or self.float_environment)
+
+        self.misses += 1
+        before = {section: len(getattr(module, section)) for section in SECTIONS}
+        counters = (module.wire_counter, module.module_counter)
+        ports = (len(module.inputs), len(module.outputs))
+        register_bits = 0 if pipeline is None else pipeline.register_bits
+        block_clocks = 0 if sequencer is None else len(sequencer.block_clocks)
+        plans = set() if reduction is None else set(reduction.plans)
+
+        outputs = generate()
+
+        if (len(module.inputs), len(module.outputs)) != ports:
+            raise ValueError(f"{layer} added module ports, so can't be cached")
+        after = {section: len(getattr(module, section)) for section in SECTIONS}
+        restore = {
+            "counters": [module.wire_counter - counters[0], module.module_counter - counters[1]],
+            "outputs": [_describe_wire(wire) for wire in outputs],
+            "latencies": None if pipeline is None else [pipeline.latency(wire) for wire in outputs],
+            "register_bits": None if pipeline is None else pipeline.register_bits - register_bits,
+            "block_clocks": None if sequencer is None else sequencer.block_clocks[block_clocks:],
+            "start": None if sequencer is None else sequencer.start.hdl_expression(),
+            "plans": [] if reduction is None else sorted(set(reduction.plans) - plans),
+        }
+        self.pending.append((key, before, after, restore))
+        return outputs
+
+    def _restore(self, entry: dict, module, pipeline, sequencer, reduction, float_environment) -> list:
+        for section in SECTIONS:
+            getattr(module, section).extend(hdlgen.Verbatim(text) for text in entry["sections"][section])
+        module.wire_counter += entry["counters"][0]
+        module.module_counter += entry["counters"][1]
+
+        outputs = []
+        for description in entry["outputs"]:
+            if "expression" in description:
+                outputs.append(hdlgen.Verbatim(description["expression"]))
+            else:
+                outputs.append(hdlgen.Wire(
+                    description["id"], description["size"], hdlgen.WireType[description["type"]], module, description["length"]
+                ))
+
+        if pipeline is not None:
+            for wire, latency in zip(outputs, entry["latencies"]):
+                if isinstance(wire, hdlgen.Wire):
+                    pipeline.latencies[wire.id] = latency
+            pipeline.register_bits += entry["register_bits"]
+        if sequencer is not None:
+            sequencer.block_clocks.extend(entry["block_clocks"])
+            sequencer.start = hdlgen.Verbatim(entry["start"])
+        if reduction is not None:
+            for term_count in entry["plans"]:
+                reduction.plan(term_count, float_environment)
+        return outputs
+
+    def save(self, module: hdlgen.Module):
+        """Store every layer generated since the cache was made, once the module is
+        complete (so nothing added later can still change them). Their items in the
+        module are swapped for their text, so it isn't generated twice when the module
+        is written"""
+        for key, before, after, restore in self.pending:
+            sections = {}
+            for section in SECTIONS:
+                items = getattr(module, section)
+                texts = [item.hdl() for item in items[before[section]:after[section]]]
+                items[before[section]:after[section]] = [hdlgen.Verbatim(text) for text in texts]
+                # Module.write_hdl() indents line by line, so joining texts that each end
+                # in a newline makes no difference to it. ROMs are named by how many
+                # there are, so stay separate
+                if section != "roms" and all(text.endswith("\n") for text in texts):
+                    texts = ["".join(texts)] if len(texts) > 0 else []
+                sections[section] = texts
+
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary = f"{path}.{os.getpid()}.tmp"
+            with open(temporary, "w") as f:
+                json.dump({"sections": sections, **restore}, f)
+            os.replace(temporary, path)
+        self.pending = []
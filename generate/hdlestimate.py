@@ -0,0 +1,250 @@
+"""Static resource and critical path estimates for a generated hdlgen.Module, in a
+fraction of the time a Verilator build or synthesis run takes.
+
+IP instances are costed with ipcost. Glue logic in assignments and registers is counted
+as a LUT level per operator (and per 2 bits of a variable index, a 6-input LUT being a
+4:1 mux), with a LUT per output bit per operator. Timing paths start at the module's
+inputs, registers and clocked IP, and end at its outputs, register inputs and clocked
+IP's inputs. Like ipcost, the numbers are only good for comparing designs."""
+
+import collections
+import json
+from typing import NamedTuple, Optional
+
+import fp as fp
+import hdlgen
+import ipcost
+from ipsim import clog2
+
+# The parameter an IP's instances are grouped by in the report, for IP whose cost depends
+# on one
+SIZE_PARAMETERS = {"fp_sum": "inputcount", "fp_accumulator": "countsize"}
+
+
+class Driver(NamedTuple):
+    "Whatever drives a wire: an assignment or an IP instance"
+    name: str
+    sources: list[str]
+    delay: float
+    # 1 for IP instances, so paths can also be measured in instances
+    instances: int
+
+
+def _referenced(expression, wires_by_id: dict) -> tuple[list[str], int]:
+    "(ids of every wire an expression reads, LUT levels of logic in it)"
+    ids = []
+    levels = 0
+    stack = [(expression, 0)]
+    while len(stack) > 0:
+        current, depth = stack.pop()
+        levels = max(levels, depth)
+        if isinstance(current, hdlgen.Wire):
+            ids.append(current.id)
+        elif isinstance(current, hdlgen.Concatenation):
+            stack.extend((element, depth) for element in current.elements)
+        elif isinstance(current, (hdlgen.Indexing, hdlgen.Slice)):
+            index = getattr(current, "index", None)
+            if isinstance(index, str) and index in wires_by_id:
+                # A variable index is a mux over the whole array
+                ids.append(index)
+                length = getattr(current.of_what, "length", None) or len(getattr(current.of_what, "contents", [])) or 2
+                depth += max(1, -(-clog2(length) // 2))
+            stack.append((current.of_what, depth))
+        elif isinstance(current, hdlgen.Conditional):
+            stack.extend((part, depth + 1) for part in (current.condition, current.if_true, current.if_false))
+        elif isinstance(current, hdlgen.UnaryOperation):
+            stack.append((current.operand, depth + 1))
+        elif isinstance(current, hdlgen.BinaryOperation):
+            stack.extend((part, depth + 1) for part in (current.left, current.right))
+    return ids, levels
+
+
+def _target_id(target) -> str:
+    # Registers in an array are assigned through an Indexing
+    while not isinstance(target, hdlgen.Wire):
+        target = target.of_what
+    return target.id
+
+
+def _bits(wire) -> int:
+    return wire.size * (1 if wire.length is None else wire.length)
+
+
+class _Timing:
+    """Longest paths through the wire graph, in estimated LUT levels (and in IP
+    instances), worked out without recursion since adder chains can be very deep"""
+
+    def __init__(self, drivers: dict[str, Driver]):
+        self.drivers = drivers
+        # Wire id -> (arrival, instances, the source the longest path comes from)
+        self.arrivals: dict[str, tuple[float, int, Optional[str]]] = {}
+
+    def arrival(self, wire_id: str) -> tuple[float, int]:
+        stack = [wire_id]
+        while len(stack) > 0:
+            current = stack[-1]
+            if current in self.arrivals:
+                stack.pop()
+                continue
+
+            driver = self.drivers.get(current)
+            if driver is None:
+                # Inputs, registers and clocked IP outputs start paths
+                self.arrivals[current] = (0, 0, None)
+                stack.pop()
+                continue
+
+            pending = [s for s in driver.sources if s not in self.arrivals]
+            if len(pending) > 0:
+                stack.extend(pending)
+                continue
+
+            stack.pop()
+            latest = max(driver.sources, key=lambda s: self.arrivals[s][:2], default=None)
+            arrival, instances = (0, 0) if latest is None else self.arrivals[latest][:2]
+            self.arrivals[current] = (arrival + driver.delay, instances + driver.instances, latest)
+
+        return self.arrivals[wire_id][:2]
+
+    def path(self, wire_id: str) -> list[dict]:
+        "The longest path into a wire, from where it starts"
+        path = []
+        while wire_id is not None:
+            arrival, instances, previous = self.arrivals[wire_id]
+            driver = self.drivers.get(wire_id)
+            path.append({
+                "wire": wire_id,
+                "through": None if driver is None else driver.name,
+                "lut_levels": arrival,
+            })
+            wire_id = previous
+        return path[::-1]
+
+
+def estimate_module(module: hdlgen.Module, float_environment: fp.FloatEnvironment) -> dict:
+    """A JSON-serialisable report of a module's IP instances (by type, and by size for
+    SIZE_PARAMETERS), estimated LUTs, register and ROM bits, and its longest path"""
+    wires_by_id = {w.id: w for w in [*module.inputs, *module.outputs, *module.wires]}
+    wires_by_id.update((rom.id, rom) for rom in module.roms)
+
+    drivers: dict[str, Driver] = {}
+    # (name, wire ids, LUT levels after them) for every place a path ends
+    endpoints = [(output.id, [output.id], 0) for output in module.outputs]
+
+    glue_luts = 0
+    for assignment in module.assignments:
+        sources, levels = _referenced(assignment.source, wires_by_id)
+        drivers[assignment.target.id] = Driver("assign", sources, levels, 0)
+        glue_luts += levels * _bits(assignment.target)
+
+    for block in module.always_blocks:
+        controls = [e for e in (block.enable, block.reset) if e is not None]
+        for assignment in [*block.assignments, *block.reset_assignments]:
+            sources, levels = _referenced(assignment.source, wires_by_id)
+            target = wires_by_id[_target_id(assignment.target)]
+            endpoints.append((target.id, sources, levels))
+            glue_luts += levels * target.size
+        for control in controls:
+            sources, levels = _referenced(control, wires_by_id)
+            endpoints.append((f"always_ff @(posedge {block.clock.id}) control", sources, levels))
+
+    instances = collections.defaultdict(lambda: {"count": 0, "luts": 0.0})
+    unestimated = collections.Counter()
+    for instance in module.external_modules:
+        entry = instances[instance.module_name]
+        entry["count"] += 1
+
+        size_parameter = SIZE_PARAMETERS.get(instance.module_name)
+        if size_parameter is not None:
+            by_size = entry.setdefault(f"by_{size_parameter}", collections.Counter())
+            by_size[str(instance.parameters.get(size_parameter))] += 1
+
+        try:
+            cost = ipcost.ip_cost(float_environment, instance.module_name, instance.parameters)
+        except ValueError:
+            unestimated[instance.module_name] += 1
+            cost = ipcost.Cost(0, 0)
+        entry["luts"] += cost.luts
+
+        sources = []
+        for port, connection in instance.connections.items():
+            if port not in ["out", "clk"]:
+                sources.extend(_referenced(connection, wires_by_id)[0])
+
+        out = _target_id(instance.connections["out"])
+        if "clk" in instance.connections:
+            # Registered inside, so the output starts paths (which is pessimistic, as
+            # the cost's delay is the longer of the paths in and out)
+            endpoints.append((instance.id, sources, cost.delay))
+            drivers[out] = Driver(instance.id, [], cost.delay, 1)
+        else:
+            drivers[out] = Driver(instance.id, sources, cost.delay, 1)
+
+    timing = _Timing(drivers)
+    critical = None
+    deepest = 0
+    for name, sources, levels in endpoints:
+        for source in sources:
+            arrival, depth = timing.arrival(source)
+            deepest = max(deepest, depth)
+            if critical is None or arrival + levels > critical[0]:
+                critical = (arrival + levels, name, source)
+
+    ip_luts = sum(entry["luts"] for entry in instances.values())
+    report = {
+        "module": module.id,
+        "instances": {
+            name: {
+                key: (dict(sorted(value.items(), key=lambda item: int(item[0]) if item[0].isdigit() else 0))
+                      if isinstance(value, collections.Counter) else value)
+                for key, value in entry.items()
+            }
+            for name, entry in sorted(instances.items())
+        },
+        "luts": ip_luts + glue_luts,
+        "ip_luts": ip_luts,
+        "glue_luts": glue_luts,
+        "register_bits": sum(_bits(w) for w in module.wires if w.type == hdlgen.WireType.Reg),
+        "rom_bits": sum(rom.size * len(rom.contents) for rom in module.roms),
+        "critical_path": {
+            "lut_levels": 0 if critical is None else critical[0],
+            "ip_depth": deepest,
+            "endpoint": None if critical is None else critical[1],
+            "path": [] if critical is None else timing.path(critical[2]),
+        },
+    }
+    if len(unestimated) > 0:
+        report["unestimated_instances"] = dict(unestimated)
+    return report
+
+
+def write_report(report: dict, path: str):
+    "Write a report as JSON to a file, or to stdout for `-`"
+    text = json.dumps(report, indent=2)
+    if path == "-":
+        print(text)
+    else:
+        with open(path, "w") as f:
+            f.write(text + "\n")
+
+
+def summary(report: dict) -> str:
+    "A few lines for the console"
+    lines = []
+    for name, entry in report["instances"].items():
+        sizes = next((v for k, v in entry.items() if k.startswith("by_")), None)
+        detail = "" if sizes is None else " (" + ", ".join(f"{count} x {size}" for size, count in sizes.items()) + ")"
+        lines.append(f"    {name}: {entry['count']}{detail}, ~{entry['luts']:.0f} LUTs")
+    critical = report["critical_path"]
+    lines.append(f"    ~{report['luts']:.0f} LUTs, {report['register_bits']} register bits, {report['rom_bits']} ROM bits")
+    lines.append(f"    longest path ~{critical['lut_levels']:.0f} LUT levels, through up to {critical['ip_depth']} IP instances")
+    return "\n".join(lines)
+
+
+def format_saving(before: dict, after: dict) -> str:
+    "How the area and longest path changed between two reports, for the console"
+    saved = before["luts"] - after["luts"]
+    return "\n".join([
+        f"Estimated ~{before['luts']:.0f} -> ~{after['luts']:.0f} LUTs, saving ~{saved:.0f} ({saved / max(before['luts'], 1) * 100:.1f}%)",
+        f"Longest path ~{before['critical_path']['lut_levels']:.0f} -> ~{after['critical_path']['lut_levels']:.0f} LUT levels",
+    ])
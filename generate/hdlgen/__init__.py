@@ -1,8 +1,9 @@
 from enum import Enum
+import io
 from hdlgen import helpers
 
 
-WireType = Enum('WireType', ['Wire', 'Input', 'Output'])
+WireType = Enum('WireType', ['Wire', 'Input', 'Output', 'Reg'])
 
 class Expression:
     def hdl(self):
@@ -41,6 +42,18 @@ class AutoSizeLiteral(Expression):
             raise NotImplementedError()
 
 
+class SizedLiteral(Expression):
+    def __init__(self, value: int, size: int):
+        self.value = value
+        self.size = size
+
+    def hdl(self):
+        return ""
+
+    def hdl_expression(self):
+        return f"{self.size}'d{self.value}"
+
+
 class Wire(Expression):
     def __init__(self, id, size, wiretype, module, length=None):
         self.parent = module
@@ -73,6 +86,8 @@ class Wire(Expression):
             declaration = "input"
         elif self.type == WireType.Output:
             declaration = "output"
+        elif self.type == WireType.Reg:
+            declaration = "reg"
         else:
             declaration = "wire"
 
@@ -102,10 +117,89 @@ class Indexing(Expression):
     def hdl_expression(self):
         return f"{self.of_what.hdl_expression()}[{self.index}]"
 
+class Slice(Expression):
+    def __init__(self, of_what, msb, lsb):
+        self.of_what = of_what
+        self.msb = msb
+        self.lsb = lsb
+
+    def hdl(self):
+        return ""
+
+    def hdl_expression(self):
+        return f"{self.of_what.hdl_expression()}[{self.msb}:{self.lsb}]"
+
+class Conditional(Expression):
+    def __init__(self, condition, if_true, if_false):
+        self.condition = condition
+        self.if_true = if_true
+        self.if_false = if_false
+
+    def hdl(self):
+        return ""
+
+    def hdl_expression(self):
+        return f"({self.condition.hdl_expression()} ? {self.if_true.hdl_expression()} : {self.if_false.hdl_expression()})"
+
+class UnaryOperation(Expression):
+    def __init__(self, operator, operand):
+        self.operator = operator
+        self.operand = operand
+
+    def hdl(self):
+        return ""
+
+    def hdl_expression(self):
+        return f"{self.operator}{self.operand.hdl_expression()}"
+
+class BinaryOperation(Expression):
+    def __init__(self, operator, left, right):
+        self.operator = operator
+        self.left = left
+        self.right = right
+
+    def hdl(self):
+        return ""
+
+    def hdl_expression(self):
+        return f"({self.left.hdl_expression()} {self.operator} {self.right.hdl_expression()})"
+
 class HDL:
     def hdl(self):
         raise NotImplementedError
 
+class Verbatim(Expression, HDL):
+    """Text generated earlier (e.g. kept in a cache), written out as it is, in place of
+    declarations, instances or assignments, or as an expression"""
+    def __init__(self, text: str):
+        self.text = text
+
+    def hdl(self):
+        return self.text
+
+    def hdl_expression(self):
+        return self.text
+
+class Rom(Expression, HDL):
+    """A constant array, declared as a localparam, to be read by indexing it"""
+    def __init__(self, id, size, contents: list[int]):
+        self.id = id
+        self.size = size
+        self.contents = contents
+
+    def hdl(self):
+        digits = -(-self.size // 4)
+        entries = [f"{self.size}'h{value:0{digits}x}" for value in self.contents]
+        lines = [", ".join(entries[i:i + 8]) for i in range(0, len(entries), 8)]
+        return (
+            f"localparam logic [{self.size-1}:0] {self.id} [{len(self.contents)}] = '{{\n"
+            + helpers.indent(",\n".join(lines), 1)
+            + "\n};\n"
+        )
+
+    def hdl_expression(self):
+        return self.id
+
 class Assignment(HDL):
     def __init__(self, target, source):
         self.target = target
@@ -114,6 +208,45 @@ class Assignment(HDL):
     def hdl(self):
         return f"assign {self.target.id} = {self.source.hdl_expression()};\n"
     
+class NonblockingAssignment(HDL):
+    def __init__(self, target, source):
+        self.target = target
+        self.source = source
+
+    def hdl(self):
+        return f"{self.target.hdl_expression()} <= {self.source.hdl_expression()};\n"
+
+class AlwaysFF(HDL):
+    """An always_ff block clocked on the rising edge of `clock`. Registers given a reset
+    value are set to it while `reset` is high; otherwise registers only load while
+    `enable` (if given) is high"""
+    def __init__(self, clock, enable=None, reset=None):
+        self.clock = clock
+        self.enable = enable
+        self.reset = reset
+        self.assignments: list[NonblockingAssignment] = []
+        self.reset_assignments: list[NonblockingAssignment] = []
+
+    def AddAssignment(self, target, source, reset_value=None):
+        self.assignments.append(NonblockingAssignment(target, source))
+        if reset_value is not None:
+            if self.reset is None:
+                raise ValueError(f"Register `{target.id}` has a reset value but its always_ff block has no reset")
+            self.reset_assignments.append(NonblockingAssignment(target, reset_value))
+
+    def hdl(self):
+        body = "".join(assignment.hdl() for assignment in self.assignments)
+        if self.enable is not None:
+            body = f"if ({self.enable.hdl_expression()}) begin\n" + helpers.indent(body, 1) + "end\n"
+        elif len(self.reset_assignments) > 0:
+            body = "begin\n" + helpers.indent(body, 1) + "end\n"
+
+        if len(self.reset_assignments) > 0:
+            resets = "".join(assignment.hdl() for assignment in self.reset_assignments)
+            body = f"if ({self.reset.hdl_expression()}) begin\n" + helpers.indent(resets, 1) + "end else " + body
+
+        return f"always_ff @(posedge {self.clock.hdl_expression()}) begin\n" + helpers.indent(body, 1) + "end\n"
+
 class Module(HDL):
     def __init__(self, id):
         self.id = id
@@ -124,6 +257,8 @@ class Module(HDL):
         self.outputs = []
         self.assignments: list[Assignment] = []
         self.external_modules = []
+        self.always_blocks: list[AlwaysFF] = []
+        self.roms: list[Rom] = []
 
     def _make_wire(self, name, size, length=None):
         w = Wire(f"w_{self.wire_counter}{'' if name is None else '_' + name}", size, WireType.Wire, self, length)
@@ -138,6 +273,17 @@ class Module(HDL):
         self.wires.append(w)
         return w
     
+    def AddRegister(self, size: int = 1, name:str|None = None, length:int|None = None):
+        r = self._make_wire(name, size, length=length)
+        r.type = WireType.Reg
+        self.wires.append(r)
+        return r
+
+    def AddRom(self, size: int, contents: list[int], name: str|None = None):
+        r = Rom(f"rom_{len(self.roms)}{'' if name is None else '_' + name}", size, contents)
+        self.roms.append(r)
+        return r
+
     def AddInput(self, id: str, size: int = 1, length: int|None = None):
         i = self._make_input_output(id, size, WireType.Input, length=length)
         self.inputs.append(i)
@@ -156,6 +302,11 @@ class Module(HDL):
     
     def AddAssignment(self, target: Expression, source_wire):
         self.assignments.append(Assignment(target, source_wire))
+
+    def AddAlwaysFF(self, clock: Wire, enable: Expression|None = None, reset: Expression|None = None):
+        block = AlwaysFF(clock, enable, reset)
+        self.always_blocks.append(block)
+        return block
     
     def checks(self):
         
@@ -190,38 +341,26 @@ class Module(HDL):
     
             
 
-    def hdl(self):
-        o = f"module {self.id}("
-
+    def write_hdl(self, stream):
+        """Write the module to a text stream one declaration, instance and assignment at
+        a time, so the whole design never has to be held as a string"""
         input_ids = [input.id for input in self.inputs]
         output_ids = [output.id for output in self.outputs]
-        
-        o += ", ".join([*input_ids, *output_ids])
-        o += ");\n"
-
-        body = ""
-        for input in self.inputs:
-            body += input.hdl()
-
-        for output in self.outputs:
-            body += output.hdl()
-
-        for wire in self.wires:
-            body += wire.hdl()
 
-        for external_module in self.external_modules:
-            body += external_module.hdl()
+        stream.write(f"module {self.id}(")
+        stream.write(", ".join([*input_ids, *output_ids]))
+        stream.write(");\n")
 
-        for assignment in self.assignments:
-            body += assignment.hdl()
+        for part in (self.inputs, self.outputs, self.roms, self.wires, self.external_modules, self.assignments, self.always_blocks):
+            for item in part:
+                helpers.write_indented(stream, item.hdl(), 1)
 
-        body = helpers.indent(body, 1)
+        stream.write("endmodule\n")
 
-        o += body
-
-        o += "endmodule\n"
-
-        return o
+    def hdl(self):
+        o = io.StringIO()
+        self.write_hdl(o)
+        return o.getvalue()
 
 class ExternalModule(HDL):
     def __init__(self, id, module, module_name, connections, parameters):
@@ -251,4 +390,141 @@ class ExternalModule(HDL):
         out += ");\n"
 
         return out
-    
+
+
+class Pipeline:
+    """Register stages on one clock, which all hold while `enable` is low (i.e. the whole
+    pipeline stalls together). Keeps track of how many stages behind the module's inputs
+    every registered wire is, so that paths can be balanced before they meet.
+
+    reduction_stages is how many register stages generators may put inside a layer's
+    reductions (e.g. between fp_multiplybypowerof2s and their fp_sum), on top of the
+    ones between layers"""
+    def __init__(self, module: Module, clock: Wire, enable: Expression, reduction_stages: int = 0):
+        self.module = module
+        self.clock = clock
+        self.enable = enable
+        self.reduction_stages = reduction_stages
+        # Wire id -> stages, or None for constants, which fit in at any stage
+        self.latencies: dict[str, int|None] = {}
+        self.register_bits = 0
+
+    def latency(self, wire) -> int|None:
+        if not isinstance(wire, Wire):
+            return None
+        return self.latencies.get(wire.id, 0)
+
+    def mark_constant(self, wire: Wire):
+        self.latencies[wire.id] = None
+
+    def inherit(self, wire: Wire, sources):
+        "Record that `wire` is combinational logic of `sources`, so comes out at the same stage"
+        latencies = [l for l in map(self.latency, sources) if l is not None]
+        self.latencies[wire.id] = max(latencies) if len(latencies) > 0 else None
+
+    def depth(self, wires) -> int:
+        return max((l for l in map(self.latency, wires) if l is not None), default=0)
+
+    def stage(self, wires, name="stage"):
+        """Register every wire (after balancing them), returning the registered copies.
+        Constants are passed through as they are"""
+        wires = self.balance(wires)
+        block = self.module.AddAlwaysFF(self.clock, self.enable)
+
+        out = []
+        for wire in wires:
+            if self.latency(wire) is None:
+                out.append(wire)
+                continue
+            out.append(self._register(block, wire, name))
+        return out
+
+    def _register(self, block: AlwaysFF, wire: Wire, name):
+        register = self.module.AddRegister(wire.size, name, wire.length)
+        block.AddAssignment(register, wire)
+        self.latencies[register.id] = self.latency(wire) + 1
+        self.register_bits += wire.size * (1 if wire.length is None else wire.length)
+        return register
+
+    def balance(self, wires):
+        "Delay any wires behind the deepest one with extra registers so they all line up"
+        wires = list(wires)
+        target = self.depth(wires)
+        while True:
+            lagging = [i for i, wire in enumerate(wires) if self.latency(wire) is not None and self.latency(wire) < target]
+            if len(lagging) == 0:
+                return wires
+            block = self.module.AddAlwaysFF(self.clock, self.enable)
+            for i in lagging:
+                wires[i] = self._register(block, wires[i], "balance")
+
+    def handshake(self, reset: Wire, in_valid: Wire, in_ready: Wire, out_valid: Wire, out_ready: Wire, latency: int):
+        """Drive the valid/ready signals for a pipeline `latency` stages deep whose enable
+        is a plain wire: everything advances unless the output holds valid data that
+        isn't being taken, so a new input can be accepted every clock while out_ready is
+        high. in_ready depends combinationally on out_ready"""
+        self.module.AddAssignment(
+            self.enable, BinaryOperation("|", out_ready, UnaryOperation("!", out_valid))
+        )
+        self.module.AddAssignment(in_ready, self.enable)
+
+        valid = in_valid
+        block = self.module.AddAlwaysFF(self.clock, self.enable, reset)
+        for _ in range(latency):
+            register = self.module.AddRegister(1, "valid")
+            block.AddAssignment(register, valid, SizedLiteral(0, 1))
+            valid = register
+        self.module.AddAssignment(out_valid, valid)
+
+
+class Sequencer:
+    """Control for a design that works on one input at a time over many clocks, as a
+    chain of blocks that run one after another. Each block is started by a one-clock
+    pulse on `start`, and hands on to the next with then(), giving its own done pulse"""
+
+    # Accepting an input, registering the last done pulse as out_valid, and seeing out_ready
+    HANDSHAKE_CLOCKS = 3
+
+    def __init__(self, module: Module, clock: Wire, reset: Wire):
+        self.module = module
+        self.clock = clock
+        self.reset = reset
+        self.first_start = module.AddRegister(1, "start")
+        self.start: Expression = self.first_start
+        self.block_clocks: list[int] = []
+
+    def then(self, done: Expression, clocks: int):
+        "Chain on a block that pulses `done` `clocks` clocks after it was started"
+        self.start = done
+        self.block_clocks.append(clocks)
+
+    def clocks_per_input(self) -> int:
+        return sum(self.block_clocks) + self.HANDSHAKE_CLOCKS
+
+    def handshake(self, in_valid: Wire, in_ready: Wire, out_valid: Wire, out_ready: Wire) -> Wire:
+        """Drive the valid/ready signals: an input is taken whenever nothing is in
+        progress, and the outputs are held with out_valid high from the last block's done
+        pulse until out_ready. Returns the wire that is high as an input is taken, for
+        latching it"""
+        busy = self.module.AddRegister(1, "busy")
+        finished = self.module.AddRegister(1, "finished")
+        accept = self.module.AddWire(1, "accept")
+        taken = BinaryOperation("&", out_valid, out_ready)
+
+        self.module.AddAssignment(in_ready, UnaryOperation("!", busy))
+        self.module.AddAssignment(accept, BinaryOperation("&", in_valid, in_ready))
+        self.module.AddAssignment(out_valid, finished)
+
+        block = self.module.AddAlwaysFF(self.clock, reset=self.reset)
+        block.AddAssignment(self.first_start, accept, SizedLiteral(0, 1))
+        block.AddAssignment(
+            busy,
+            Conditional(accept, SizedLiteral(1, 1), BinaryOperation("&", busy, UnaryOperation("!", taken))),
+            SizedLiteral(0, 1),
+        )
+        block.AddAssignment(
+            finished,
+            Conditional(self.start, SizedLiteral(1, 1), BinaryOperation("&", finished, UnaryOperation("!", out_ready))),
+            SizedLiteral(0, 1),
+        )
+        return accept
@@ -1,4 +1,11 @@
 def indent(text, amount):
     return "\n".join([line if len(line) == 0 else amount * "  " + line for line in text.split("\n")])
 
+def write_indented(stream, text, amount):
+    """Same as stream.write(indent(text, amount)) for text that ends in a newline, or is
+    empty, without building the indented copy"""
+    prefix = amount * "  "
+    for line in text.splitlines(keepends=True):
+        stream.write(line if line == "\n" else prefix + line)
+
 indentation = "  "
@@ -0,0 +1,134 @@
+"""Rough area and delay estimates for the IP in ip/, for comparing designs without
+synthesising them.
+
+Areas are in LUTs and delays in LUT levels, for a generic 6-input LUT FPGA. They come
+from counting the logic each block's SystemVerilog describes (comparators, shifters,
+adders and so on, at about a LUT per bit each and a level per log2 of a shifter's
+range), not from synthesis, so they are only good for comparing designs with each
+other. Delays are of the combinational path through the block; for clocked blocks,
+the longer of the paths into and out of the register."""
+
+from typing import NamedTuple
+
+import fp as fp
+from ipsim import clog2
+
+
+class Cost(NamedTuple):
+    luts: float
+    delay: float
+
+
+def fp_multiplybypowerof2(float_environment: fp.FloatEnvironment, **_) -> Cost:
+    # Exponent plus a constant, and the wrap check folded into the output mux
+    return Cost(float_environment.exponent_size + 2, 2)
+
+
+def fp_multiplybyvariablepowerof2(float_environment: fp.FloatEnvironment, **_) -> Cost:
+    exponent_size = float_environment.exponent_size
+    # Exponent adder, wrap comparator and a zeroing mux over the whole word
+    return Cost(2 * exponent_size + float_environment.float_size, 4)
+
+
+def fp_activation_relu(float_environment: fp.FloatEnvironment, **_) -> Cost:
+    return Cost(float_environment.float_size - 1, 1)
+
+
+def fp_adder(float_environment: fp.FloatEnvironment, **_) -> Cost:
+    significand_size = float_environment.significand_size
+    magnitude_size = float_environment.exponent_size + significand_size
+    shift_levels = clog2(significand_size + 2)
+
+    luts = (
+        magnitude_size  # comparing the operands
+        + 2 * (magnitude_size + 1)  # swapping them
+        + (significand_size + 1) * shift_levels  # aligning the smaller one
+        + (significand_size + 3)  # adding
+        + (significand_size + 2) * (shift_levels + 1)  # finding the leading 1 and normalising
+        + significand_size  # rounding
+        + float_environment.exponent_size
+    )
+    delay = clog2(magnitude_size) + 1 + shift_levels + 3 + 2 * shift_levels + 2
+    return Cost(luts, delay)
+
+
+def fp_sum(float_environment: fp.FloatEnvironment, inputcount: int = 4, **_) -> Cost:
+    inputcount = int(inputcount)
+    significand_size = float_environment.significand_size
+    exponent_size = float_environment.exponent_size
+    sum_size = significand_size + 3 + clog2(inputcount)
+    shift_levels = clog2(significand_size + 2)
+
+    # Both of fp_sum's loops are chains, one step per input: finding the maximum exponent
+    # (a compare and a mux each), then adding up the aligned significands
+    luts = (
+        2 * exponent_size * (inputcount - 1)
+        + inputcount * ((significand_size + 2) * shift_levels + sum_size)
+        + sum_size * (clog2(sum_size) + 2)  # ones' complement, normalisation
+        + exponent_size
+    )
+    delay = 2 * (inputcount - 1) + shift_levels + (inputcount - 1) + 2 * clog2(sum_size) + 2
+    return Cost(luts, delay)
+
+
+def fp_multiplier(float_environment: fp.FloatEnvironment, **_) -> Cost:
+    significand_size = float_environment.significand_size
+    # Multiplying by a constant is a few shifted adds
+    luts = (significand_size + 1) ** 2 // 2 + 2 * significand_size + 2 * float_environment.exponent_size
+    return Cost(luts, 2 * clog2(significand_size + 1) + 4)
+
+
+def fp_variablemultiplier(float_environment: fp.FloatEnvironment, **_) -> Cost:
+    significand_size = float_environment.significand_size
+    luts = (significand_size + 1) ** 2 + 2 * significand_size + 3 * float_environment.exponent_size
+    return Cost(luts, 2 * clog2(significand_size + 1) + 6)
+
+
+def fp_accumulator(float_environment: fp.FloatEnvironment, countsize: int = 16, **_) -> Cost:
+    significand_size = float_environment.significand_size
+    exponent_size = float_environment.exponent_size
+    accumulator_size = 1 + int(countsize) + (1 << exponent_size) + significand_size
+
+    # Into the register: shifting the input into place, negating and adding. Out of it:
+    # negating, finding the leading 1 and normalising
+    luts = accumulator_size * (exponent_size + 4 + clog2(accumulator_size))
+    delay_in = exponent_size + accumulator_size // 8 + 2
+    delay_out = accumulator_size // 8 + 2 * clog2(accumulator_size) + 2
+    return Cost(luts, max(delay_in, delay_out))
+
+
+def fp_convert(float_environment: fp.FloatEnvironment, inexponentsize: int = 5, **_) -> Cost:
+    # Rebiasing adder, under/overflow comparators and the output mux; the significand is
+    # only wiring
+    exponent_size = max(float_environment.exponent_size, int(inexponentsize)) + 2
+    return Cost(3 * exponent_size + float_environment.float_size, 4)
+
+
+IP_COSTS = {
+    cost.__name__: cost
+    for cost in [
+        fp_multiplybypowerof2,
+        fp_multiplybyvariablepowerof2,
+        fp_activation_relu,
+        fp_adder,
+        fp_sum,
+        fp_multiplier,
+        fp_variablemultiplier,
+        fp_accumulator,
+        fp_convert,
+    ]
+}
+
+
+def ip_cost(float_environment: fp.FloatEnvironment, ip_name: str, parameters: dict = {}) -> Cost:
+    """Estimate for an instance of `ip_name` with the given (SystemVerilog) parameters.
+    Instances whose floatsize and exponentsize differ from the environment's (layers
+    built in their own format) are estimated in theirs"""
+    if ip_name not in IP_COSTS:
+        raise ValueError(f"No cost estimate for `{ip_name}`")
+    parameters = dict(parameters)
+    float_size = int(parameters.pop("floatsize", float_environment.float_size))
+    exponent_size = int(parameters.pop("exponentsize", float_environment.exponent_size))
+    if (float_size, exponent_size) != (float_environment.float_size, float_environment.exponent_size):
+        float_environment = fp.FloatEnvironment.from_sizes(float_size, exponent_size)
+    return IP_COSTS[ip_name](float_environment, **parameters)
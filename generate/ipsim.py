@@ -0,0 +1,404 @@
+"""Bit-accurate software models of the IP in ip/.
+
+Every kernel works on numpy arrays of raw float words (uint16 for binary16) and
+mirrors the SystemVerilog of the block it is named after, including its quirks:
+truncating shifts, flush-to-zero on exponent wrap, and so on. This lets us predict
+what the generated hardware computes without a Verilator build."""
+
+import numpy as np
+
+import fp as fp
+
+WORD_DTYPES = {16: np.uint16, 32: np.uint32, 64: np.uint64}
+
+NATIVE_FLOAT_DTYPES = {"e": np.float16, "f": np.float32, "d": np.float64}
+
+
+def clog2(value: int) -> int:
+    "Same as SystemVerilog's $clog2"
+    return max(int(value) - 1, 0).bit_length()
+
+
+def _bit_length(values: np.ndarray) -> np.ndarray:
+    "Vectorised int.bit_length() for non-negative values below 2**53"
+    return np.frexp(values.astype(np.float64))[1].astype(np.int64)
+
+
+def _word_dtype(float_environment: fp.FloatEnvironment):
+    "Formats without a native size (see fp.custom_float_definition) use the next one up"
+    return WORD_DTYPES[min(size for size in WORD_DTYPES if size >= float_environment.float_size)]
+
+
+def _fields(float_environment: fp.FloatEnvironment, words):
+    words = np.asarray(words).astype(np.int64)
+    significand_size = float_environment.significand_size
+    exponent_size = float_environment.exponent_size
+
+    sign = (words >> (float_environment.float_size - 1)) & 1
+    exponent = (words >> significand_size) & ((1 << exponent_size) - 1)
+    significand = words & ((1 << significand_size) - 1)
+    return words, sign, exponent, significand
+
+
+def _to_words(float_environment: fp.FloatEnvironment, values):
+    return (values & ((1 << float_environment.float_size) - 1)).astype(
+        _word_dtype(float_environment)
+    )
+
+
+def _encode(float_environment: fp.FloatEnvironment, values) -> np.ndarray:
+    """IEEE 754 style rounding (to nearest, ties to even, with subnormals and overflow to
+    infinity) for formats numpy has no type for"""
+    values = np.asarray(values, dtype=np.float64)
+    significand_size = float_environment.significand_size
+    bias = float_environment.exponent_bias
+    infinite_exponent = (1 << float_environment.exponent_size) - 1
+
+    magnitude = np.abs(values)
+    finite = np.isfinite(values)
+    magnitude = np.where(finite, magnitude, 0)
+    _, exponent = np.frexp(magnitude)
+    # Biased exponent were it normal; zeros and subnormals are scaled as if it was 1
+    exponent = np.where(magnitude == 0, 1, np.maximum(exponent.astype(np.int64) - 1 + bias, 1))
+    scaled = np.rint(np.ldexp(magnitude, significand_size - (exponent - bias)))
+    # Rounding up to the next power of two carries into the exponent on its own
+    words = ((exponent - 1) << significand_size) + scaled.astype(np.int64)
+
+    infinity = infinite_exponent << significand_size
+    words = np.where(~finite | (words >= infinity), infinity, words)
+    words = np.where(np.isnan(values), infinity | (1 << (significand_size - 1)), words)
+    words = words | (np.signbit(values).astype(np.int64) << (float_environment.float_size - 1))
+    return _to_words(float_environment, words)
+
+
+def _decode(float_environment: fp.FloatEnvironment, words) -> np.ndarray:
+    _, sign, exponent, significand = _fields(float_environment, words)
+    significand_size = float_environment.significand_size
+    bias = float_environment.exponent_bias
+    infinite_exponent = (1 << float_environment.exponent_size) - 1
+
+    magnitude = np.ldexp(
+        np.where(exponent == 0, significand, (1 << significand_size) | significand).astype(np.float64),
+        np.maximum(exponent, 1) - bias - significand_size,
+    )
+    magnitude = np.where(exponent == infinite_exponent, np.where(significand == 0, np.inf, np.nan), magnitude)
+    return np.where(sign == 1, -magnitude, magnitude)
+
+
+def float_to_bits(float_environment: fp.FloatEnvironment, values) -> np.ndarray:
+    "Round floats to the environment's format (as the testbenches do) and return the raw words"
+    if float_environment.float_info.struct_format is None:
+        return _encode(float_environment, values)
+    native = NATIVE_FLOAT_DTYPES[float_environment.float_info.struct_format]
+    return np.asarray(values, dtype=np.float64).astype(native).view(
+        _word_dtype(float_environment)
+    )
+
+
+def bits_to_float(float_environment: fp.FloatEnvironment, words) -> np.ndarray:
+    if float_environment.float_info.struct_format is None:
+        return _decode(float_environment, words)
+    native = NATIVE_FLOAT_DTYPES[float_environment.float_info.struct_format]
+    return (
+        np.asarray(words).astype(_word_dtype(float_environment)).view(native).astype(np.float64)
+    )
+
+
+def fp_convert(
+    input_environment: fp.FloatEnvironment, float_environment: fp.FloatEnvironment, argumenta
+) -> np.ndarray:
+    """Words of input_environment's format to float_environment's, as the IP does it: the
+    exponent is rebiased, the significand truncated or padded with zeros. Zeros and
+    subnormals become zero, as do values too small for the new exponent, and ones too big
+    become infinity. Infinities and NaNs stay so"""
+    _, sign, exponent, significand = _fields(input_environment, argumenta)
+    significand_size = float_environment.significand_size
+    input_infinite_exponent = (1 << input_environment.exponent_size) - 1
+    infinite_exponent = (1 << float_environment.exponent_size) - 1
+
+    exponent_out = exponent - input_environment.exponent_bias + float_environment.exponent_bias
+    shift = significand_size - input_environment.significand_size
+    significand_out = significand << shift if shift >= 0 else significand >> -shift
+
+    special = exponent == input_infinite_exponent
+    zero = ~special & ((exponent == 0) | (exponent_out <= 0))
+    overflow = ~special & ~zero & (exponent_out >= infinite_exponent)
+
+    result = np.where(
+        special,
+        (infinite_exponent << significand_size) | ((significand != 0) << (significand_size - 1)),
+        np.where(
+            overflow,
+            infinite_exponent << significand_size,
+            (exponent_out << significand_size) | significand_out,
+        ),
+    )
+    result = np.where(zero, 0, result) | (sign << (float_environment.float_size - 1))
+    return _to_words(float_environment, result)
+
+
+def fp_activation_relu(float_environment: fp.FloatEnvironment, argumenta) -> np.ndarray:
+    words, sign, _, _ = _fields(float_environment, argumenta)
+    return _to_words(float_environment, np.where(sign == 0, words, 0))
+
+
+def fp_multiplybypowerof2(
+    float_environment: fp.FloatEnvironment, argumenta, power, negate=0
+) -> np.ndarray:
+    """power and negate broadcast against argumenta, so a whole set of differently-
+    parameterised instances can be evaluated at once"""
+    _, sign, exponent, significand = _fields(float_environment, argumenta)
+    power = np.asarray(power, dtype=np.int64)
+    negate = np.asarray(negate, dtype=np.int64)
+    exponent_mask = (1 << float_environment.exponent_size) - 1
+
+    # exponent_a + exponentsize'(power), wrapping in exponentsize bits
+    shifted_exponent = (exponent + (power & exponent_mask)) & exponent_mask
+
+    affected = (
+        ((sign ^ negate) << (float_environment.float_size - 1))
+        | (shifted_exponent << float_environment.significand_size)
+        | significand
+    )
+
+    # Wrapping round means we over/underflowed
+    wrapped = np.where(power > 0, shifted_exponent < exponent, shifted_exponent > exponent)
+
+    return _to_words(float_environment, np.where(wrapped, 0, affected))
+
+
+def fp_multiplybyvariablepowerof2(
+    float_environment: fp.FloatEnvironment, argumenta, power, negate=0
+) -> np.ndarray:
+    """fp_multiplybypowerof2() with the power and negation on ports, which unlike the
+    fixed one gives zero for zero exponents"""
+    _, _, exponent, _ = _fields(float_environment, argumenta)
+    out = fp_multiplybypowerof2(float_environment, argumenta, power, negate)
+    return _to_words(float_environment, np.where(exponent == 0, 0, out))
+
+
+def fp_adder(float_environment: fp.FloatEnvironment, argumenta, argumentb) -> np.ndarray:
+    significand_size = float_environment.significand_size
+    exponent_size = float_environment.exponent_size
+
+    words_a, sign_a, exponent_a, significand_a = _fields(float_environment, argumenta)
+    words_b, sign_b, exponent_b, significand_b = _fields(float_environment, argumentb)
+
+    argsorter = ((exponent_a << significand_size) | significand_a) >= (
+        (exponent_b << significand_size) | significand_b
+    )
+
+    sign_big = np.where(argsorter, sign_a, sign_b)
+    exponent_big = np.where(argsorter, exponent_a, exponent_b)
+    significand_big = np.where(argsorter, significand_a, significand_b)
+
+    sign_small = np.where(argsorter, sign_b, sign_a)
+    exponent_small = np.where(argsorter, exponent_b, exponent_a)
+    significand_small = np.where(argsorter, significand_b, significand_a)
+
+    implied_one = 1 << significand_size
+    operand_mask = (1 << (significand_size + 2)) - 1
+
+    big_operand = implied_one | significand_big
+    small_operand = (implied_one | significand_small) >> np.minimum(
+        exponent_big - exponent_small, 63
+    )
+
+    # Negated in significandsize+2 bits, but then zero- rather than sign-extended
+    # into the significandsize+3 bit sum
+    big_signed = np.where(sign_big, (-big_operand) & operand_mask, big_operand)
+    small_signed = np.where(sign_small, (-small_operand) & operand_mask, small_operand)
+
+    significands_added = (big_signed + small_signed) & ((1 << (significand_size + 3)) - 1)
+    significand_sign = significands_added >> (significand_size + 2)
+
+    for_shifting = np.where(
+        significand_sign == 1,
+        ~significands_added & operand_mask,
+        significands_added & operand_mask,
+    )
+
+    # The normalisation loop gives up (leaving the index at 0) after significandsize
+    # shifts if it never finds a leading 1
+    shifts_needed = significand_size + 2 - _bit_length(for_shifting)
+    found = shifts_needed < significand_size
+    first_1_index = np.where(found, shifts_needed, 0)
+    significand_shifted = (
+        for_shifting << np.where(found, shifts_needed, significand_size)
+    ) & operand_mask
+
+    significand_mask = (1 << significand_size) - 1
+    significand_out = (
+        ((significand_shifted >> 1) & significand_mask) + (significand_shifted & 1)
+    ) & significand_mask
+
+    exponent_width = max(exponent_size, clog2(significand_size + 1))
+    exponent_out = (exponent_big - first_1_index + 1) & ((1 << exponent_width) - 1)
+
+    result = (
+        (significand_sign << (exponent_width + significand_size))
+        | (exponent_out << significand_size)
+        | significand_out
+    )
+
+    out = np.where(
+        significands_added == 0,
+        0,
+        np.where(words_a == 0, words_b, np.where(words_b == 0, words_a, result)),
+    )
+    return _to_words(float_environment, out)
+
+
+def fp_sum_segments(
+    float_environment: fp.FloatEnvironment, argument_words, offsets
+) -> np.ndarray:
+    """Run a separate fp_sum over each segment argument_words[..., offsets[i]:offsets[i+1]],
+    each with inputcount set to its segment length. Empty segments give 0, as the
+    generator ties neurons without any contributions to a literal 0."""
+    significand_size = float_environment.significand_size
+    exponent_size = float_environment.exponent_size
+
+    words, sign, exponent, significand = _fields(float_environment, argument_words)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    input_counts = np.diff(offsets)
+    nonempty = input_counts > 0
+    starts = offsets[:-1][nonempty]
+    input_counts = input_counts[nonempty]
+
+    out = np.zeros(words.shape[:-1] + (len(nonempty),), dtype=np.int64)
+    if len(starts) == 0:
+        return _to_words(float_environment, out)
+
+    segment = np.repeat(np.arange(len(starts)), input_counts)
+    max_exponent = np.maximum.reduceat(exponent, starts, axis=-1)
+
+    sext_significand = (1 << significand_size) | significand
+    shifted = sext_significand >> np.minimum(max_exponent[..., segment] - exponent, 63)
+    shifted = np.where(words == 0, 0, shifted)
+    total = np.add.reduceat(np.where(sign == 1, -shifted, shifted), starts, axis=-1)
+
+    # Per-segment widths, all set by inputcount
+    input_count_log = np.array([clog2(n) for n in input_counts], dtype=np.int64)
+    sum_width = significand_size + 3 + input_count_log
+    carry_width = np.array([clog2(w) for w in sum_width], dtype=np.int64)
+    sum_mask = (1 << sum_width) - 1
+
+    significand_sum = total & sum_mask
+    result_sign = (significand_sum >> (sum_width - 1)) & 1
+    # Negative results are ones'-complemented, not negated
+    significand_sum = np.where(result_sign == 1, ~significand_sum & sum_mask, significand_sum)
+
+    shift = sum_width - 2 - (_bit_length(significand_sum) - 1)
+    shift = np.where(significand_sum == 0, 0, shift)
+    normalised = (significand_sum << shift) & sum_mask
+
+    carry_mask = (1 << carry_width) - 1
+    # 4'($clog2(inputcount)) + 4'b1, counted down once per normalising shift
+    significand_carry = (((input_count_log & 0xF) + 1) - shift) & carry_mask
+
+    # max_exponent is unsigned, so the carry is zero-extended before the add
+    exponent_width = np.maximum(exponent_size, carry_width)
+    exponent_out = (max_exponent + significand_carry) & ((1 << exponent_width) - 1)
+    significand_correct = (normalised >> (sum_width - 2 - significand_size)) & (
+        (1 << significand_size) - 1
+    )
+
+    result = (
+        (result_sign << (exponent_width + significand_size))
+        | (exponent_out << significand_size)
+        | significand_correct
+    )
+    out[..., nonempty] = np.where(significand_sum == 0, 0, result)
+
+    return _to_words(float_environment, out)
+
+
+def fp_sum(float_environment: fp.FloatEnvironment, argument_array) -> np.ndarray:
+    "A single fp_sum, with inputcount given by the last axis of argument_array"
+    argument_array = np.asarray(argument_array)
+    return fp_sum_segments(
+        float_environment, argument_array, [0, argument_array.shape[-1]]
+    )[..., 0]
+
+
+def fp_variablemultiplier(float_environment: fp.FloatEnvironment, argumenta, argumentb) -> np.ndarray:
+    significand_size = float_environment.significand_size
+    exponent_size = float_environment.exponent_size
+
+    _, sign_a, exponent_a, significand_a = _fields(float_environment, argumenta)
+    _, sign_b, exponent_b, significand_b = _fields(float_environment, argumentb)
+
+    implied_one = 1 << significand_size
+    multiplied = (implied_one | significand_a) * (implied_one | significand_b)
+    carry = multiplied >> (2 * significand_size + 1)
+    significand_out = (multiplied >> (significand_size + carry)) & (implied_one - 1)
+
+    exponent_bias = (1 << (exponent_size - 1)) - 1
+    exponent_out = exponent_a + exponent_b - exponent_bias + carry
+    infinite_exponent = (1 << exponent_size) - 1
+
+    sign_out = sign_a ^ sign_b
+    result = np.where(
+        exponent_out >= infinite_exponent,
+        infinite_exponent << significand_size,
+        (exponent_out << significand_size) | significand_out,
+    ) | (sign_out << (float_environment.float_size - 1))
+
+    zero = (exponent_a == 0) | (exponent_b == 0) | (exponent_out < 1)
+    return _to_words(float_environment, np.where(zero, 0, result))
+
+
+def accumulator_size(float_environment: fp.FloatEnvironment, count_size: int = 16) -> int:
+    "fp_accumulator's accumulatorsize"
+    return 1 + count_size + (1 << float_environment.exponent_size) + float_environment.significand_size
+
+
+def fp_accumulator_segments(
+    float_environment: fp.FloatEnvironment, argument_words, offsets, count_size: int = 16
+) -> np.ndarray:
+    """What an fp_accumulator holds after being cleared and then fed each segment
+    argument_words[..., offsets[i]:offsets[i+1]] in turn. The fixed point sum is exact,
+    so unlike fp_sum the order doesn't matter. Empty segments give 0"""
+    significand_size = float_environment.significand_size
+    exponent_size = float_environment.exponent_size
+    size = accumulator_size(float_environment, count_size)
+    if size > 63:
+        raise NotImplementedError(f"Can't model a {size} bit fp_accumulator with 64 bit integers")
+
+    _, sign, exponent, significand = _fields(float_environment, argument_words)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    input_counts = np.diff(offsets)
+    nonempty = input_counts > 0
+
+    magnitude = np.where(
+        exponent == 0, 0, ((1 << significand_size) | significand) << np.maximum(exponent - 1, 0)
+    )
+    total = np.zeros(magnitude.shape[:-1] + (len(nonempty),), dtype=np.int64)
+    if np.any(nonempty):
+        total[..., nonempty] = np.add.reduceat(
+            np.where(sign == 1, -magnitude, magnitude), offsets[:-1][nonempty], axis=-1
+        )
+
+    # Wrap into accumulatorsize bits, as the register would
+    total = ((total + (1 << (size - 1))) & ((1 << size) - 1)) - (1 << (size - 1))
+    sign_out = (total < 0).astype(np.int64)
+    magnitude_out = np.abs(total)
+
+    # Exact bit lengths of values up to 2**63, 32 bits at a time
+    high = magnitude_out >> 32
+    first_1_index = np.where(
+        high > 0, 32 + _bit_length(high), _bit_length(magnitude_out & 0xFFFFFFFF)
+    ) - 1
+    exponent_out = first_1_index - (significand_size - 1)
+    significand_out = (magnitude_out >> np.maximum(first_1_index - significand_size, 0)) & (
+        (1 << significand_size) - 1
+    )
+
+    infinite_exponent = (1 << exponent_size) - 1
+    result = np.where(
+        exponent_out >= infinite_exponent,
+        infinite_exponent << significand_size,
+        (exponent_out << significand_size) | significand_out,
+    ) | (sign_out << (float_environment.float_size - 1))
+
+    return _to_words(float_environment, np.where(exponent_out < 1, 0, result))
@@ -0,0 +1,197 @@
+"""Test vectors for the IP's unit benches, with the outputs ipsim says it should give.
+
+Every bit-accurate model (eval_hardware(), difftest, the format search) rests on ipsim's
+kernels matching the SystemVerilog, so the benches in test/<ip>_tb_unit.cpp read these
+on stdin and compare the IP with them word for word:
+
+    python generate/ipvectors.py fp_sum -Ginputcount=17 | obj_dir/check/fp_sum.17/bench
+
+Give the same -Gname=value parameters the bench was built with (`make check-ip` builds
+and runs every check in the Makefile's ip_checks, each with its CHECK_PARAMS). Each line is one vector of hex words: the inputs in port order, then the expected
+output. Inputs are a mix of arbitrary bit patterns (so zeros, subnormals, infinities and
+NaNs turn up) and ordinary values across a few dozen binades."""
+
+import argparse
+import re
+import sys
+
+import numpy as np
+
+import fp as fp
+import ipsim
+
+
+def random_words(float_environment: fp.FloatEnvironment, rng: np.random.Generator, count: int) -> np.ndarray:
+    "Half arbitrary bit patterns, half ordinary values, plus the special ones up front"
+    size = float_environment.float_size
+    infinite_exponent = (1 << float_environment.exponent_size) - 1
+    significand_size = float_environment.significand_size
+    special = np.array([
+        0,
+        1 << (size - 1),
+        1,
+        1 << significand_size,
+        ((infinite_exponent - 1) << significand_size) | ((1 << significand_size) - 1),
+        infinite_exponent << significand_size,
+        (infinite_exponent << significand_size) | 1,
+    ], dtype=np.int64)
+
+    arbitrary = rng.integers(0, 1 << size, count // 2, dtype=np.int64)
+    values = rng.normal(0, 1, count - count // 2) * np.exp2(rng.integers(-12, 12, count - count // 2))
+    ordinary = ipsim.float_to_bits(float_environment, values).astype(np.int64)
+    words = np.concatenate([special, arbitrary, ordinary])
+    rng.shuffle(words[len(special):])
+    return words[:max(count, len(special))]
+
+
+def fp_sum(parameters: dict, rng: np.random.Generator, count: int) -> np.ndarray:
+    """argument_array (inputcount words), out. Each vector's values are spread over a
+    random number of binades, so some cancel and carry and some are mostly rounded away,
+    and a few vectors are arbitrary bit patterns"""
+    float_environment = fp.FloatEnvironment.from_sizes(parameters["floatsize"], parameters["exponentsize"])
+    input_count = parameters["inputcount"]
+    spread = rng.integers(0, 12, (count, 1))
+    values = rng.normal(0, 1, (count, input_count)) * np.exp2(rng.integers(-spread, spread + 1, (count, input_count)))
+    words = ipsim.float_to_bits(float_environment, values).astype(np.int64)
+    arbitrary = rng.random(count) < 0.1
+    words[arbitrary] = random_words(float_environment, rng, int(arbitrary.sum()) * input_count)[:arbitrary.sum() * input_count].reshape(-1, input_count)
+    out = ipsim.fp_sum(float_environment, words)
+    return np.concatenate([words, out.astype(np.int64)[:, None]], axis=1)
+
+
+def fp_adder(parameters: dict, rng: np.random.Generator, count: int) -> np.ndarray:
+    "argumenta, argumentb, out, with argumentb sometimes argumenta negated, or close to it"
+    float_environment = fp.FloatEnvironment.from_sizes(parameters["floatsize"], parameters["exponentsize"])
+    a = random_words(float_environment, rng, count)
+    b = rng.permutation(random_words(float_environment, rng, len(a)))
+    sign = 1 << (float_environment.float_size - 1)
+    near = rng.random(len(a)) < 0.2
+    b[near] = (a[near] ^ sign) + rng.integers(-2, 3, int(near.sum()))
+    b &= (1 << float_environment.float_size) - 1
+    out = ipsim.fp_adder(float_environment, a, b)
+    return np.stack([a, b, out.astype(np.int64)], axis=1)
+
+
+def fp_multiplybypowerof2(parameters: dict, rng: np.random.Generator, count: int) -> np.ndarray:
+    "argumenta, out, for the power and negate the instance has"
+    float_environment = fp.FloatEnvironment.from_sizes(parameters["floatsize"], parameters["exponentsize"])
+    words = random_words(float_environment, rng, count)
+    out = ipsim.fp_multiplybypowerof2(float_environment, words, parameters["power"], parameters["negate"])
+    return np.stack([words, out.astype(np.int64)], axis=1)
+
+
+def fp_activation_relu(parameters: dict, rng: np.random.Generator, count: int) -> np.ndarray:
+    "argumenta, out"
+    float_environment = fp.FloatEnvironment.from_sizes(parameters["floatsize"], parameters["exponentsize"])
+    words = random_words(float_environment, rng, count)
+    out = ipsim.fp_activation_relu(float_environment, words)
+    return np.stack([words, out.astype(np.int64)], axis=1)
+
+
+def fp_convert(parameters: dict, rng: np.random.Generator, count: int) -> np.ndarray:
+    "argumenta (in the input format), out"
+    input_environment = fp.FloatEnvironment.from_sizes(parameters["infloatsize"], parameters["inexponentsize"])
+    float_environment = fp.FloatEnvironment.from_sizes(parameters["floatsize"], parameters["exponentsize"])
+    words = random_words(input_environment, rng, count)
+    out = ipsim.fp_convert(input_environment, float_environment, words)
+    return np.stack([words, out.astype(np.int64)], axis=1)
+
+
+def fp_multiplybyvariablepowerof2(parameters: dict, rng: np.random.Generator, count: int) -> np.ndarray:
+    "argumenta, power (in powersize bits), negate, out"
+    float_environment = fp.FloatEnvironment.from_sizes(parameters["floatsize"], parameters["exponentsize"])
+    power_size = parameters["powersize"]
+    words = random_words(float_environment, rng, count)
+    # Mostly the small shifts weights use, but every power now and then
+    power = np.where(
+        rng.random(len(words)) < 0.5,
+        rng.integers(-20, 6, len(words)),
+        rng.integers(-(1 << (power_size - 1)), 1 << (power_size - 1), len(words)),
+    )
+    negate = rng.integers(0, 2, len(words))
+
+    # Zeros and subnormals shifted up, which must stay zero
+    sign = 1 << (float_environment.float_size - 1)
+    zeros = np.array([0, sign, 1, sign | 1, (1 << float_environment.significand_size) - 1])
+    zero_powers = np.arange(1, 6)
+    words = np.concatenate([np.repeat(zeros, len(zero_powers)), words])
+    power = np.concatenate([np.tile(zero_powers, len(zeros)), power])
+    negate = np.concatenate([np.arange(len(zeros) * len(zero_powers)) % 2, negate])
+
+    out = ipsim.fp_multiplybyvariablepowerof2(float_environment, words, power, negate)
+    return np.stack([words, power & ((1 << power_size) - 1), negate, out.astype(np.int64)], axis=1)
+
+
+def fp_variablemultiplier(parameters: dict, rng: np.random.Generator, count: int) -> np.ndarray:
+    "argumenta, argumentb, out"
+    float_environment = fp.FloatEnvironment.from_sizes(parameters["floatsize"], parameters["exponentsize"])
+    a = random_words(float_environment, rng, count)
+    b = rng.permutation(random_words(float_environment, rng, len(a)))
+    out = ipsim.fp_variablemultiplier(float_environment, a, b)
+    return np.stack([a, b, out.astype(np.int64)], axis=1)
+
+
+def fp_accumulator(parameters: dict, rng: np.random.Generator, count: int) -> np.ndarray:
+    """clear, argumenta, out after the clock: runs of up to 32 additions, each started by
+    a clear. Arbitrary bit patterns are rare, as one huge value swamps the rest of a run"""
+    float_environment = fp.FloatEnvironment.from_sizes(parameters["floatsize"], parameters["exponentsize"])
+    values = rng.normal(0, 1, count) * np.exp2(rng.integers(-12, 12, count))
+    words = ipsim.float_to_bits(float_environment, values).astype(np.int64)
+    arbitrary = rng.random(count) < 0.05
+    words[arbitrary] = random_words(float_environment, rng, int(arbitrary.sum()))[:arbitrary.sum()]
+
+    clear = np.zeros(count, dtype=np.int64)
+    out = np.zeros(count, dtype=np.int64)
+    start = 0
+    while start < count:
+        stop = min(start + int(rng.integers(1, 33)), count)
+        clear[start] = 1
+        # What it holds after each addition of the run
+        ends = np.arange(start + 1, stop + 1)
+        out[start:stop] = [
+            ipsim.fp_accumulator_segments(float_environment, words[start:end], [0, end - start], parameters["countsize"])[0]
+            for end in ends
+        ]
+        start = stop
+    return np.stack([clear, words, out], axis=1)
+
+
+# Each IP's vectors, and the parameters it has by default
+GENERATORS = {
+    "fp_sum": (fp_sum, {"floatsize": 16, "exponentsize": 5, "inputcount": 4}),
+    "fp_adder": (fp_adder, {"floatsize": 16, "exponentsize": 5}),
+    "fp_multiplybypowerof2": (fp_multiplybypowerof2, {"floatsize": 16, "exponentsize": 5, "power": 4, "negate": 0}),
+    "fp_activation_relu": (fp_activation_relu, {"floatsize": 32, "exponentsize": 8}),
+    "fp_convert": (fp_convert, {"floatsize": 16, "exponentsize": 5, "infloatsize": 16, "inexponentsize": 5}),
+    "fp_multiplybyvariablepowerof2": (fp_multiplybyvariablepowerof2, {"floatsize": 16, "exponentsize": 5, "powersize": 8}),
+    "fp_variablemultiplier": (fp_variablemultiplier, {"floatsize": 16, "exponentsize": 5}),
+    "fp_accumulator": (fp_accumulator, {"floatsize": 16, "exponentsize": 5, "countsize": 16}),
+}
+
+
+def parse_parameters(arguments: list[str], defaults: dict) -> dict:
+    "Verilator's -Gname=value overrides on top of the defaults"
+    parameters = dict(defaults)
+    for argument in arguments:
+        match = re.fullmatch(r"-G(\w+)=(-?\d+)", argument)
+        if match is None:
+            raise ValueError(f"Expected -Gname=value parameters, got {argument}")
+        if match[1] not in parameters:
+            raise ValueError(f"Unknown parameter {match[1]}, expected one of {sorted(parameters)}")
+        parameters[match[1]] = int(match[2])
+    return parameters
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write test vectors for an IP's unit bench, with the outputs ipsim gives")
+    parser.add_argument("ip", choices=sorted(GENERATORS))
+    parser.add_argument("--count", type=int, default=20000, help="vectors to write")
+    parser.add_argument("--seed", type=int, default=0)
+
+    # Everything else is the bench's -G parameters
+    args, parameter_arguments = parser.parse_known_args()
+    generate, defaults = GENERATORS[args.ip]
+    parameters = parse_parameters(parameter_arguments, defaults)
+
+    vectors = generate(parameters, np.random.default_rng(args.seed), args.count)
+    np.savetxt(sys.stdout, vectors, fmt="%x")
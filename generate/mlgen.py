@@ -1,13 +1,37 @@
-from dataclasses import dataclass
-from typing import Optional, NamedTuple
+from dataclasses import dataclass, field
+from typing import Iterator, Optional, NamedTuple
+import collections
+import heapq
 import warnings
 import numpy as np
 import math
 
 import fp as fp
+import ipcost
+import ipsim
+import profiling
+import zonotope
 
 import hdlgen
 
+# Upper bound on the number of fragment words worked on at once in eval_hardware
+HARDWARE_CHUNK_ELEMENTS = 1 << 22
+
+# Upper bound on the bytes of per-step matrices (effective weights etc.) kept per layer
+STEP_CACHE_BYTES = 256 << 20
+
+# Sparse products gather one input column per nonzero, which is so much slower per
+# multiply than BLAS that it only wins when very few of the matrix's entries are nonzero
+SPARSE_MATMUL_MAX_DENSITY = 1 / 512
+
+# Integer bits each folded neuron's fp_accumulator has spare, so it can add up to 2**this
+# many terms without overflowing
+FOLD_ACCUMULATOR_COUNT_SIZE = 16
+
+# Clocks a folded step takes on top of its longest lane: one to flush the last term out
+# of the accumulators, and one for the done pulse
+FOLD_OVERHEAD_CLOCKS = 2
+
 
 class WeightFragment(NamedTuple):
     exponent: int
@@ -95,6 +119,253 @@ def make_aio_adder(
     on_module.AddAssignment(arg_wire, hdlgen.Concatenation(summing_wires))
 
 
+class Reduction(NamedTuple):
+    """One IP instance (fp_sum or fp_adder) in a planned reduction. Children are either
+    further Reductions or positions in the list of wires being added up"""
+    ip: str
+    children: tuple
+
+
+REDUCTION_TOPOLOGIES = ["aio", "tree", "linear", "hierarchical", "auto"]
+
+
+@dataclass
+class ReductionPlanner:
+    """Chooses how each neuron's terms get added up, by their count:
+    - aio: one fp_sum of all of them, as make_aio_adder() does
+    - tree, linear: a balanced tree or a chain of fp_adders (whose rounding differs
+      from fp_sum's, so check accuracy with eval_hardware())
+    - hierarchical: fp_sums of at most a given fan-in, whose outputs are added up the
+      same way, trying several fan-ins
+    - auto: any of the above
+    picking whichever has the least delay or area (the objective, ties going to the
+    other one) by ipcost's estimates. max_fan_in bounds every fp_sum's inputcount, and
+    max_depth how many IP instances there are from any term to the sum"""
+
+    topology: str = "aio"
+    max_fan_in: Optional[int] = None
+    max_depth: Optional[int] = None
+    objective: str = "delay"
+    # Every plan made so far, by term count
+    plans: dict = field(default_factory=dict, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        if self.topology not in REDUCTION_TOPOLOGIES:
+            raise ValueError(f"Unknown adder topology `{self.topology}`, expected one of {REDUCTION_TOPOLOGIES}")
+        if self.objective not in ["delay", "area"]:
+            raise ValueError(f"Unknown objective `{self.objective}`, expected delay or area")
+
+    def plan(self, term_count: int, float_environment: fp.FloatEnvironment) -> Reduction | int:
+        "The cheapest reduction of term_count terms (a bare position if nothing needs adding)"
+        if term_count not in self.plans:
+            self.plans[term_count] = self._make_plan(term_count, float_environment)
+        return self.plans[term_count]
+
+    def _make_plan(self, term_count: int, float_environment: fp.FloatEnvironment) -> Reduction | int:
+        positions = list(range(term_count))
+        candidates = []
+        if self.topology in ["aio", "auto"]:
+            candidates.append(Reduction("fp_sum", tuple(positions)))
+        if self.topology in ["tree", "auto"]:
+            candidates.append(_adder_tree(positions))
+        if self.topology in ["linear", "auto"]:
+            candidates.append(_adder_chain(positions))
+        if self.topology in ["hierarchical", "auto"]:
+            fan_ins = {1 << i for i in range(1, term_count.bit_length())} | {max(term_count, 2)}
+            if self.max_fan_in is not None:
+                fan_ins = {f for f in fan_ins if f <= self.max_fan_in} | {self.max_fan_in}
+            candidates.extend(_sum_hierarchy(positions, fan_in) for fan_in in sorted(fan_ins) if fan_in >= 2)
+
+        best = None
+        for candidate in candidates:
+            luts, delay, depth, fan_in = reduction_cost(candidate, float_environment)
+            if self.max_fan_in is not None and fan_in > self.max_fan_in:
+                continue
+            if self.max_depth is not None and depth > self.max_depth:
+                continue
+            score = (delay, luts) if self.objective == "delay" else (luts, delay)
+            if best is None or score < best[0]:
+                best = (score, candidate)
+
+        if best is None:
+            raise ValueError(
+                f"No {self.topology} reduction of {term_count} terms has a fan-in of at most {self.max_fan_in} and a depth of at most {self.max_depth}"
+            )
+        return best[1]
+
+
+def _adder_tree(children: list) -> Reduction | int:
+    # Split the same way make_tree_adder() does
+    if len(children) == 1:
+        return children[0]
+    half = len(children) // 2
+    return Reduction("fp_adder", (_adder_tree(children[:half]), _adder_tree(children[half:])))
+
+
+def _adder_chain(children: list) -> Reduction | int:
+    total = children[0]
+    for child in children[1:]:
+        total = Reduction("fp_adder", (total, child))
+    return total
+
+
+def _sum_hierarchy(children: list, fan_in: int) -> Reduction:
+    "fp_sums of at most fan_in inputs each, as evenly filled as possible, level by level"
+    while len(children) > fan_in:
+        groups = -(-len(children) // fan_in)
+        base, extra = divmod(len(children), groups)
+        sizes = [base + (i < extra) for i in range(groups)]
+        starts = np.concatenate(([0], np.cumsum(sizes))).tolist()
+        children = [Reduction("fp_sum", tuple(children[a:b])) for a, b in zip(starts, starts[1:])]
+    return Reduction("fp_sum", tuple(children))
+
+
+def fold_reduction(plan: Reduction | int, leaf, node):
+    """Compute node(instance, [results for its children]) for every instance in a plan,
+    children first, with leaf(position) for the terms. Doesn't recurse, as chains of
+    fp_adders can be thousands of instances deep"""
+    if not isinstance(plan, Reduction):
+        return leaf(plan)
+
+    results = {}
+    stack = [plan]
+    while len(stack) > 0:
+        current = stack[-1]
+        pending = [c for c in current.children if isinstance(c, Reduction) and id(c) not in results]
+        if len(pending) > 0:
+            stack.extend(pending)
+            continue
+
+        stack.pop()
+        results[id(current)] = node(
+            current,
+            [results[id(c)] if isinstance(c, Reduction) else leaf(c) for c in current.children],
+        )
+    return results[id(plan)]
+
+
+def reduction_cost(plan: Reduction | int, float_environment: fp.FloatEnvironment) -> tuple[float, float, int, int]:
+    "(LUTs, delay, IP instances deep, largest fp_sum inputcount) of a planned reduction"
+    def node(instance, children):
+        inputcount = len(instance.children) if instance.ip == "fp_sum" else 0
+        cost = ipcost.ip_cost(
+            float_environment, instance.ip, {"inputcount": inputcount} if inputcount > 0 else {}
+        )
+        return (
+            cost.luts + sum(c[0] for c in children),
+            cost.delay + max(c[1] for c in children),
+            1 + max(c[2] for c in children),
+            max([inputcount] + [c[3] for c in children]),
+        )
+
+    return fold_reduction(plan, lambda _: (0, 0, 0, 0), node)
+
+
+def is_single_sum(plan: Reduction | int) -> bool:
+    "Whether a plan is just what make_aio_adder() makes"
+    return isinstance(plan, Reduction) and plan.ip == "fp_sum" and plan.children == tuple(range(len(plan.children)))
+
+
+def describe_reduction(plan: Reduction | int) -> str:
+    "e.g. `2 levels of fp_sum (up to 32 inputs)` or `fp_adder x 9, 4 deep`"
+    if not isinstance(plan, Reduction):
+        return "no adders"
+
+    def node(instance, children):
+        counts = collections.Counter({instance.ip: 1})
+        for child_counts, _, _ in children:
+            counts += child_counts
+        fan_in = len(instance.children) if instance.ip == "fp_sum" else 0
+        return counts, 1 + max(c[1] for c in children), max([fan_in] + [c[2] for c in children])
+
+    counts, depth, fan_in = fold_reduction(plan, lambda _: (collections.Counter(), 0, 0), node)
+    if set(counts) == {"fp_sum"}:
+        if depth == 1:
+            return f"fp_sum ({fan_in} inputs)"
+        return f"{depth} levels of fp_sum (up to {fan_in} inputs)"
+    return ", ".join(f"{ip} x {count}" for ip, count in sorted(counts.items())) + f", {depth} deep"
+
+
+def make_reduction(
+    float_environment: fp.FloatEnvironment,
+    on_module: hdlgen.Module,
+    summing_wires: list[hdlgen.Wire],
+    plan: Reduction | int,
+    out_wire: hdlgen.Wire,
+    width,
+    pipeline: Optional[hdlgen.Pipeline] = None,
+    register_levels: int = 0,
+):
+    """Generate a planned reduction of summing_wires into out_wire. With a pipeline, the
+    outputs of instances up to register_levels above the terms are registered (except
+    for out_wire itself)"""
+    if not isinstance(plan, Reduction):
+        on_module.AddAssignment(out_wire, summing_wires[plan])
+        if pipeline is not None:
+            pipeline.inherit(out_wire, [summing_wires[plan]])
+        return
+
+    def node(instance, made):
+        children = [wire for wire, _ in made]
+        level = 1 + max(level for _, level in made)
+        if pipeline is not None:
+            children = pipeline.balance(children)
+
+        is_root = instance is plan
+        out = out_wire if is_root else on_module.AddWire(width, "partial_sum")
+        if instance.ip == "fp_sum":
+            make_aio_adder(float_environment, on_module, children, out, width)
+        else:
+            float_environment.add_ip(
+                on_module,
+                "fp_adder",
+                {"argumenta": children[0], "argumentb": children[1], "out": out},
+            )
+
+        if pipeline is not None:
+            pipeline.inherit(out, children)
+            if not is_root and level <= register_levels:
+                out = pipeline.stage([out], "sum_reg")[0]
+        return out, level
+
+    fold_reduction(plan, lambda position: (summing_wires[position], 0), node)
+
+
+def convert_wires(
+    input_environment: fp.FloatEnvironment,
+    float_environment: fp.FloatEnvironment,
+    on_module: hdlgen.Module,
+    wires: list,
+    pipeline: Optional[hdlgen.Pipeline] = None,
+) -> list:
+    "fp_convert each wire from input_environment's format to float_environment's"
+    converted = []
+    for wire in wires:
+        out = on_module.AddWire(float_environment.float_size, "converted")
+        float_environment.add_ip(
+            on_module,
+            "fp_convert",
+            {"argumenta": wire, "out": out},
+            {"infloatsize": input_environment.float_size, "inexponentsize": input_environment.exponent_size},
+        )
+        if pipeline is not None:
+            pipeline.inherit(out, [wire])
+        converted.append(out)
+    return converted
+
+
+def eval_reduction(
+    float_environment: fp.FloatEnvironment, argument_words: np.ndarray, plan: Reduction | int
+) -> np.ndarray:
+    "Bit-accurate output of a planned reduction of the terms on argument_words' last axis"
+    def node(instance, children):
+        if instance.ip == "fp_sum":
+            return ipsim.fp_sum(float_environment, np.stack(children, axis=-1))
+        return ipsim.fp_adder(float_environment, *children)
+
+    return fold_reduction(plan, lambda position: argument_words[..., position], node)
+
+
 def make_neuron_stage(
     float_environment, on_module, input_wires, weights, out_wire, width
 ):
@@ -118,10 +389,308 @@ def make_neuron_stage(
     )
 
 
+class FoldedTerms(NamedTuple):
+    """Every term a folded step adds up, grouped by neuron: neuron i's terms are
+    [offsets[i], offsets[i+1]). `unit` is the IP each lane runs its terms through, and
+    operands are either that IP's power (with negates) or the raw weight words"""
+    unit: str
+    shape: tuple[int, int]
+    inputs: np.ndarray
+    operands: np.ndarray
+    negatives: np.ndarray
+    offsets: np.ndarray
+
+
+def plan_fold(term_counts: np.ndarray, units: int) -> list[list[int]]:
+    """Share out the neurons with any terms between at most `units` lanes, biggest first
+    onto whichever lane has the fewest terms so far, so the longest lane (which sets how
+    many clocks the step takes) is as short as it can easily be made"""
+    neurons = [int(j) for j in np.argsort(-np.asarray(term_counts), kind="stable") if term_counts[j] > 0]
+    lanes: list[list[int]] = [[] for _ in range(min(units, len(neurons)))]
+    loads = [(0, lane) for lane in range(len(lanes))]
+
+    for neuron in neurons:
+        load, lane = heapq.heappop(loads)
+        lanes[lane].append(neuron)
+        heapq.heappush(loads, (load + int(term_counts[neuron]), lane))
+
+    return [sorted(lane) for lane in lanes]
+
+
+def folded_step_clocks(terms: FoldedTerms, units: int) -> int:
+    counts = np.diff(terms.offsets)
+    depth = max((int(counts[lane].sum()) for lane in plan_fold(counts, units)), default=0)
+    return depth + FOLD_OVERHEAD_CLOCKS
+
+
+def make_folded_step(
+    float_environment: fp.FloatEnvironment,
+    on_module: hdlgen.Module,
+    input_wires: list[hdlgen.Wire],
+    terms: FoldedTerms,
+    sequencer: hdlgen.Sequencer,
+    units: int,
+) -> list[hdlgen.Wire]:
+    """Generate a folded step: `units` lanes, each an instance of terms.unit feeding an
+    fp_accumulator, work through their neurons' terms one per clock from a ROM, all on
+    one shared counter. Started by sequencer.start, and hands on with its done pulse"""
+    float_size = float_environment.float_size
+    counts = np.diff(terms.offsets)
+    if counts.max(initial=0) > 1 << FOLD_ACCUMULATOR_COUNT_SIZE:
+        raise ValueError(
+            f"A neuron has {counts.max()} terms, but folded accumulators can only add up to {1 << FOLD_ACCUMULATOR_COUNT_SIZE}"
+        )
+
+    lanes = plan_fold(counts, units)
+    depth = folded_step_clocks(terms, units) - FOLD_OVERHEAD_CLOCKS
+    clock, reset, start = sequencer.clock, sequencer.reset, sequencer.start
+
+    # The whole input vector, for each lane to pick its operands out of
+    input_bank = on_module.AddWire(float_size, "fold_inputs", len(input_wires))
+    on_module.AddAssignment(input_bank, hdlgen.Concatenation(input_wires))
+
+    # Runs through ROM addresses 0 to depth. The last address is always a padding entry,
+    # during which the final terms' sums are stored
+    counter_size = max(depth.bit_length(), 1)
+    counter = on_module.AddRegister(counter_size, "fold_counter")
+    running = on_module.AddRegister(1, "fold_running")
+    done = on_module.AddRegister(1, "fold_done")
+    at_end = hdlgen.BinaryOperation("==", counter, hdlgen.SizedLiteral(depth, counter_size))
+    advance = on_module.AddWire(1, "fold_advance")
+    on_module.AddAssignment(advance, hdlgen.BinaryOperation("&", running, hdlgen.UnaryOperation("!", at_end)))
+
+    control = on_module.AddAlwaysFF(clock, reset=reset)
+    control.AddAssignment(
+        counter,
+        hdlgen.Conditional(
+            start,
+            hdlgen.SizedLiteral(0, counter_size),
+            hdlgen.Conditional(
+                advance,
+                hdlgen.BinaryOperation("+", counter, hdlgen.SizedLiteral(1, counter_size)),
+                counter,
+            ),
+        ),
+    )
+    control.AddAssignment(
+        running, hdlgen.Conditional(start, hdlgen.SizedLiteral(1, 1), advance), hdlgen.SizedLiteral(0, 1)
+    )
+    control.AddAssignment(done, hdlgen.BinaryOperation("&", running, at_end), hdlgen.SizedLiteral(0, 1))
+
+    outputs: list[hdlgen.Wire] = [None] * len(counts)
+    for neuron in np.flatnonzero(counts == 0):
+        outputs[neuron] = on_module.AddWire(float_size, f"neuron_folded_{neuron}")
+        on_module.AddAssignment(outputs[neuron], hdlgen.AutoSizeLiteral(0))
+
+    # Fragment exponents are stored as int8
+    operand_size = 8 if terms.unit == "fp_multiplybyvariablepowerof2" else float_size
+    index_size = max(ipsim.clog2(len(input_wires)), 1)
+    for lane in lanes:
+        slot_size = max(ipsim.clog2(len(lane)), 1)
+
+        # Entries, from the least significant bit up: slot to store the neuron's sum in,
+        # input index, operand, negate, last term of a neuron, first term, valid
+        fields = {}
+        entry_size = 0
+        for name, size in [("slot", slot_size), ("input", index_size), ("operand", operand_size), ("negate", 1), ("last", 1), ("first", 1), ("valid", 1)]:
+            fields[name] = (entry_size, size)
+            entry_size += size
+
+        term_index = np.concatenate([np.arange(terms.offsets[j], terms.offsets[j + 1]) for j in lane])
+        values = {
+            "slot": np.repeat(np.arange(len(lane)), counts[lane]),
+            "input": terms.inputs[term_index],
+            "operand": terms.operands[term_index].astype(np.int64) & ((1 << operand_size) - 1),
+            "negate": terms.negatives[term_index],
+            "last": np.isin(term_index, terms.offsets[1:] - 1),
+            "first": np.isin(term_index, terms.offsets[:-1]),
+            "valid": np.ones(len(term_index)),
+        }
+        entries = np.zeros(depth + 1, dtype=np.int64)
+        for name, value in values.items():
+            entries[: len(term_index)] |= np.asarray(value, dtype=np.int64) << fields[name][0]
+
+        rom = on_module.AddRom(entry_size, entries.tolist(), "fold_terms")
+        entry = on_module.AddWire(entry_size, "fold_entry")
+        on_module.AddAssignment(entry, hdlgen.Indexing(rom, counter.id))
+
+        field_wires = {}
+        for name, (lsb, size) in fields.items():
+            field_wires[name] = on_module.AddWire(size, f"fold_{name}")
+            on_module.AddAssignment(field_wires[name], hdlgen.Slice(entry, lsb + size - 1, lsb))
+
+        operand = on_module.AddWire(float_size, "fold_operand")
+        on_module.AddAssignment(operand, hdlgen.Indexing(input_bank, field_wires["input"].id))
+
+        term = on_module.AddWire(float_size, "fold_term")
+        if terms.unit == "fp_multiplybyvariablepowerof2":
+            connections = {"power": field_wires["operand"], "negate": field_wires["negate"]}
+            parameters = {"powersize": operand_size}
+        else:
+            connections = {"argumentb": field_wires["operand"]}
+            parameters = {}
+        float_environment.add_ip(
+            on_module, terms.unit, {"argumenta": operand, **connections, "out": term}, parameters
+        )
+
+        total = on_module.AddWire(float_size, "fold_total")
+        float_environment.add_ip(
+            on_module,
+            "fp_accumulator",
+            {
+                "clk": clock,
+                "enable": hdlgen.BinaryOperation("&", running, field_wires["valid"]),
+                "clear": field_wires["first"],
+                "argumenta": term,
+                "out": total,
+            },
+            {"countsize": FOLD_ACCUMULATOR_COUNT_SIZE},
+        )
+
+        # A neuron's sum is in the accumulator the clock after its last term went in
+        write = on_module.AddRegister(1, "fold_write")
+        slot = on_module.AddRegister(slot_size, "fold_slot")
+        control.AddAssignment(
+            write,
+            hdlgen.BinaryOperation(
+                "&", running, hdlgen.BinaryOperation("&", field_wires["valid"], field_wires["last"])
+            ),
+            hdlgen.SizedLiteral(0, 1),
+        )
+        control.AddAssignment(slot, field_wires["slot"])
+
+        sums = on_module.AddRegister(float_size, "fold_sums", len(lane))
+        on_module.AddAlwaysFF(clock, write).AddAssignment(hdlgen.Indexing(sums, slot.id), total)
+
+        for position, neuron in enumerate(lane):
+            outputs[neuron] = on_module.AddWire(float_size, f"neuron_folded_{neuron}")
+            on_module.AddAssignment(outputs[neuron], hdlgen.Indexing(sums, position))
+
+    profiling.annotate(terms=int(terms.offsets[-1]), lanes=len(lanes), unit=terms.unit, clocks=depth + FOLD_OVERHEAD_CLOCKS)
+    sequencer.then(done, depth + FOLD_OVERHEAD_CLOCKS)
+    return outputs
+
+
+def eval_folded_terms(
+    float_environment: fp.FloatEnvironment, words_in: np.ndarray, terms: FoldedTerms
+) -> np.ndarray:
+    "Bit-accurate model of make_folded_step()'s outputs"
+    chunk = max(1, HARDWARE_CHUNK_ELEMENTS // max(len(terms.inputs), 1))
+
+    out = []
+    for start in range(0, len(words_in), chunk):
+        operands = words_in[start : start + chunk, terms.inputs]
+        if terms.unit == "fp_multiplybyvariablepowerof2":
+            multiplied = ipsim.fp_multiplybyvariablepowerof2(
+                float_environment, operands, terms.operands, terms.negatives
+            )
+        else:
+            multiplied = ipsim.fp_variablemultiplier(float_environment, operands, terms.operands)
+        out.append(
+            ipsim.fp_accumulator_segments(
+                float_environment, multiplied, terms.offsets, FOLD_ACCUMULATOR_COUNT_SIZE
+            )
+        )
+
+    if len(out) == 0:
+        return np.zeros((0, len(terms.offsets) - 1), dtype=words_in.dtype)
+    return np.concatenate(out)
+
+
 # pytorch is prone to API changes and extracting model params is generally poorly-documented
 # + a bit buggy so we make our own scheme here
 
 
+def as_float_array(values) -> np.ndarray:
+    "Weights/biases may be nested lists or torch tensors depending on where they came from"
+    return np.asarray(values, dtype=np.float64)
+
+
+def stored_float_array(values) -> np.ndarray:
+    "Keep float32 weights (as torch gives us) as they are when saving, rather than doubling them"
+    array = np.asarray(values)
+    return array if array.dtype.kind == "f" else array.astype(np.float64)
+
+
+def interval_matmul(
+    lower: np.ndarray, upper: np.ndarray, weights: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Bound (N, input_count) boxes through an output_count x input_count matrix by
+    splitting it into its positive and negative parts: the lower bound takes the lower
+    inputs through positive weights and the upper inputs through negative ones, and vice
+    versa for the upper bound"""
+    positive = np.maximum(weights, 0.0)
+    negative = np.minimum(weights, 0.0)
+    return (
+        lower @ positive.T + upper @ negative.T,
+        upper @ positive.T + lower @ negative.T,
+    )
+
+
+def sparse_matmul(
+    batch: np.ndarray,
+    rows: np.ndarray,
+    columns: np.ndarray,
+    values: np.ndarray,
+    shape: tuple[int, int],
+) -> np.ndarray:
+    """batch @ M.T for the shape (output_count, input_count) matrix M which is zero apart
+    from values at (rows, columns). Entries must be sorted by row, and not repeated"""
+    if len(values) > SPARSE_MATMUL_MAX_DENSITY * shape[0] * shape[1]:
+        dense = np.zeros(shape)
+        dense[rows, columns] = values
+        return batch @ dense.T
+
+    out = np.zeros((len(batch), shape[0]))
+    if len(values) == 0:
+        return out
+
+    starts = np.flatnonzero(np.concatenate(([True], rows[1:] != rows[:-1])))
+    chunk = max(1, HARDWARE_CHUNK_ELEMENTS // len(values))
+    for start in range(0, len(batch), chunk):
+        out[start : start + chunk, rows[starts]] = np.add.reduceat(
+            batch[start : start + chunk, columns] * values, starts, axis=1
+        )
+    return out
+
+
+class ArrayCache:
+    """Least recently used cache of arrays (or tuples of arrays), which drops old
+    entries to stay within max_bytes"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+    @staticmethod
+    def _nbytes(value) -> int:
+        if isinstance(value, tuple):
+            return sum(ArrayCache._nbytes(v) for v in value)
+        return value.nbytes if isinstance(value, np.ndarray) else 0
+
+    def peek(self, key):
+        "The cached value if there is one, else None, without counting as a use"
+        entry = self.entries.get(key)
+        return None if entry is None else entry[0]
+
+    def get(self, key, make):
+        "The cached value, or make() if it isn't cached (which is then cached if it fits)"
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+        value = make()
+        nbytes = self._nbytes(value)
+        if nbytes <= self.max_bytes:
+            self.entries[key] = (value, nbytes)
+            self.size += nbytes
+            while self.size > self.max_bytes:
+                _, (_, dropped) = self.entries.popitem(last=False)
+                self.size -= dropped
+        return value
+
+
 def sort_tuple(tup: tuple[float, float]) -> tuple[float, float]:
     "No generics in Python yet so this is a bit ugly"
     if tup[0] > tup[1]:
@@ -131,18 +700,102 @@ def sort_tuple(tup: tuple[float, float]) -> tuple[float, float]:
 
 
 class SequentialStepHDL:
+    def __getstate__(self):
+        # Derived arrays are cheap to rebuild and would only bloat saved models
+        state = dict(self.__dict__)
+        state.pop("_cached", None)
+        return state
+
+    def _cache(self) -> dict:
+        return self.__dict__.setdefault("_cached", {})
+
+    def _step_cache(self) -> ArrayCache:
+        "For arrays there may be one of per log-weight step, so which can't all be kept"
+        cache = self._cache()
+        if "steps" not in cache:
+            cache["steps"] = ArrayCache(STEP_CACHE_BYTES)
+        return cache["steps"]
+
+    def to_arrays(self) -> dict[str, np.ndarray]:
+        """Everything needed to rebuild this layer, as named numpy arrays, so that it can
+        be put in shared memory or a file without pickling Python objects"""
+        return {}
+
+    @classmethod
+    def from_arrays(cls, arrays: dict[str, np.ndarray]):
+        "Inverse of to_arrays(). The arrays may be read-only views, and are not copied"
+        return cls()
 
     def apply(
         self,
         previous_neuron_buses: list[hdlgen.Wire],
         target_module: hdlgen.Module,
         float_environment: fp.FloatEnvironment,
+        pipeline: Optional[hdlgen.Pipeline] = None,
+        reduction: Optional[ReductionPlanner] = None,
     ) -> list[hdlgen.Wire]:
+        """Generate the layer's hardware, returning its output wires. If a pipeline is
+        given, layers may register inside themselves (up to its reduction_stages), and
+        must keep all of their outputs at the same latency. Layers that add up terms do so
+        as the reduction planner says, or with a single fp_sum each if there isn't one"""
         raise NotImplementedError()
 
+    def folded_terms(self, float_environment: fp.FloatEnvironment) -> Optional[FoldedTerms]:
+        "The terms apply_folded() would work through, or None if this step doesn't fold"
+        return None
+
+    def apply_folded(
+        self,
+        previous_neuron_buses: list[hdlgen.Wire],
+        target_module: hdlgen.Module,
+        float_environment: fp.FloatEnvironment,
+        sequencer: hdlgen.Sequencer,
+        units: int,
+    ) -> list[hdlgen.Wire]:
+        """Generate the step for a folded network, where steps with terms to add up share
+        `units` lanes between their neurons over many clocks (see make_folded_step), and
+        everything else stays combinational"""
+        terms = self.folded_terms(float_environment)
+        if terms is None:
+            return self.apply(previous_neuron_buses, target_module, float_environment)
+
+        output_count, input_count = terms.shape
+        if len(previous_neuron_buses) != input_count:
+            raise ValueError(
+                f"Size mismatch: given {len(previous_neuron_buses)} wires for a {output_count}x{input_count} matrix."
+            )
+        return make_folded_step(
+            float_environment, target_module, previous_neuron_buses, terms, sequencer, units
+        )
+
     def eval(self, vector_in: list[float]):
         raise NotImplementedError()
 
+    def eval_batch(self, batch_in: np.ndarray) -> np.ndarray:
+        """Vectorised equivalent of eval(): takes an (N, input_count) array of input
+        vectors and returns the (N, output_count) array of outputs"""
+        raise NotImplementedError()
+
+    def eval_hardware(
+        self,
+        words_in: np.ndarray,
+        float_environment: fp.FloatEnvironment,
+        reduction: Optional[ReductionPlanner] = None,
+    ) -> np.ndarray:
+        """Bit-accurate model of the hardware apply() generates (with the same reduction
+        planner): takes an (N, input_count) array of raw float words and returns the
+        (N, output_count) output words. See ipsim"""
+        raise NotImplementedError()
+
+    def eval_hardware_folded(
+        self, words_in: np.ndarray, float_environment: fp.FloatEnvironment
+    ) -> np.ndarray:
+        "eval_hardware() for the hardware apply_folded() generates"
+        terms = self.folded_terms(float_environment)
+        if terms is None:
+            return self.eval_hardware(words_in, float_environment)
+        return eval_folded_terms(float_environment, words_in, terms)
+
     def eval_interval(
         self, intervals_vector_in: list[tuple[float, float]]
     ) -> list[tuple[float, float]]:
@@ -152,6 +805,20 @@ class SequentialStepHDL:
             "For a monotonic layer, inherit from Monotoni cStep for an implementation"
         )
 
+    def eval_interval_batch(
+        self, lower: np.ndarray, upper: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Vectorised equivalent of eval_interval(): takes (N, input_count) arrays of
+        lower and upper input bounds, and returns the (N, output_count) output bounds"""
+        raise NotImplementedError(
+            "For a monotonic layer, inherit from MonotonicStep for an implementation"
+        )
+
+    def eval_zonotope(self, zonotope: zonotope.Zonotope) -> zonotope.Zonotope:
+        """Like eval_interval_batch(), but for a batch of zonotopes (see zonotope.py),
+        which keep track of how neurons relate to each other"""
+        raise NotImplementedError()
+
 
 class MonotonicStep(SequentialStepHDL):
     def eval_interval(
@@ -165,20 +832,40 @@ class MonotonicStep(SequentialStepHDL):
 
         return [sort_tuple((x, y)) for x, y in zip(lower_bounds, upper_bounds)]
 
+    def eval_interval_batch(self, lower, upper):
+        from_lower = self.eval_batch(lower)
+        from_upper = self.eval_batch(upper)
+
+        return np.minimum(from_lower, from_upper), np.maximum(from_lower, from_upper)
+
 
 class ActivationStep(SequentialStepHDL):
     pass
 
 
 class ReLUStep(MonotonicStep, ActivationStep):
+    # Neurons known never to be negative (see prune.py), which skip the activation and are
+    # passed straight through. None for none of them
+    passthrough: Optional[np.ndarray] = None
+
+    def __init__(self, passthrough=None):
+        if passthrough is not None:
+            self.passthrough = np.asarray(passthrough, dtype=bool)
+
     def apply(
         self,
         previous_neuron_buses,
         target_module,
         float_environment: fp.FloatEnvironment,
+        pipeline=None,
+        reduction=None,
     ):
         out_layer = []
-        for neuron_in in previous_neuron_buses:
+        for index, neuron_in in enumerate(previous_neuron_buses):
+            if self.passthrough is not None and self.passthrough[index]:
+                out_layer.append(neuron_in)
+                continue
+
             neuron_out = target_module.AddWire(
                 float_environment.float_size, f"neuron_relu"
             )
@@ -189,11 +876,35 @@ class ReLUStep(MonotonicStep, ActivationStep):
                 "fp_activation_relu",
                 {"argumenta": neuron_in, "out": neuron_out},
             )
+            if pipeline is not None:
+                pipeline.inherit(neuron_out, [neuron_in])
 
         return out_layer
 
     def eval(self, vector_in):
-        return [x if x > 0 else 0 for x in vector_in]
+        passthrough = [False] * len(vector_in) if self.passthrough is None else self.passthrough
+        return [x if x > 0 or through else 0 for x, through in zip(vector_in, passthrough, strict=True)]
+
+    def to_arrays(self):
+        return {} if self.passthrough is None else {"passthrough": self.passthrough}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays.get("passthrough"))
+
+    def eval_batch(self, batch_in):
+        if self.passthrough is None:
+            return np.maximum(batch_in, 0.0)
+        return np.where(self.passthrough, batch_in, np.maximum(batch_in, 0.0))
+
+    def eval_zonotope(self, zonotope):
+        return zonotope.relu(self.passthrough)
+
+    def eval_hardware(self, words_in, float_environment, reduction=None):
+        words_out = ipsim.fp_activation_relu(float_environment, words_in)
+        if self.passthrough is None:
+            return words_out
+        return np.where(self.passthrough, words_in, words_out).astype(words_out.dtype, copy=False)
 
 
 class BiasStep(MonotonicStep, SequentialStepHDL):
@@ -205,6 +916,8 @@ class BiasStep(MonotonicStep, SequentialStepHDL):
         previous_neuron_buses: list[hdlgen.Wire],
         target_module: hdlgen.Module,
         float_environment: fp.FloatEnvironment,
+        pipeline=None,
+        reduction=None,
     ):
         out = []
 
@@ -219,6 +932,8 @@ class BiasStep(MonotonicStep, SequentialStepHDL):
                 "fp_adder",
                 {"argumenta": neuron, "argumentb": bias_as_literal, "out": out_neuron},
             )
+            if pipeline is not None:
+                pipeline.inherit(out_neuron, [neuron])
 
             out.append(out_neuron)
 
@@ -227,37 +942,338 @@ class BiasStep(MonotonicStep, SequentialStepHDL):
     def eval(self, vector_in):
         return [x + bias for (x, bias) in zip(vector_in, self.biases, strict=True)]
 
+    def to_arrays(self):
+        return {"biases": stored_float_array(self.biases)}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        layer = cls(arrays["biases"])
+        layer._cache()["biases"] = arrays["biases"]
+        return layer
+
+    def bias_array(self) -> np.ndarray:
+        cache = self._cache()
+        if "biases" not in cache:
+            cache["biases"] = as_float_array(self.biases)
+        return cache["biases"]
+
+    def eval_batch(self, batch_in):
+        return batch_in + self.bias_array()
+
+    def eval_zonotope(self, zonotope):
+        return zonotope.shift(self.bias_array())
+
+    def eval_hardware(self, words_in, float_environment, reduction=None):
+        bias_words = ipsim.float_to_bits(float_environment, self.bias_array())
+        return ipsim.fp_adder(float_environment, words_in, bias_words)
+
+
+class FragmentStore:
+    """CSR-style storage for the fragments of an output_count x input_count matrix of log
+    weights. The fragments of weight w (numbered row-major) are offsets[w]:offsets[w+1]
+    of the int8 exponents, and of the sign bits, which are packed eight to a byte."""
+
+    def __init__(self, shape: tuple[int, int], offsets, exponents, packed_signs):
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.offsets = offsets
+        self.exponents = exponents
+        self.packed_signs = packed_signs
+
+        if len(self.offsets) != self.shape[0] * self.shape[1] + 1:
+            raise ValueError(
+                f"Got {len(self.offsets)} offsets for a {self.shape[0]}x{self.shape[1]} matrix"
+            )
+
+    @classmethod
+    def from_flat(cls, counts: np.ndarray, exponents, negatives) -> "FragmentStore":
+        "From output_count x input_count fragment counts and row-major flattened fragments"
+        counts = np.asarray(counts, dtype=np.int64)
+        exponents = np.asarray(exponents, dtype=np.int64)
+        if exponents.size > 0 and (exponents.min() < -128 or exponents.max() > 127):
+            raise ValueError("Fragment exponents must fit in an int8")
+
+        offsets = np.concatenate(([0], np.cumsum(counts.ravel())))
+        offset_type = np.int32 if offsets[-1] < np.iinfo(np.int32).max else np.int64
+
+        return cls(
+            counts.shape,
+            offsets.astype(offset_type),
+            exponents.astype(np.int8),
+            np.packbits(np.asarray(negatives, dtype=bool), bitorder="little"),
+        )
+
+    @classmethod
+    def from_lists(cls, weight_fragments: list[list[list[WeightFragment]]]) -> "FragmentStore":
+        counts = np.array(
+            [[len(fragments) for fragments in row] for row in weight_fragments],
+            dtype=np.int64,
+        ).reshape(len(weight_fragments), -1)
+        flat = [
+            fragment for row in weight_fragments for fragments in row for fragment in fragments
+        ]
+        return cls.from_flat(
+            counts, [f[0] for f in flat], np.array([f[1] for f in flat], dtype=bool)
+        )
+
+    def __len__(self):
+        "Total number of fragments"
+        return int(self.offsets[-1])
+
+    def counts(self) -> np.ndarray:
+        return np.diff(self.offsets).astype(np.int64).reshape(self.shape)
+
+    def negatives(self, start: int = 0, stop: int | None = None) -> np.ndarray:
+        stop = len(self) if stop is None else stop
+        # Only unpack the bytes covering [start, stop)
+        bits = np.unpackbits(
+            self.packed_signs[start // 8 : -(-stop // 8)], bitorder="little"
+        )
+        return bits[start % 8 : start % 8 + stop - start].astype(bool)
+
+    def weight_index(self) -> np.ndarray:
+        "Row-major index of the weight each fragment belongs to"
+        return np.repeat(np.arange(self.shape[0] * self.shape[1]), np.diff(self.offsets))
+
+    def ranks(self) -> np.ndarray:
+        "Position of each fragment within its weight's list of fragments"
+        counts = np.diff(self.offsets)
+        return np.arange(len(self)) - np.repeat(self.offsets[:-1].astype(np.int64), counts)
+
+    def first(self, k: int | None = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(weight indices, exponents, negatives) of the first k fragments of every weight
+        (all of them if k is None), in storage order"""
+        weight_index = self.weight_index()
+        exponents = self.exponents.astype(np.int64)
+        negatives = self.negatives()
+
+        if k is not None:
+            used = self.ranks() < k
+            return weight_index[used], exponents[used], negatives[used]
+        return weight_index, exponents, negatives
+
+    def nth(self, n: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(weight indices, exponents, negatives) of the n-th (from 0) fragment of every
+        weight which has one"""
+        counts = np.diff(self.offsets)
+        weight_index = np.flatnonzero(counts > n)
+        positions = self.offsets[weight_index].astype(np.int64) + n
+        return (
+            weight_index,
+            self.exponents[positions].astype(np.int64),
+            self.negatives().take(positions),
+        )
+
+    def neuron(self, index: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        "(input indices, exponents, negatives) of every fragment feeding one output neuron"
+        row_offsets = self.offsets[index * self.shape[1] : (index + 1) * self.shape[1] + 1]
+        start, stop = int(row_offsets[0]), int(row_offsets[-1])
+        return (
+            np.repeat(np.arange(self.shape[1]), np.diff(row_offsets)),
+            self.exponents[start:stop].astype(np.int64),
+            self.negatives(start, stop),
+        )
+
+    def select(self, rows, columns) -> "FragmentStore":
+        "The fragments of a submatrix, given increasing row and column indices"
+        rows = np.asarray(rows, dtype=np.int64)
+        columns = np.asarray(columns, dtype=np.int64)
+        kept_weights = np.zeros(self.shape, dtype=bool)
+        kept_weights[np.ix_(rows, columns)] = True
+        kept = np.repeat(kept_weights.ravel(), np.diff(self.offsets))
+        return FragmentStore.from_flat(
+            self.counts()[np.ix_(rows, columns)], self.exponents[kept], self.negatives()[kept]
+        )
+
+    def distinct_shifts(self) -> int:
+        """Number of distinct (input, exponent, negative) fragments, i.e. shifted copies of
+        the inputs needed when they're shared between output neurons"""
+        input_index = self.weight_index() % self.shape[1]
+        keys = (input_index * 256 + (self.exponents.astype(np.int64) + 128)) * 2 + self.negatives()
+        return len(np.unique(keys))
+
+    def to_lists(self) -> list[list[list[WeightFragment]]]:
+        exponents = self.exponents.tolist()
+        negatives = self.negatives().tolist()
+        offsets = self.offsets.tolist()
+        fragments = [
+            [WeightFragment(e, n) for e, n in zip(exponents[a:b], negatives[a:b])]
+            for a, b in zip(offsets[:-1], offsets[1:])
+        ]
+        return [
+            fragments[i : i + self.shape[1]] for i in range(0, len(fragments), self.shape[1])
+        ]
+
 
 class DenseLogLayer(SequentialStepHDL):
-    def __init__(self, weight_fragments: list[list[list[WeightFragment]]]):
-        self.weight_fragments = weight_fragments
+    def __init__(
+        self, weight_fragments: list[list[list[WeightFragment]]] | FragmentStore
+    ):
+        if isinstance(weight_fragments, FragmentStore):
+            self.fragments = weight_fragments
+        else:
+            self.fragments = FragmentStore.from_lists(weight_fragments)
+
+    def __setstate__(self, state):
+        # Layers pickled before FragmentStore existed hold the nested lists directly
+        if "weight_fragments" in state:
+            state = dict(state)
+            state["fragments"] = FragmentStore.from_lists(state.pop("weight_fragments"))
+        self.__dict__.update(state)
+
+    @property
+    def weight_fragments(self) -> list[list[list[WeightFragment]]]:
+        """Compatibility view of the fragments as nested lists, indexed by output neuron,
+        then input neuron. Built on first use; prefer the FragmentStore queries"""
+        cache = self._cache()
+        if "weight_fragments" not in cache:
+            cache["weight_fragments"] = self.fragments.to_lists()
+        return cache["weight_fragments"]
+
+    def to_arrays(self):
+        return {
+            "shape": np.array(self.fragments.shape, dtype=np.int64),
+            "offsets": self.fragments.offsets,
+            "exponents": self.fragments.exponents,
+            "signs": self.fragments.packed_signs,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        if "counts" in arrays:
+            # As first written by mlgenfile, before the fragments were stored CSR-style
+            store = FragmentStore.from_flat(arrays["counts"], arrays["exponents"], arrays["negatives"])
+        else:
+            store = FragmentStore(
+                tuple(arrays["shape"]), arrays["offsets"], arrays["exponents"], arrays["signs"]
+            )
+        layer = cls.__new__(cls)
+        layer.fragments = store
+        return layer
+
+    def effective_weights(self, max_fragments: int | None = None) -> np.ndarray:
+        """The output_count x input_count weight matrix the fragments add up to, using
+        only the first max_fragments fragments of each weight if given"""
+        return self._step_cache().get(
+            ("effective_weights", max_fragments),
+            lambda: self._make_effective_weights(max_fragments),
+        )
+
+    def _make_effective_weights(self, max_fragments: int | None) -> np.ndarray:
+        weight_index, exponents, negatives = self.fragments.first(max_fragments)
+        values = np.where(negatives, -1.0, 1.0) * np.ldexp(1.0, exponents)
+
+        # bincount gives ints rather than floats if there are no fragments at all
+        return np.bincount(
+            weight_index, weights=values, minlength=self.fragments.shape[0] * self.fragments.shape[1]
+        ).astype(np.float64, copy=False).reshape(self.fragments.shape)
+
+    def eval_batch(self, batch_in):
+        return batch_in @ self.effective_weights().T
+
+    def eval_interval_batch(self, lower, upper):
+        return interval_matmul(lower, upper, self.effective_weights())
+
+    def eval_zonotope(self, zonotope):
+        return zonotope.affine(self.effective_weights())
+
+    def hardware_fragments(
+        self, max_fragments: int | None = None
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """(input indices, exponents, negatives, neuron offsets) of every
+        fp_multiplybypowerof2 feeding each neuron's fp_sum, in the order apply() makes them"""
+        def make():
+            weight_index, exponents, negatives = self.fragments.first(max_fragments)
+
+            neuron, input_index = np.divmod(weight_index, self.fragments.shape[1])
+            offsets = np.concatenate(
+                ([0], np.cumsum(np.bincount(neuron, minlength=self.fragments.shape[0])))
+            )
+            return input_index, exponents, negatives, offsets
+
+        return self._step_cache().get(("hardware_fragments", max_fragments), make)
+
+    def _eval_fragments_hardware(self, words_in, float_environment, max_fragments, reduction=None):
+        input_index, exponents, negatives, offsets = self.hardware_fragments(max_fragments)
+        chunk = max(1, HARDWARE_CHUNK_ELEMENTS // max(len(input_index), 1))
+
+        # Neurons with the same number of terms get the same plan, so are evaluated together
+        counts = np.diff(offsets)
+        groups = []
+        if reduction is not None and reduction.topology != "aio":
+            for count in np.unique(counts[counts > 0]).tolist():
+                neurons = np.flatnonzero(counts == count)
+                term_index = offsets[neurons][:, None] + np.arange(count)
+                groups.append((neurons, term_index, reduction.plan(count, float_environment)))
+
+        out = []
+        for start in range(0, len(words_in), chunk):
+            multiplied = ipsim.fp_multiplybypowerof2(
+                float_environment,
+                words_in[start : start + chunk, input_index],
+                exponents,
+                negatives,
+            )
+            if len(groups) == 0:
+                out.append(ipsim.fp_sum_segments(float_environment, multiplied, offsets))
+                continue
+
+            sums = np.zeros((len(multiplied), len(counts)), dtype=multiplied.dtype)
+            for neurons, term_index, plan in groups:
+                sums[:, neurons] = eval_reduction(float_environment, multiplied[:, term_index], plan)
+            out.append(sums)
+
+        if len(out) == 0:
+            return np.zeros((0, len(offsets) - 1), dtype=words_in.dtype)
+        return np.concatenate(out)
+
+    def eval_hardware(self, words_in, float_environment, reduction=None):
+        return self._eval_fragments_hardware(words_in, float_environment, None, reduction)
+
+    def folded_terms(self, float_environment):
+        input_index, exponents, negatives, offsets = self.hardware_fragments()
+        return FoldedTerms(
+            "fp_multiplybyvariablepowerof2",
+            self.fragments.shape,
+            input_index,
+            exponents,
+            negatives,
+            offsets,
+        )
 
     def apply(
         self,
         previous_neuron_buses: list[hdlgen.Wire],
         target_module: hdlgen.Module,
         float_environment: fp.FloatEnvironment,
+        pipeline: Optional[hdlgen.Pipeline] = None,
+        reduction: Optional[ReductionPlanner] = None,
     ):
-        if len(previous_neuron_buses) != len(self.weight_fragments[0]):
+        output_count, input_count = self.fragments.shape
+        if len(previous_neuron_buses) != input_count:
             raise ValueError(
-                f"Size mismatch: given {len(previous_neuron_buses)} wires for a {len(self.weight_fragments)}x{len(self.weight_fragments[0])} matrix."
+                f"Size mismatch: given {len(previous_neuron_buses)} wires for a {output_count}x{input_count} matrix."
             )
 
         post_mul_neurons = [
             target_module.AddWire(
                 float_environment.float_size, f"neuron_multiplied_{i}"
             )
-            for i in range(len(self.weight_fragments))
+            for i in range(output_count)
         ]
-        print("Made target array of size", len(post_mul_neurons))
-        for target_neuron, neuron_log_weights_signs in zip(
-            post_mul_neurons, self.weight_fragments, strict=True
-        ):
-            collected_multiplication_wires = []
-            for in_wire, this_connection_weights_signs in zip(
-                previous_neuron_buses, neuron_log_weights_signs, strict=True
-            ):
-                for exponent, negate in this_connection_weights_signs:
+
+        # With reduction stages to spare, register the shifted inputs before the fp_sums,
+        # which means making them all first
+        register_products = pipeline is not None and pipeline.reduction_stages > 0
+        neuron_shifts = []
+
+        # An input shifted by a given power (and maybe negated) is the same signal whichever
+        # neuron it's for, so each one is only made once and fanned out to every fp_sum
+        shifted_wires: dict[tuple[int, int, bool], hdlgen.Wire] = {}
+        for neuron_index, target_neuron in enumerate(post_mul_neurons):
+            shifts = list(zip(*(a.tolist() for a in self.fragments.neuron(neuron_index))))
+            for shift in shifts:
+                if shift not in shifted_wires:
+                    input_index, exponent, negate = shift
                     multiply_out = target_module.AddWire(
                         float_environment.float_size, "mult_out"
                     )
@@ -265,24 +1281,86 @@ class DenseLogLayer(SequentialStepHDL):
                     float_environment.add_ip(
                         target_module,
                         "fp_multiplybypowerof2",
-                        {"argumenta": in_wire, "out": multiply_out},
+                        {"argumenta": previous_neuron_buses[input_index], "out": multiply_out},
                         {"power": exponent, "negate": int(negate)},
                     )
-                    collected_multiplication_wires.append(multiply_out)
-            if len(collected_multiplication_wires) == 0:
-                warnings.warn("Neuron had no contributing neurons within precision!")
-                target_module.AddAssignment(target_neuron, hdlgen.AutoSizeLiteral(0))
+                    if pipeline is not None:
+                        pipeline.inherit(multiply_out, [previous_neuron_buses[input_index]])
+                    shifted_wires[shift] = multiply_out
+
+            if register_products:
+                neuron_shifts.append(shifts)
             else:
-                make_aio_adder(
-                    float_environment,
+                self._make_neuron_sum(
+                    [shifted_wires[shift] for shift in shifts],
+                    target_neuron,
                     target_module,
-                    collected_multiplication_wires,
+                    float_environment,
+                    pipeline,
+                    reduction,
+                )
+
+        if register_products:
+            registered = dict(
+                zip(shifted_wires, pipeline.stage(shifted_wires.values(), "mult_reg"))
+            )
+            for target_neuron, shifts in zip(post_mul_neurons, neuron_shifts):
+                self._make_neuron_sum(
+                    [registered[shift] for shift in shifts],
                     target_neuron,
-                    float_environment.float_size,
+                    target_module,
+                    float_environment,
+                    pipeline,
+                    reduction,
                 )
 
+        profiling.annotate(
+            shifts=len(shifted_wires),
+            fragments=len(self.fragments),
+            saved=len(self.fragments) - len(shifted_wires),
+        )
         return post_mul_neurons
 
+    @staticmethod
+    def _make_neuron_sum(
+        wires: list[hdlgen.Wire],
+        target_neuron: hdlgen.Wire,
+        target_module: hdlgen.Module,
+        float_environment: fp.FloatEnvironment,
+        pipeline: Optional[hdlgen.Pipeline],
+        reduction: Optional[ReductionPlanner],
+    ):
+        plan = None if reduction is None or len(wires) == 0 else reduction.plan(len(wires), float_environment)
+        if len(wires) == 0:
+            warnings.warn("Neuron had no contributing neurons within precision!")
+            target_module.AddAssignment(target_neuron, hdlgen.AutoSizeLiteral(0))
+            if pipeline is not None:
+                pipeline.mark_constant(target_neuron)
+        elif plan is not None and not is_single_sum(plan):
+            # Any reduction stages left after registering the products go inside the
+            # reduction itself
+            register_levels = 0 if pipeline is None else pipeline.reduction_stages - 1
+            make_reduction(
+                float_environment,
+                target_module,
+                wires,
+                plan,
+                target_neuron,
+                float_environment.float_size,
+                pipeline,
+                register_levels,
+            )
+        else:
+            make_aio_adder(
+                float_environment,
+                target_module,
+                wires,
+                target_neuron,
+                float_environment.float_size,
+            )
+            if pipeline is not None:
+                pipeline.inherit(target_neuron, wires)
+
     def eval(self, vector_in):
         return [
             sum(
@@ -299,22 +1377,33 @@ class DenseLogLayer(SequentialStepHDL):
 
 
 class IncrementalLogLayer(DenseLogLayer):
-    """Doesnt actually incrementally compute accumulated values, just computes outputs
-    in one go upon eval() for flexibility"""
+    """Evaluates using only the first use_num_weights fragments of each weight (see
+    set_steps()). eval() and eval_batch() compute outputs in one go for flexibility, while
+    sweep_batch() steps through every number of fragments, accumulating as it goes"""
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self.max_num_weights = max(
-            (max((len(y) for y in x), default=0) for x in self.weight_fragments),
-            default=0,
-        )
-        print(f"Getting max weight count of {self.max_num_weights}")
+        self.max_num_weights = self._max_fragment_count()
         self.use_num_weights = 1
 
+    def _max_fragment_count(self) -> int:
+        counts = self.fragments.counts()
+        return int(counts.max()) if counts.size > 0 else 0
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        layer = super().from_arrays(arrays)
+        layer.max_num_weights = layer._max_fragment_count()
+        layer.use_num_weights = 1
+        return layer
+
     def apply(self, *args, **kwargs):
         raise NotImplementedError()
 
+    def folded_terms(self, float_environment):
+        return None
+
     def set_steps(self, steps):
         self.use_num_weights = steps
         return self.use_num_weights == self.max_num_weights
@@ -350,27 +1439,146 @@ class IncrementalLogLayer(DenseLogLayer):
                     math.pow(2, weight_fragments[self.use_num_weights-1].exponent)
                 ) if (self.use_num_weights > 0) and (self.use_num_weights <= len(weight_fragments)) else 0.0
 
+                # The known part of the weight behaves like a DenseLayer weight, the unknown
+                # part can push either way by up to the largest magnitude of the input
+                largest_input = max(abs(interval_lower), abs(interval_higher))
+
                 max_sum += (
                     current_weight
-                    + (
-                        unused_fragments_contrib
-                        if interval_higher > 0
-                        else -unused_fragments_contrib
-                    )
-                ) * interval_higher
+                    * (interval_higher if current_weight > 0 else interval_lower)
+                    + unused_fragments_contrib * largest_input
+                )
                 min_sum += (
                     current_weight
-                    + (
-                        -unused_fragments_contrib
-                        if interval_lower > 0
-                        else unused_fragments_contrib
-                    )
-                ) * interval_lower
+                    * (interval_lower if current_weight > 0 else interval_higher)
+                    - unused_fragments_contrib * largest_input
+                )
 
             intervals.append((min_sum, max_sum))
 
         return intervals
 
+    def unused_fragments_bound(self, steps: int) -> np.ndarray:
+        """Per-weight magnitude bound on the fragments not used within `steps`, as in
+        eval_interval()"""
+        def make():
+            bound = np.zeros(self.fragments.shape[0] * self.fragments.shape[1])
+
+            if steps > 0:
+                weight_index, exponents, _ = self.fragments.nth(steps - 1)
+                bound[weight_index] = np.ldexp(1.0, exponents)
+
+            return bound.reshape(self.fragments.shape)
+
+        return self._step_cache().get(("unused_fragments_bound", steps), make)
+
+    def _make_effective_weights(self, max_fragments: int | None) -> np.ndarray:
+        previous = None
+        if max_fragments is not None and max_fragments > 0:
+            previous = self._step_cache().peek(("effective_weights", max_fragments - 1))
+        if previous is None:
+            return super()._make_effective_weights(max_fragments)
+
+        # Only the fragments new at this step need adding on
+        weight_index, changes, _ = self.step_deltas(max_fragments)[0]
+        weights = previous.copy()
+        weights.ravel()[weight_index] += changes
+        return weights
+
+    def step_deltas(self, steps: int) -> tuple[tuple[np.ndarray, ...], tuple[np.ndarray, ...]]:
+        """What changes going from steps-1 to steps fragments per weight, as sparse
+        (weight indices, changes, changes in magnitude) of the known weights and
+        (weight indices, changes) of unused_fragments_bound(), both sorted by weight"""
+
+        def make():
+            weight_index, exponents, negatives = self.fragments.nth(steps - 1)
+            changes = np.where(negatives, -1.0, 1.0) * np.ldexp(1.0, exponents)
+            before = self.effective_weights(steps - 1).ravel()[weight_index]
+
+            bound_changes = (
+                self.unused_fragments_bound(steps) - self.unused_fragments_bound(steps - 1)
+            ).ravel()
+            bound_index = np.flatnonzero(bound_changes)
+
+            return (
+                (weight_index, changes, np.abs(before + changes) - np.abs(before)),
+                (bound_index, bound_changes[bound_index]),
+            )
+
+        return self._step_cache().get(("step_deltas", steps), make)
+
+    def sweep_batch(
+        self, batch_in: Optional[np.ndarray], lower=None, upper=None, max_steps: int | None = None
+    ) -> Iterator[tuple[int, Optional[np.ndarray], Optional[tuple[np.ndarray, np.ndarray]]]]:
+        """Yield (steps, outputs, (lower, upper) output bounds) for every number of steps
+        from 1 to max_steps (max_num_weights by default), setting the layer to each as it
+        goes. Each step only adds its own fragments on to the previous step's sums, so the
+        whole sweep costs about as much as one evaluation with every fragment. Intervals
+        are only propagated if lower and upper are given, and are kept as centre +/-
+        radius, which (unlike the lower/upper split) is additive over fragments"""
+        max_steps = self.max_num_weights if max_steps is None else max_steps
+        shape = self.fragments.shape
+
+        outputs = None if batch_in is None else np.zeros((len(batch_in), shape[0]))
+        if lower is not None:
+            centre = (lower + upper) / 2
+            radius = (upper - lower) / 2
+            largest_input = np.maximum(np.abs(lower), np.abs(upper))
+            known_centre = np.zeros((len(lower), shape[0]))
+            known_radius = np.zeros((len(lower), shape[0]))
+            unknown = np.zeros((len(lower), shape[0]))
+
+        for steps in range(1, max(max_steps, 1) + 1):
+            (weight_index, changes, magnitude_changes), (bound_index, bound_changes) = (
+                self.step_deltas(steps)
+            )
+            rows, columns = np.divmod(weight_index, shape[1])
+
+            if outputs is not None:
+                outputs = outputs + sparse_matmul(batch_in, rows, columns, changes, shape)
+
+            bounds = None
+            if lower is not None:
+                known_centre = known_centre + sparse_matmul(centre, rows, columns, changes, shape)
+                known_radius = known_radius + sparse_matmul(
+                    radius, rows, columns, magnitude_changes, shape
+                )
+                unknown = unknown + sparse_matmul(
+                    largest_input, *np.divmod(bound_index, shape[1]), bound_changes, shape
+                )
+                bounds = (
+                    known_centre - known_radius - unknown,
+                    known_centre + known_radius + unknown,
+                )
+
+            self.set_steps(steps)
+            yield steps, outputs, bounds
+
+    def eval_interval_batch(self, lower, upper):
+        known_lower, known_upper = interval_matmul(
+            lower, upper, self.effective_weights(self.use_num_weights)
+        )
+        unknown = np.maximum(np.abs(lower), np.abs(upper)) @ self.unused_fragments_bound(
+            self.use_num_weights
+        ).T
+
+        return known_lower - unknown, known_upper + unknown
+
+    def eval_zonotope(self, zonotope):
+        "The unused fragments can push either way, as in eval_interval_batch()"
+        unknown = np.maximum(*np.abs(zonotope.bounds())) @ self.unused_fragments_bound(self.use_num_weights).T
+        return zonotope.affine(self.effective_weights(self.use_num_weights)).add_box(unknown)
+
+    def eval_batch(self, batch_in):
+        return batch_in @ self.effective_weights(self.use_num_weights).T
+
+    def eval_hardware(self, words_in, float_environment, reduction=None):
+        """There's no hardware for incremental layers, so this is what a DenseLogLayer of
+        the fragments used so far would compute"""
+        return self._eval_fragments_hardware(
+            words_in, float_environment, self.use_num_weights, reduction
+        )
+
     def eval(self, vector_in) -> list[float]:
         return [
             sum(
@@ -421,9 +1629,238 @@ class DenseLayer(MonotonicStep, SequentialStepHDL):
             for neuron_weights in self.weights
         ]
 
+    def to_arrays(self):
+        return {"weights": stored_float_array(self.weights)}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        layer = cls(arrays["weights"])
+        layer._cache()["weights"] = arrays["weights"]
+        return layer
+
+    def weight_array(self) -> np.ndarray:
+        cache = self._cache()
+        if "weights" not in cache:
+            cache["weights"] = as_float_array(self.weights)
+        return cache["weights"]
+
+    def eval_batch(self, batch_in):
+        return batch_in @ self.weight_array().T
+
+    def folded_terms(self, float_environment):
+        words = ipsim.float_to_bits(float_environment, self.weight_array())
+        # fp_variablemultiplier takes zero exponents as zero, so those weights are skipped
+        exponents = (words.astype(np.int64) >> float_environment.significand_size) & (
+            (1 << float_environment.exponent_size) - 1
+        )
+        neuron, input_index = np.nonzero(exponents)
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(neuron, minlength=words.shape[0]))))
+        return FoldedTerms(
+            "fp_variablemultiplier",
+            words.shape,
+            input_index,
+            words[neuron, input_index],
+            np.zeros(len(neuron), dtype=np.int64),
+            offsets,
+        )
+
+    def eval_interval_batch(self, lower, upper):
+        return interval_matmul(lower, upper, self.weight_array())
+
+    def eval_zonotope(self, zonotope):
+        return zonotope.affine(self.weight_array())
+
+
+# For rebuilding layers from arrays by name
+LAYER_TYPES: dict[str, type[SequentialStepHDL]] = {
+    layer_type.__name__: layer_type
+    for layer_type in [ReLUStep, BiasStep, DenseLogLayer, IncrementalLogLayer, DenseLayer]
+}
+
 
 @dataclass
 class Model:
     layers: list[SequentialStepHDL]
     input_count: int
     output_count: int
+
+    def eval_batch(self, batch_in) -> np.ndarray:
+        """Push an (N, input_count) array of inputs through every layer at once"""
+        batch = as_float_array(batch_in)
+        if batch.ndim != 2 or batch.shape[1] != self.input_count:
+            raise ValueError(
+                f"Expected an (N, {self.input_count}) input array, got shape {batch.shape}"
+            )
+
+        for index, layer in enumerate(self.layers):
+            with profiling.stage("simulate layer", "simulation", layer=index, type=type(layer).__name__, samples=len(batch)):
+                batch = layer.eval_batch(batch)
+
+        return batch
+
+    def eval_interval_batch(self, lower, upper) -> tuple[np.ndarray, np.ndarray]:
+        """Propagate a batch of input boxes, given as (N, input_count) arrays of lower
+        and upper bounds, through every layer at once"""
+        lower = as_float_array(lower)
+        upper = as_float_array(upper)
+        if lower.shape != upper.shape:
+            raise ValueError(
+                f"Lower and upper bounds have different shapes {lower.shape} and {upper.shape}"
+            )
+
+        for layer in self.layers:
+            lower, upper = layer.eval_interval_batch(lower, upper)
+
+        return lower, upper
+
+    def eval_zonotope_batch(
+        self, lower, upper, max_generators: int = zonotope.MAX_GENERATORS
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Like eval_interval_batch(), but through zonotopes with at most max_generators
+        generators (or one per neuron, if more), which are usually much tighter"""
+        lower = as_float_array(lower)
+        upper = as_float_array(upper)
+        if lower.shape != upper.shape:
+            raise ValueError(
+                f"Lower and upper bounds have different shapes {lower.shape} and {upper.shape}"
+            )
+
+        bounds = zonotope.Zonotope.from_box(lower, upper)
+        for layer in self.layers:
+            bounds = layer.eval_zonotope(bounds).reduce(max_generators)
+
+        return bounds.bounds()
+
+    def eval_hardware(
+        self,
+        batch_in,
+        float_environment: fp.FloatEnvironment,
+        folded: bool = False,
+        reduction: Optional[ReductionPlanner] = None,
+        layer_environments: Optional[list[Optional[fp.FloatEnvironment]]] = None,
+    ) -> np.ndarray:
+        """Like eval_batch(), but bit-accurately reproducing the generated hardware: inputs
+        are rounded to the float environment's format, every layer runs on raw words via
+        its eval_hardware() (or eval_hardware_folded(), for a folded network), and the
+        output words are converted back to floats. Give the reduction planner the
+        hardware was generated with, if any, and the layers' own formats if it was
+        generated with some (see eval_hardware_words())"""
+        words = ipsim.float_to_bits(float_environment, batch_in)
+        if words.ndim != 2 or words.shape[1] != self.input_count:
+            raise ValueError(
+                f"Expected an (N, {self.input_count}) input array, got shape {words.shape}"
+            )
+
+        words = self.eval_hardware_words(words, float_environment, folded, reduction, layer_environments)
+        return ipsim.bits_to_float(float_environment, words)
+
+    def eval_hardware_words(
+        self,
+        words: np.ndarray,
+        float_environment: fp.FloatEnvironment,
+        folded: bool = False,
+        reduction: Optional[ReductionPlanner] = None,
+        layer_environments: Optional[list[Optional[fp.FloatEnvironment]]] = None,
+    ) -> np.ndarray:
+        """The hardware's output words for input words, both in the float environment's
+        format. layer_environments gives each layer's own format (None for the float
+        environment's), for networks generated with mixed formats: words are run through
+        fp_convert wherever the format changes, as mlgen2hdl puts it there"""
+        if layer_environments is None:
+            layer_environments = [None] * len(self.layers)
+        if len(layer_environments) != len(self.layers):
+            raise ValueError(f"Expected a format for each of {len(self.layers)} layers, got {len(layer_environments)}")
+
+        environment = float_environment
+        for index, (layer, layer_environment) in enumerate(zip(self.layers, layer_environments)):
+            layer_environment = layer_environment or float_environment
+            if layer_environment != environment:
+                words = ipsim.fp_convert(environment, layer_environment, words)
+                environment = layer_environment
+
+            with profiling.stage("simulate layer", "simulation", layer=index, type=type(layer).__name__, samples=len(words)):
+                if folded:
+                    words = layer.eval_hardware_folded(words, environment)
+                else:
+                    words = layer.eval_hardware(words, environment, reduction)
+
+        if environment != float_environment:
+            words = ipsim.fp_convert(environment, float_environment, words)
+        return words
+
+    def folded_clocks(self, float_environment: fp.FloatEnvironment, units: int) -> int:
+        "Clocks per input the network takes when generated folded onto `units` lanes per step"
+        clocks = hdlgen.Sequencer.HANDSHAKE_CLOCKS
+        for layer in self.layers:
+            terms = layer.folded_terms(float_environment)
+            if terms is not None:
+                clocks += folded_step_clocks(terms, units)
+        return clocks
+
+    def incremental_steps(self) -> int:
+        """Steps to sweep the incremental log layers over: until the first of them has
+        used all of its fragments"""
+        counts = [
+            layer.max_num_weights
+            for layer in self.layers
+            if isinstance(layer, IncrementalLogLayer)
+        ]
+        return max(min(counts, default=1), 1)
+
+    def sweep_incremental_batch(
+        self,
+        batch_in,
+        lower=None,
+        upper=None,
+        float_environment: Optional[fp.FloatEnvironment] = None,
+        reduction: Optional[ReductionPlanner] = None,
+    ) -> Iterator[tuple[int, np.ndarray, Optional[tuple[np.ndarray, np.ndarray]]]]:
+        """Yield (steps, outputs, (lower, upper) output bounds) for every number of
+        incremental log-weight steps, in one pass: layers before the first
+        IncrementalLogLayer are only evaluated once, it accumulates step by step (see
+        IncrementalLogLayer.sweep_batch()) and only the layers after are rerun. With a
+        float environment, outputs are from eval_hardware() instead (with the reduction
+        planner, if any), which can't be accumulated as fp_sum rounds everything at once,
+        so is rerun in full each step"""
+        index = next(
+            (i for i, layer in enumerate(self.layers) if isinstance(layer, IncrementalLogLayer)),
+            None,
+        )
+        if index is None:
+            raise ValueError("Model has no incremental log layers to sweep")
+
+        batch = as_float_array(batch_in)
+        if batch.ndim != 2 or batch.shape[1] != self.input_count:
+            raise ValueError(
+                f"Expected an (N, {self.input_count}) input array, got shape {batch.shape}"
+            )
+
+        swept = None if float_environment is not None else batch
+        if lower is not None:
+            lower = as_float_array(lower)
+            upper = as_float_array(upper)
+
+        for layer in self.layers[:index]:
+            if swept is not None:
+                swept = layer.eval_batch(swept)
+            if lower is not None:
+                lower, upper = layer.eval_interval_batch(lower, upper)
+
+        for steps, outputs, bounds in self.layers[index].sweep_batch(
+            swept, lower, upper, self.incremental_steps()
+        ):
+            for layer in self.layers[index + 1 :]:
+                if isinstance(layer, IncrementalLogLayer):
+                    layer.set_steps(steps)
+
+            if float_environment is not None:
+                outputs = self.eval_hardware(batch, float_environment, reduction=reduction)
+            else:
+                for layer in self.layers[index + 1 :]:
+                    outputs = layer.eval_batch(outputs)
+
+            if bounds is not None:
+                for layer in self.layers[index + 1 :]:
+                    bounds = layer.eval_interval_batch(*bounds)
+
+            yield steps, outputs, bounds
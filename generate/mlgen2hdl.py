@@ -1,8 +1,12 @@
-import pickle
 import mlgen
+import mlgenfile
 import fp as fp
 import hdlgen
+import hdlestimate
+import hdlcache
+import profiling
 import argparse, os
+import filecmp
 import pathlib
 
 from dataclasses import dataclass
@@ -10,65 +14,233 @@ from dataclasses import dataclass
 parser = argparse.ArgumentParser(description='Process some images')
 parser.add_argument("model", help="the input .mlgen array")
 parser.add_argument("destination", help="the destination .sv file")
-
-# import after for better responsiveness
-import numpy as np
-import torch
-
-float_environment = fp.FloatEnvironment("binary16")
-
-args = parser.parse_args()
-
-f = open(args.model, "rb")
-mlgen_model: mlgen.Model = pickle.load(f)
-f.close()
-
-destination_filename = os.path.basename(args.destination)
-
-if not destination_filename.endswith(".sv"):
-    raise ValueError("Destination must be a .sv file, to determine module name")
-
-module = hdlgen.Module(destination_filename.split(".sv")[0])
-
-is_first = True
-
-prev_layer = []
-
-input_layer = []
-output_layer = []
-
-for layer_index, layer in enumerate(mlgen_model.layers):
-    if is_first:
-        input_layer = [module.AddWire(float_environment.float_size, f"network_in_{wire}") for wire in range(mlgen_model.input_count)]
-        prev_layer = input_layer
-
-        is_first = False
-
-    is_last = layer_index == len(mlgen_model.layers) - 1
-
-    print("Passing in size of", len(prev_layer))
-    prev_layer = layer.apply(prev_layer, module, float_environment)
-    print("Got layer of size", len(prev_layer), "on iteration #", layer_index)
-
-    if is_last:
-        output_layer = prev_layer
-        
-# set up packed arrays for input and output
-input_array = module.AddInput("input_array", 16, len(input_layer))
-for index, input_neuron in enumerate(input_layer):
-    module.AddAssignment(input_neuron, hdlgen.Indexing(input_array, index))
-    
-output_array = module.AddOutput("output_array", 16, len(output_layer))
-module.AddAssignment(output_array, hdlgen.Concatenation(output_layer))
-
-#__import__("code").interact(local=locals())
-
-pathlib.Path(args.destination).parent.mkdir(parents=True, exist_ok=True)
-
-with open(args.destination, "w") as sv_output:
-    sv_output.write(module.hdl())
-
-try:
-    module.checks()
-except Exception as e:
-    raise ValueError(f"Invalid configuration, still writing to {args.destination} so you can see what's going on.")
\ No newline at end of file
+parser.add_argument("--pipeline", "-p", action="store_true", help="generate a clocked design (clk, rst, in_valid/in_ready, out_valid/out_ready) with register stages, taking one input per clock")
+parser.add_argument("--register-after", choices=["step", "activation", "output"], default="activation", help="with --pipeline, where to put register stages: after every layer step, after every activation, or only on the outputs (which are always registered)")
+parser.add_argument("--fold", type=int, metavar="UNITS", help="generate a folded design (clk, rst, in_valid/in_ready, out_valid/out_ready) that takes one input at a time, giving each dense layer UNITS multiplier or shift lanes that step through its weights from ROMs over many clocks")
+parser.add_argument("--adder", choices=mlgen.REDUCTION_TOPOLOGIES, default="aio", help="how to add up each neuron's terms: one fp_sum of all of them, a tree or chain of fp_adders, levels of smaller fp_sums, or whichever of those is estimated best")
+parser.add_argument("--max-fan-in", type=int, help="the most inputs any fp_sum may have")
+parser.add_argument("--max-adder-depth", type=int, help="the most adder instances from any term to its neuron's sum")
+parser.add_argument("--adder-objective", choices=["delay", "area"], default="delay", help="what --adder picks topologies to minimise, by estimated LUT levels or LUTs")
+parser.add_argument("--estimate", nargs="?", const="-", metavar="FILE", help="write a JSON report of estimated resources and the longest path (see hdlestimate) to FILE, or print it")
+parser.add_argument("--estimate-only", action="store_true", help="stop after the estimate, without writing the .sv")
+parser.add_argument("--layer-cache", metavar="DIR", help="keep each layer's generated HDL in DIR (e.g. .mlgen2hdl_cache), to reuse for layers that haven't changed (not used with --estimate)")
+parser.add_argument("--formats", metavar="FILE", help="generate each layer in its own float format, from a JSON file written by floatformats.py, with fp_convert between layers of different formats (the ports stay binary16)")
+parser.add_argument("--reduction-stages", type=int, default=0, help="with --pipeline, register stages allowed inside each layer's reductions (currently 1 registers the shifted inputs ahead of every fp_sum)")
+
+
+def build_module(
+    mlgen_model: mlgen.Model,
+    args,
+    float_environment: fp.FloatEnvironment,
+    module_name: str,
+    layer_cache: hdlcache.LayerCache | None = None,
+    verbose: bool = True,
+) -> hdlgen.Module:
+    """Generate the network as configured by parsed command line arguments, without
+    writing it. Layers come from the layer cache where they can, if one is given.
+    Without verbose, nothing is printed about what was generated"""
+    log = print if verbose else lambda *args: None
+    module = hdlgen.Module(module_name)
+
+    if args.pipeline and args.fold is not None:
+        raise ValueError("--pipeline and --fold can't be used together")
+
+    pipeline = None
+    sequencer = None
+    reduction = mlgen.ReductionPlanner(args.adder, args.max_fan_in, args.max_adder_depth, args.adder_objective)
+    if args.fold is not None:
+        if args.fold < 1:
+            raise ValueError("--fold needs at least one unit per layer")
+
+        # Powers of two up to a lane per neuron of the widest layer
+        all_terms = [layer.folded_terms(float_environment) for layer in mlgen_model.layers]
+        widest = max((terms.shape[0] for terms in all_terms if terms is not None), default=1)
+        fold_options = {1 << i for i in range(widest.bit_length())} | {widest, args.fold}
+
+        log("Clocks per input by units per layer:")
+        for units in sorted(fold_options):
+            log(f"    {units:6d}: {mlgen_model.folded_clocks(float_environment, units)}{' (generating)' if units == args.fold else ''}")
+
+        clock = module.AddInput("clk")
+        reset = module.AddInput("rst")
+        in_valid = module.AddInput("in_valid")
+        out_ready = module.AddInput("out_ready")
+        in_ready = module.AddOutput("in_ready")
+        out_valid = module.AddOutput("out_valid")
+        sequencer = hdlgen.Sequencer(module, clock, reset)
+    elif args.pipeline:
+        clock = module.AddInput("clk")
+        reset = module.AddInput("rst")
+        in_valid = module.AddInput("in_valid")
+        out_ready = module.AddInput("out_ready")
+        in_ready = module.AddOutput("in_ready")
+        out_valid = module.AddOutput("out_valid")
+        pipeline = hdlgen.Pipeline(module, clock, module.AddWire(1, "advance"), args.reduction_stages)
+
+    layer_environments = [None] * len(mlgen_model.layers)
+    if args.formats is not None:
+        layer_environments = mlgenfile.load_formats(args.formats, mlgen_model, float_environment)
+    # The format the wires between layers are in
+    environment = float_environment
+
+    is_first = True
+
+    prev_layer = []
+
+    input_layer = []
+    output_layer = []
+
+    for layer_index, layer in enumerate(mlgen_model.layers):
+        if is_first:
+            # Folded designs hold on to their input while they work on it
+            add_input = module.AddWire if sequencer is None else module.AddRegister
+            input_layer = [add_input(float_environment.float_size, f"network_in_{wire}") for wire in range(mlgen_model.input_count)]
+            prev_layer = input_layer
+
+            is_first = False
+
+        is_last = layer_index == len(mlgen_model.layers) - 1
+
+        layer_environment = layer_environments[layer_index] or float_environment
+        if layer_environment != environment:
+            log(f"Converting from {environment.name} to {layer_environment.name}")
+            with profiling.stage("convert", "apply", module, layer=layer_index, to=layer_environment.name):
+                prev_layer = mlgen.convert_wires(environment, layer_environment, module, prev_layer, pipeline)
+            environment = layer_environment
+
+        if sequencer is not None:
+            generate = lambda: layer.apply_folded(prev_layer, module, environment, sequencer, args.fold)
+        else:
+            generate = lambda: layer.apply(prev_layer, module, environment, pipeline, reduction)
+        with profiling.stage("apply", "apply", module, layer=layer_index, type=type(layer).__name__, inputs=len(prev_layer)) as span:
+            if layer_cache is None:
+                prev_layer = generate()
+            else:
+                hits = layer_cache.hits
+                prev_layer = layer_cache.apply(layer, prev_layer, module, generate, pipeline, sequencer, reduction, environment)
+                span["cached"] = layer_cache.hits > hits
+            span["outputs"] = len(prev_layer)
+
+        if sequencer is None and isinstance(layer, mlgen.DenseLogLayer):
+            fragments = len(layer.fragments)
+            shifts = layer.fragments.distinct_shifts()
+            log(f"Layer #{layer_index}: {shifts} fp_multiplybypowerof2 instances for {fragments} fragments ({fragments - shifts} saved by sharing shifted inputs)")
+
+        if pipeline is not None and not is_last and (
+            args.register_after == "step"
+            or (args.register_after == "activation" and isinstance(layer, mlgen.ActivationStep))
+        ):
+            prev_layer = pipeline.stage(prev_layer, f"layer_{layer_index}_reg")
+
+        if is_last:
+            output_layer = prev_layer
+            if environment != float_environment:
+                output_layer = mlgen.convert_wires(environment, float_environment, module, output_layer, pipeline)
+
+    if args.adder != "aio":
+        log("Reductions by term count:")
+        for term_count, plan in sorted(reduction.plans.items()):
+            luts, delay, depth, fan_in = mlgen.reduction_cost(plan, float_environment)
+            log(f"    {term_count:6d}: {mlgen.describe_reduction(plan)}, ~{luts:.0f} LUTs, ~{delay:.0f} LUT levels")
+
+    if pipeline is not None:
+        output_layer = pipeline.stage(output_layer, "output_reg")
+        latency = pipeline.depth(output_layer)
+        pipeline.handshake(reset, in_valid, in_ready, out_valid, out_ready, latency)
+        log(f"Pipelined with a latency of {latency} clocks, using {pipeline.register_bits} register bits")
+
+    # set up packed arrays for input and output
+    input_array = module.AddInput("input_array", 16, len(input_layer))
+    if sequencer is not None:
+        accept = sequencer.handshake(in_valid, in_ready, out_valid, out_ready)
+        latch = module.AddAlwaysFF(clock, accept)
+        for index, input_neuron in enumerate(input_layer):
+            latch.AddAssignment(input_neuron, hdlgen.Indexing(input_array, index))
+        log(f"Folded onto {args.fold} units per layer, taking {sequencer.clocks_per_input()} clocks per input")
+    else:
+        for index, input_neuron in enumerate(input_layer):
+            module.AddAssignment(input_neuron, hdlgen.Indexing(input_array, index))
+
+    output_array = module.AddOutput("output_array", 16, len(output_layer))
+    module.AddAssignment(output_array, hdlgen.Concatenation(output_layer))
+
+    return module
+
+
+if __name__ == "__main__":
+    # import after for better responsiveness
+    import numpy as np
+    import torch
+
+    float_environment = fp.FloatEnvironment("binary16")
+
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.from_arguments(args)
+
+    mlgen_model: mlgen.Model = mlgenfile.load_model(args.model)
+
+    destination_filename = os.path.basename(args.destination)
+
+    if not destination_filename.endswith(".sv"):
+        raise ValueError("Destination must be a .sv file, to determine module name")
+
+    layer_cache = None
+    if args.layer_cache is not None and args.estimate is None and not args.estimate_only:
+        # Everything layers see besides their inputs and where in the module they go
+        settings = {
+            "pipeline": args.pipeline,
+            "reduction_stages": args.reduction_stages,
+            "fold": args.fold,
+            "adder": args.adder,
+            "max_fan_in": args.max_fan_in,
+            "max_adder_depth": args.max_adder_depth,
+            "adder_objective": args.adder_objective,
+        }
+        layer_cache = hdlcache.LayerCache(args.layer_cache, float_environment, settings)
+
+    with profiling.stage("build module", "apply"):
+        module = build_module(mlgen_model, args, float_environment, destination_filename.split(".sv")[0], layer_cache)
+
+    if layer_cache is not None:
+        with profiling.stage("save layer cache", "file"):
+            layer_cache.save(module)
+        print(f"Reused {layer_cache.hits} of {layer_cache.hits + layer_cache.misses} layers from {args.layer_cache}")
+
+    #__import__("code").interact(local=locals())
+
+    if args.estimate is not None or args.estimate_only:
+        with profiling.stage("estimate", "apply"):
+            report = hdlestimate.estimate_module(module, float_environment)
+        print("Estimated resources:")
+        print(hdlestimate.summary(report))
+        if args.estimate is not None:
+            hdlestimate.write_report(report, args.estimate)
+        if args.estimate_only:
+            profiling.finish(args)
+            raise SystemExit()
+
+    pathlib.Path(args.destination).parent.mkdir(parents=True, exist_ok=True)
+
+    # Big designs run to hundreds of MB, so stream them out rather than building one
+    # string. The .sv is only replaced if it changed, so make doesn't rebuild for nothing
+    temporary = f"{args.destination}.{os.getpid()}.tmp"
+    with open(temporary, "w", buffering=1 << 20) as sv_output:
+        with profiling.stage("hdl", "hdl") as span:
+            module.write_hdl(sv_output)
+            span["bytes"] = sv_output.tell()
+
+    with profiling.stage("write file", "file", path=args.destination) as span:
+        if os.path.exists(args.destination) and filecmp.cmp(temporary, args.destination, shallow=False):
+            os.remove(temporary)
+            print(f"{args.destination} is unchanged")
+            span["unchanged"] = True
+        else:
+            os.replace(temporary, args.destination)
+
+    profiling.finish(args)
+
+    try:
+        module.checks()
+    except Exception as e:
+        raise ValueError(f"Invalid configuration, still writing to {args.destination} so you can see what's going on.")
@@ -0,0 +1,141 @@
+"""Array-backed .mlgen container format.
+
+Layout: an 8-byte magic, a little-endian uint32 format version and uint32 header
+length, then a JSON header describing each layer's type and arrays (dtype, shape and
+byte offset), then the raw array data. The data starts at the first ARRAY_ALIGNMENT-
+aligned offset after the header, and array offsets are relative to it (and aligned).
+
+Loading memory-maps the file and builds every layer straight on top of the mapping
+with from_arrays(), so nothing is read from disk until a layer is actually used.
+Older pickled .mlgen files are still loaded (with pickle) if the magic isn't found."""
+
+import argparse
+import json
+import mmap
+import pickle
+import struct
+
+import numpy as np
+
+import fp as fp
+import mlgen
+import profiling
+
+MAGIC = b"MLGENARR"
+FORMAT_VERSION = 1
+ARRAY_ALIGNMENT = 64
+
+_PREAMBLE = struct.Struct("<8sII")
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+
+
+def _data_start(header_length: int) -> int:
+    return _aligned(_PREAMBLE.size + header_length)
+
+
+def save_model(model: mlgen.Model, path):
+    with profiling.stage("save model", "file", path=str(path)) as span:
+        layers = []
+        placed = []
+
+        data_size = 0
+        for layer in model.layers:
+            arrays = {}
+            for name, array in layer.to_arrays().items():
+                array = np.ascontiguousarray(array)
+                data_size = _aligned(data_size)
+                arrays[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": data_size}
+                placed.append((data_size, array))
+                data_size += array.nbytes
+            layers.append({"type": type(layer).__name__, "arrays": arrays})
+
+        header = json.dumps(
+            {"input_count": model.input_count, "output_count": model.output_count, "layers": layers}
+        ).encode("utf-8")
+        data_start = _data_start(len(header))
+
+        with open(path, "wb") as f:
+            f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+            f.write(header)
+            for offset, array in placed:
+                f.seek(data_start + offset)
+                f.write(array.tobytes())
+            # Make sure the file covers the final (possibly empty) array
+            f.truncate(data_start + data_size)
+        span["bytes"] = data_start + data_size
+
+
+def is_array_file(path) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def load_model(path) -> mlgen.Model:
+    with profiling.stage("load model", "file", path=str(path)):
+        if not is_array_file(path):
+            with open(path, "rb") as f:
+                return pickle.load(f)
+
+        with open(path, "rb") as f:
+            _, version, header_length = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+            if version > FORMAT_VERSION:
+                raise ValueError(
+                    f"{path} is .mlgen format version {version}, but only up to {FORMAT_VERSION} is understood"
+                )
+            header = json.loads(f.read(header_length).decode("utf-8"))
+            data_start = _data_start(header_length)
+            # The mapping stays open for as long as any array viewing it is alive
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        layers = []
+        for layer in header["layers"]:
+            if layer["type"] not in mlgen.LAYER_TYPES:
+                raise ValueError(f"Don't know how to load a `{layer['type']}` layer")
+
+            arrays = {
+                name: np.ndarray(
+                    tuple(description["shape"]),
+                    np.dtype(description["dtype"]),
+                    buffer=mapping,
+                    offset=data_start + description["offset"],
+                )
+                for name, description in layer["arrays"].items()
+            }
+            layers.append(mlgen.LAYER_TYPES[layer["type"]].from_arrays(arrays))
+
+        return mlgen.Model(layers, header["input_count"], header["output_count"])
+
+
+def save_formats(layer_environments: list, float_environment: fp.FloatEnvironment, path, **extra):
+    """Write each layer's float format (None for the float environment's) for mlgen2hdl
+    --formats, along with anything in `extra` (e.g. how they were picked)"""
+    with open(path, "w") as f:
+        json.dump({
+            "float_environment": float_environment.name,
+            "layers": [None if environment is None else environment.name for environment in layer_environments],
+            **extra,
+        }, f, indent=2)
+
+
+def load_formats(path, model: mlgen.Model, float_environment: fp.FloatEnvironment) -> list:
+    "Each layer's float environment, or None where it's just float_environment"
+    with open(path) as f:
+        formats = json.load(f)
+    if fp.FloatEnvironment(formats["float_environment"]) != float_environment:
+        raise ValueError(f"{path} has formats for a {formats['float_environment']} network, not {float_environment.name}")
+    if len(formats["layers"]) != len(model.layers):
+        raise ValueError(f"{path} has formats for {len(formats['layers'])} layers, but the model has {len(model.layers)}")
+    return [None if name is None else fp.FloatEnvironment(name) for name in formats["layers"]]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a .mlgen model (e.g. an old pickled one) to the array format")
+    parser.add_argument("model", help="the input .mlgen file")
+    parser.add_argument("destination", help="the destination .mlgen file")
+
+    args = parser.parse_args()
+
+    save_model(load_model(args.model), args.destination)
@@ -0,0 +1,449 @@
+"""Streaming statistics of the values each neuron takes over a dataset.
+
+Intervals give hard bounds, but say nothing about what values turn up in practice. This
+runs a dataset through the model and records, for every layer's outputs (and the model's
+inputs), each neuron's running mean and variance, minimum and maximum, how often it was
+exactly zero or negative, and a histogram of its values. The histogram is log-linear,
+with 2**subbins_log2 bins per binade from 2**min_exponent up to 2**max_exponent (binary16's
+range by default), one set for each sign, plus underflow and overflow bins. Quantiles read
+from it are within half a bin of the truth, which is a few percent.
+
+Everything is fixed size and adds up exactly, so chunks can be recorded in separate worker
+processes and merged. The statistics are saved next to the model (model.stats.npz for
+model.mlgen), and later runs can be merged into them with --append. They show which
+neurons are dead on real traffic, and how many binades each layer really uses."""
+
+import argparse
+import collections
+import multiprocessing
+import os
+import shlex
+import time
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+
+import dataset
+import fp as fp
+import ipsim
+import mlgen
+import mlgen2hdl
+import mlgenfile
+import parallel
+import prune
+
+MIN_EXPONENT = -24
+MAX_EXPONENT = 16
+SUBBINS_LOG2 = 3
+
+
+@dataclass
+class NeuronStats:
+    neuron_count: int
+    min_exponent: int = MIN_EXPONENT
+    max_exponent: int = MAX_EXPONENT
+    subbins_log2: int = SUBBINS_LOG2
+    # Samples seen, and per neuron, how many of them were finite (which the moments are of)
+    count: int = 0
+    finite: np.ndarray = field(init=False)
+    mean: np.ndarray = field(init=False)
+    m2: np.ndarray = field(init=False)
+    minimum: np.ndarray = field(init=False)
+    maximum: np.ndarray = field(init=False)
+    zeros: np.ndarray = field(init=False)
+    negatives: np.ndarray = field(init=False)
+    # (neuron_count, 2, magnitude_bins) counts of negative and positive values
+    histogram: np.ndarray = field(init=False)
+
+    def __post_init__(self):
+        n = self.neuron_count
+        self.finite = np.zeros(n, dtype=np.int64)
+        self.mean = np.zeros(n)
+        self.m2 = np.zeros(n)
+        self.minimum = np.full(n, np.inf)
+        self.maximum = np.full(n, -np.inf)
+        self.zeros = np.zeros(n, dtype=np.int64)
+        self.negatives = np.zeros(n, dtype=np.int64)
+        self.histogram = np.zeros((n, 2, self.magnitude_bins), dtype=np.int64)
+
+    @property
+    def magnitude_bins(self) -> int:
+        "Underflow, the log-linear bins, and overflow (including infinity)"
+        return (self.max_exponent - self.min_exponent << self.subbins_log2) + 2
+
+    def _bins(self, magnitudes: np.ndarray) -> np.ndarray:
+        "Bin of each nonzero magnitude"
+        significand, exponent = np.frexp(magnitudes)
+        # significand is in [0.5, 1), so 2 * significand - 1 is the fraction past the binade
+        subbin = ((2 * significand - 1) * (1 << self.subbins_log2)).astype(np.int64)
+        bins = ((exponent.astype(np.int64) - 1 - self.min_exponent) << self.subbins_log2) + subbin + 1
+        bins = np.where(magnitudes < np.ldexp(1.0, self.min_exponent), 0, bins)
+        return np.where(magnitudes >= np.ldexp(1.0, self.max_exponent), self.magnitude_bins - 1, bins)
+
+    def bin_values(self) -> np.ndarray:
+        "A representative magnitude for each bin: the middle of the log-linear ones"
+        subbins = 1 << self.subbins_log2
+        index = np.arange(self.magnitude_bins - 2)
+        values = np.ldexp(1 + (index % subbins + 0.5) / subbins, index // subbins + self.min_exponent)
+        return np.concatenate(([np.ldexp(0.5, self.min_exponent)], values, [np.ldexp(1.0, self.max_exponent)]))
+
+    def update(self, values: np.ndarray):
+        "Record an (N, neuron_count) batch of values"
+        values = np.asarray(values, dtype=np.float64)
+        if values.ndim != 2 or values.shape[1] != self.neuron_count:
+            raise ValueError(f"Expected an (N, {self.neuron_count}) array, got shape {values.shape}")
+        if len(values) == 0:
+            return
+
+        finite = np.isfinite(values)
+        batch = NeuronStats(self.neuron_count, self.min_exponent, self.max_exponent, self.subbins_log2)
+        batch.count = len(values)
+        batch.finite = finite.sum(axis=0)
+        finite_values = np.where(finite, values, 0.0)
+        batch.mean = finite_values.sum(axis=0) / np.maximum(batch.finite, 1)
+        batch.m2 = (np.where(finite, values - batch.mean, 0.0) ** 2).sum(axis=0)
+        batch.minimum = np.where(finite, values, np.inf).min(axis=0)
+        batch.maximum = np.where(finite, values, -np.inf).max(axis=0)
+        # Infinities count towards the extremes, NaNs towards nothing but the count
+        batch.minimum = np.minimum(batch.minimum, np.where(values == -np.inf, -np.inf, np.inf).min(axis=0))
+        batch.maximum = np.maximum(batch.maximum, np.where(values == np.inf, np.inf, -np.inf).max(axis=0))
+        batch.zeros = (values == 0).sum(axis=0)
+        batch.negatives = (values < 0).sum(axis=0)
+
+        nonzero = (values != 0) & ~np.isnan(values)
+        neuron = np.broadcast_to(np.arange(self.neuron_count), values.shape)[nonzero]
+        sign = (values[nonzero] > 0).astype(np.int64)
+        bins = self._bins(np.abs(values[nonzero]))
+        batch.histogram = np.bincount(
+            (neuron * 2 + sign) * self.magnitude_bins + bins, minlength=self.histogram.size
+        ).reshape(self.histogram.shape)
+
+        self.merge(batch)
+
+    def merge(self, other: "NeuronStats"):
+        if (other.neuron_count, other.min_exponent, other.max_exponent, other.subbins_log2) != (
+            self.neuron_count, self.min_exponent, self.max_exponent, self.subbins_log2
+        ):
+            raise ValueError("Can only merge statistics of the same neurons, with the same histogram bins")
+
+        # Chan et al.'s pairwise combination of means and sums of squared deviations
+        total = self.finite + other.finite
+        delta = other.mean - self.mean
+        share = np.divide(other.finite, total, out=np.zeros(self.neuron_count), where=total > 0)
+        self.m2 = self.m2 + other.m2 + delta**2 * self.finite * share
+        self.mean = self.mean + delta * share
+        self.finite = total
+
+        self.count += other.count
+        self.minimum = np.minimum(self.minimum, other.minimum)
+        self.maximum = np.maximum(self.maximum, other.maximum)
+        self.zeros += other.zeros
+        self.negatives += other.negatives
+        self.histogram += other.histogram
+
+    @property
+    def variance(self) -> np.ndarray:
+        return np.divide(self.m2, self.finite, out=np.full(self.neuron_count, np.nan), where=self.finite > 0)
+
+    def signed_histogram(self) -> tuple[np.ndarray, np.ndarray]:
+        """(neuron_count, bins) counts in ascending order of value, from the most negative
+        bin through zero to the most positive, and a representative value for each bin"""
+        values = self.bin_values()
+        counts = np.concatenate(
+            [self.histogram[:, 0, ::-1], self.zeros[:, None], self.histogram[:, 1]], axis=1
+        )
+        return counts, np.concatenate([-values[::-1], [0.0], values])
+
+    def quantiles(self, q) -> np.ndarray:
+        "(len(q), neuron_count) estimated quantiles of each neuron's values, ignoring NaNs"
+        counts, values = self.signed_histogram()
+        cumulative = np.cumsum(counts, axis=1)
+        total = cumulative[:, -1]
+        q = np.atleast_1d(np.asarray(q, dtype=np.float64))
+        rank = q[:, None] * np.maximum(total - 1, 0)
+        index = (cumulative[None, :, :] > rank[:, :, None]).argmax(axis=2)
+        estimate = np.clip(values[index], self.minimum, self.maximum)
+        return np.where(total > 0, estimate, np.nan)
+
+    def dead(self) -> np.ndarray:
+        "Neurons that were zero every time"
+        return (self.zeros == self.count) & (self.count > 0)
+
+    def never_negative(self) -> np.ndarray:
+        return (self.negatives == 0) & (self.count > 0)
+
+    def binade_range(self) -> Optional[tuple[int, int]]:
+        """Lowest and highest binades any nonzero magnitude of the layer fell in, or None
+        if all were zero. Underflow and overflow come out as the ends of the range"""
+        used = np.flatnonzero(self.histogram.sum(axis=(0, 1)))
+        if len(used) == 0:
+            return None
+        binade = lambda bin: self.min_exponent + ((int(bin) - 1) >> self.subbins_log2) if bin > 0 else self.min_exponent - 1
+        return binade(used[0]), binade(used[-1])
+
+    def to_arrays(self) -> dict[str, np.ndarray]:
+        return {
+            "settings": np.array([self.neuron_count, self.min_exponent, self.max_exponent, self.subbins_log2, self.count], dtype=np.int64),
+            **{name: getattr(self, name) for name in ["finite", "mean", "m2", "minimum", "maximum", "zeros", "negatives", "histogram"]},
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: dict[str, np.ndarray]) -> "NeuronStats":
+        neuron_count, min_exponent, max_exponent, subbins_log2, count = (int(x) for x in arrays["settings"])
+        stats = cls(neuron_count, min_exponent, max_exponent, subbins_log2)
+        stats.count = count
+        for name in ["finite", "mean", "m2", "minimum", "maximum", "zeros", "negatives", "histogram"]:
+            setattr(stats, name, np.array(arrays[name]))
+        return stats
+
+
+@dataclass
+class ModelStats:
+    "NeuronStats of the model's inputs and of each layer's outputs"
+    inputs: NeuronStats
+    layers: list[NeuronStats]
+    seconds: float = 0.0
+
+    @classmethod
+    def for_model(cls, model: mlgen.Model, **settings) -> "ModelStats":
+        layers = []
+        width = model.input_count
+        for layer in model.layers:
+            # Only the batch evaluation says how wide a layer's outputs are for every type
+            width = layer.eval_batch(np.zeros((1, width))).shape[1]
+            layers.append(NeuronStats(width, **settings))
+        return cls(NeuronStats(model.input_count, **settings), layers)
+
+    def observe(
+        self,
+        model: mlgen.Model,
+        inputs: np.ndarray,
+        float_environment: Optional[fp.FloatEnvironment] = None,
+        folded: bool = False,
+        reduction: Optional[mlgen.ReductionPlanner] = None,
+        layer_environments: Optional[list[Optional[fp.FloatEnvironment]]] = None,
+    ):
+        """Run a chunk of inputs through the model, recording every layer's outputs. With a
+        float environment, they're what the hardware would compute (see
+        Model.eval_hardware_words()), inputs included, each layer in its own format if
+        layer_environments gives one"""
+        if float_environment is None:
+            values = mlgen.as_float_array(inputs)
+            self.inputs.update(values)
+            for layer, stats in zip(model.layers, self.layers):
+                values = layer.eval_batch(values)
+                stats.update(values)
+            return
+
+        if layer_environments is None:
+            layer_environments = [None] * len(model.layers)
+
+        words = ipsim.float_to_bits(float_environment, inputs)
+        self.inputs.update(ipsim.bits_to_float(float_environment, words))
+        environment = float_environment
+        for layer, layer_environment, stats in zip(model.layers, layer_environments, self.layers):
+            layer_environment = layer_environment or float_environment
+            if layer_environment != environment:
+                words = ipsim.fp_convert(environment, layer_environment, words)
+                environment = layer_environment
+            if folded:
+                words = layer.eval_hardware_folded(words, environment)
+            else:
+                words = layer.eval_hardware(words, environment, reduction)
+            stats.update(ipsim.bits_to_float(environment, words))
+
+    def merge(self, other: "ModelStats"):
+        if len(other.layers) != len(self.layers):
+            raise ValueError(f"Can't merge statistics of {len(other.layers)} layers into ones of {len(self.layers)}")
+        self.inputs.merge(other.inputs)
+        for stats, other_stats in zip(self.layers, other.layers):
+            stats.merge(other_stats)
+        self.seconds += other.seconds
+
+    def save(self, path):
+        arrays = {f"inputs.{name}": array for name, array in self.inputs.to_arrays().items()}
+        for index, stats in enumerate(self.layers):
+            arrays.update((f"layer_{index}.{name}", array) for name, array in stats.to_arrays().items())
+        # Written to a file object, so numpy doesn't add .npz to the name
+        with open(path, "wb") as f:
+            np.savez_compressed(f, **arrays)
+
+    @classmethod
+    def load(cls, path) -> "ModelStats":
+        with np.load(path) as arrays:
+            grouped = collections.defaultdict(dict)
+            for key in arrays.files:
+                prefix, name = key.split(".", 1)
+                grouped[prefix][name] = arrays[key]
+        layer_count = len(grouped) - 1
+        return cls(
+            NeuronStats.from_arrays(grouped["inputs"]),
+            [NeuronStats.from_arrays(grouped[f"layer_{index}"]) for index in range(layer_count)],
+        )
+
+    def format(self, model: mlgen.Model) -> str:
+        lines = [f"{self.inputs.count} samples" + (f" in {self.seconds:.2f}s" if self.seconds > 0 else "")]
+        quantiles = (0.01, 0.5, 0.99)
+        for name, stats in [("Inputs", self.inputs)] + [
+            (f"Layer #{index} ({type(layer).__name__})", stats) for index, (layer, stats) in enumerate(zip(model.layers, self.layers))
+        ]:
+            if stats.count == 0:
+                continue
+            magnitudes = NeuronStats(1, stats.min_exponent, stats.max_exponent, stats.subbins_log2)
+            magnitudes.count = int(stats.count * stats.neuron_count)
+            magnitudes.histogram = stats.histogram.sum(axis=0, keepdims=True)
+            magnitudes.zeros = np.array([stats.zeros.sum()])
+            magnitudes.minimum = np.array([stats.minimum.min()])
+            magnitudes.maximum = np.array([stats.maximum.max()])
+            low, median, high = magnitudes.quantiles(quantiles)[:, 0]
+            binades = stats.binade_range()
+            lines.append(
+                f"{name}: {stats.neuron_count} neurons in [{stats.minimum.min():.4g}, {stats.maximum.max():.4g}], "
+                f"mean {np.nanmean(stats.mean):.4g}, 1%/50%/99% {low:.4g}/{median:.4g}/{high:.4g}"
+            )
+            lines.append(
+                f"    {int(stats.dead().sum())} always zero, {int(stats.never_negative().sum())} never negative, "
+                + ("all zero" if binades is None else f"nonzero magnitudes in binades 2**{binades[0]} to 2**{binades[1]}")
+            )
+        return "\n".join(lines)
+
+
+def stats_path(model_path) -> str:
+    "Where the statistics of a model are kept: model.stats.npz for model.mlgen"
+    return os.path.splitext(model_path)[0] + ".stats.npz"
+
+
+_worker_state: dict = {}
+
+
+def _init_worker(spec, settings, float_environment, folded, reduction, layer_environments):
+    model, shm = parallel.attach_model(spec)
+    _worker_state.update(
+        model=model,
+        shm=shm,
+        settings=settings,
+        float_environment=float_environment,
+        folded=folded,
+        reduction=reduction,
+        layer_environments=layer_environments,
+    )
+
+
+def _run_chunk(inputs):
+    state = _worker_state
+    stats = ModelStats.for_model(state["model"], **state["settings"])
+    stats.observe(
+        state["model"], inputs, state["float_environment"], state["folded"], state["reduction"], state["layer_environments"]
+    )
+    return stats
+
+
+def record(
+    model: mlgen.Model,
+    chunks: Iterable[np.ndarray],
+    processes: int = 1,
+    float_environment: Optional[fp.FloatEnvironment] = None,
+    folded: bool = False,
+    reduction: Optional[mlgen.ReductionPlanner] = None,
+    layer_environments: Optional[list[Optional[fp.FloatEnvironment]]] = None,
+    **settings,
+) -> ModelStats:
+    """Statistics over every chunk of inputs, recorded in worker processes (each chunk
+    separately, then merged) if there's more than one"""
+    stats = ModelStats.for_model(model, **settings)
+    start_time = time.perf_counter()
+
+    if processes == 1:
+        for inputs in chunks:
+            stats.observe(model, inputs, float_environment, folded, reduction, layer_environments)
+    else:
+        shared = parallel.SharedModel(model)
+        try:
+            initargs = (shared.spec, settings, float_environment, folded, reduction, layer_environments)
+            with multiprocessing.Pool(processes, _init_worker, initargs) as pool:
+                in_flight = collections.deque()
+                for inputs in chunks:
+                    in_flight.append(pool.apply_async(_run_chunk, (inputs,)))
+                    if len(in_flight) >= processes * parallel.CHUNKS_PER_WORKER:
+                        stats.merge(in_flight.popleft().get())
+                while len(in_flight) > 0:
+                    stats.merge(in_flight.popleft().get())
+        finally:
+            shared.close()
+
+    stats.seconds += time.perf_counter() - start_time
+    return stats
+
+
+def dataset_chunks(args, input_count: int) -> Iterator[np.ndarray]:
+    rows = 0
+    for inputs, _ in dataset.iter_dataset(args.dataset, input_count, args.chunk_size, label_column=args.label_column, dtype=args.dtype):
+        if args.samples is not None:
+            if rows >= args.samples:
+                break
+            inputs = inputs[:args.samples - rows]
+        rows += len(inputs)
+        yield inputs * args.input_scale + args.input_offset
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record statistics of every neuron's values over a dataset, saved next to the model")
+    parser.add_argument("model", help="the input .mlgen model")
+    parser.add_argument("--dataset", "-d", help="stream inputs from this CSV, .npy or raw binary file (without one, only print the saved statistics)")
+    parser.add_argument("--label-column", type=int, help="skip this column of --dataset (MNIST CSVs have labels in column 0)")
+    parser.add_argument("--dtype", default="float32", help="element type of raw binary --dataset files")
+    parser.add_argument("--samples", type=int, help="stop after this many rows")
+    parser.add_argument("--chunk-size", type=int, default=1024, help="rows to evaluate at once")
+    parser.add_argument("--input-scale", type=float, default=1.0, help="multiply dataset inputs by this before evaluating")
+    parser.add_argument("--input-offset", type=float, default=0.0, help="then add this to dataset inputs")
+    parser.add_argument("--hardware", "-hw", action="store_true", help="record what the generated hardware computes, rather than doubles")
+    parser.add_argument("--generated-with", default="", metavar="ARGS", help="with --hardware, the mlgen2hdl options the hardware is generated with, given with = as they start with -, e.g. --generated-with=\"--fold 4\"")
+    parser.add_argument("--processes", "-j", type=int, default=1, help="worker processes to record chunks in (0 for one per core)")
+    parser.add_argument("--output", "-o", help="where to save the statistics (default: next to the model, as .stats.npz)")
+    parser.add_argument("--append", action="store_true", help="merge into the statistics already saved there, rather than replacing them")
+    parser.add_argument("--min-exponent", type=int, default=MIN_EXPONENT, help="histograms start at 2**this")
+    parser.add_argument("--max-exponent", type=int, default=MAX_EXPONENT, help="and end at 2**this")
+    parser.add_argument("--subbins-log2", type=int, default=SUBBINS_LOG2, help="histograms have 2**this bins per binade")
+
+    args = parser.parse_args()
+
+    mlgen_model = mlgenfile.load_model(args.model)
+    path = args.output or stats_path(args.model)
+
+    if args.dataset is None:
+        print(ModelStats.load(path).format(mlgen_model))
+    else:
+        float_environment = None
+        folded = False
+        reduction = None
+        layer_environments = None
+        if args.hardware:
+            float_environment = fp.FloatEnvironment("binary16")
+            generator_args = mlgen2hdl.parser.parse_args(["stats.mlgen", "stats.sv", *shlex.split(args.generated_with)])
+            prune.require_hardware(mlgen_model, generator_args)
+            folded = generator_args.fold is not None
+            reduction = mlgen.ReductionPlanner(generator_args.adder, generator_args.max_fan_in, generator_args.max_adder_depth, generator_args.adder_objective)
+            if generator_args.formats is not None:
+                layer_environments = mlgenfile.load_formats(generator_args.formats, mlgen_model, float_environment)
+
+        stats = record(
+            mlgen_model,
+            dataset_chunks(args, mlgen_model.input_count),
+            args.processes or os.cpu_count() or 1,
+            float_environment,
+            folded,
+            reduction,
+            layer_environments,
+            min_exponent=args.min_exponent,
+            max_exponent=args.max_exponent,
+            subbins_log2=args.subbins_log2,
+        )
+        if args.append and os.path.exists(path):
+            saved = ModelStats.load(path)
+            saved.merge(stats)
+            stats = saved
+
+        print(stats.format(mlgen_model))
+        stats.save(path)
+        print(f"Saved statistics of {stats.inputs.count} samples to {path}")
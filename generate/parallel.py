@@ -0,0 +1,271 @@
+"""Process-pool simulation backend.
+
+Every layer's arrays (see SequentialStepHDL.to_arrays) are copied once into a single
+shared memory block, which workers map and rebuild their layers on top of, so the model
+is never pickled per worker or per chunk. Input chunks are handed out a few at a time
+and results come back in submission order."""
+
+import collections
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+from typing import Any, Iterable, Iterator, Optional
+
+import numpy as np
+
+import fp as fp
+import mlgen
+
+# Keep every array in the shared block cache-line aligned
+ARRAY_ALIGNMENT = 64
+
+# Chunks in flight per worker: enough to keep workers busy, few enough that a streamed
+# dataset is never all in memory at once
+CHUNKS_PER_WORKER = 2
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+
+
+class SharedModel:
+    """Owns a shared memory copy of a model's arrays. `spec` is the small, picklable
+    description that attach_model() needs to rebuild the model in another process."""
+
+    def __init__(self, model: mlgen.Model):
+        layouts = []
+        placed = []
+        size = 0
+
+        for layer in model.layers:
+            layout = {}
+            for name, array in layer.to_arrays().items():
+                array = np.ascontiguousarray(array)
+                size = _aligned(size)
+                layout[name] = (array.dtype.str, array.shape, size)
+                placed.append((size, array))
+                size += array.nbytes
+            layouts.append((type(layer).__name__, layout))
+
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for offset, array in placed:
+            np.ndarray(array.shape, array.dtype, buffer=self.shm.buf, offset=offset)[...] = array
+
+        self.spec = (self.shm.name, layouts, model.input_count, model.output_count)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching always registers with the resource tracker, but
+        # pool workers share the owner's tracker so it still only gets unlinked once
+        return shared_memory.SharedMemory(name=name)
+
+
+def attach_model(spec) -> tuple[mlgen.Model, shared_memory.SharedMemory]:
+    """Rebuild a model from a SharedModel's spec, as read-only views onto the shared
+    block. The returned SharedMemory must be kept alive as long as the model is used."""
+    name, layouts, input_count, output_count = spec
+    shm = _attach_shared_memory(name)
+
+    layers = []
+    for layer_type, layout in layouts:
+        arrays = {}
+        for array_name, (dtype, shape, offset) in layout.items():
+            array = np.ndarray(shape, np.dtype(dtype), buffer=shm.buf, offset=offset)
+            array.flags.writeable = False
+            arrays[array_name] = array
+        layers.append(mlgen.LAYER_TYPES[layer_type].from_arrays(arrays))
+
+    return mlgen.Model(layers, input_count, output_count), shm
+
+
+def evaluate_chunk(
+    model: mlgen.Model,
+    float_environment: Optional[fp.FloatEnvironment],
+    inputs: np.ndarray,
+    steps: Optional[int] = None,
+    epsilons: tuple[float, ...] = (),
+    layer_environments: Optional[list] = None,
+    folded: bool = False,
+    reduction: Optional[mlgen.ReductionPlanner] = None,
+) -> tuple[np.ndarray, Optional[tuple[np.ndarray, np.ndarray]]]:
+    """Outputs for a chunk of inputs, plus (len(epsilons), N, output_count) lower and
+    upper output bounds for +/- each epsilon around the inputs, if any were given.
+    layer_environments are each layer's own float format, folded whether the network is
+    generated folded and reduction the planner it's generated with, for the hardware's
+    outputs"""
+    if steps is not None:
+        for layer in model.layers:
+            if isinstance(layer, mlgen.IncrementalLogLayer):
+                layer.set_steps(steps)
+
+    if float_environment is None:
+        outputs = model.eval_batch(inputs)
+    else:
+        outputs = model.eval_hardware(inputs, float_environment, folded, reduction, layer_environments)
+
+    if len(epsilons) == 0:
+        return outputs, None
+
+    bounds = [model.eval_interval_batch(inputs - epsilon, inputs + epsilon) for epsilon in epsilons]
+    return outputs, (np.stack([b[0] for b in bounds]), np.stack([b[1] for b in bounds]))
+
+
+def evaluate_sweep(
+    model: mlgen.Model,
+    float_environment: Optional[fp.FloatEnvironment],
+    inputs: np.ndarray,
+    epsilons: tuple[float, ...] = (),
+    reduction: Optional[mlgen.ReductionPlanner] = None,
+) -> list[tuple[int, np.ndarray, Optional[tuple[np.ndarray, np.ndarray]]]]:
+    """(steps, outputs, bounds) as from evaluate_chunk() for every number of incremental
+    log-weight steps, from one pass of mlgen.Model.sweep_incremental_batch()"""
+    lower = upper = None
+    if len(epsilons) > 0:
+        lower = np.concatenate([inputs - epsilon for epsilon in epsilons])
+        upper = np.concatenate([inputs + epsilon for epsilon in epsilons])
+
+    shape = (len(epsilons), len(inputs), model.output_count)
+    return [
+        (steps, outputs, None if bounds is None else (bounds[0].reshape(shape), bounds[1].reshape(shape)))
+        for steps, outputs, bounds in model.sweep_incremental_batch(inputs, lower, upper, float_environment, reduction)
+    ]
+
+
+class SerialSimulator:
+    "Runs chunks in this process; same interface as ParallelSimulator"
+
+    def __init__(
+        self,
+        model: mlgen.Model,
+        float_environment: Optional[fp.FloatEnvironment] = None,
+        layer_environments: Optional[list] = None,
+        folded: bool = False,
+        reduction: Optional[mlgen.ReductionPlanner] = None,
+    ):
+        self.model = model
+        self.float_environment = float_environment
+        self.layer_environments = layer_environments
+        self.folded = folded
+        self.reduction = reduction
+
+    def map(
+        self,
+        chunks: Iterable[tuple[np.ndarray, Any]],
+        steps: Optional[int] = None,
+        epsilons: tuple[float, ...] = (),
+    ) -> Iterator[tuple[np.ndarray, Any, Any]]:
+        """For each (inputs, payload) chunk, yield (outputs, bounds, payload) in order. The
+        payload (e.g. labels) is passed straight through"""
+        for inputs, payload in chunks:
+            outputs, bounds = evaluate_chunk(
+                self.model,
+                self.float_environment,
+                inputs,
+                steps,
+                epsilons,
+                self.layer_environments,
+                self.folded,
+                self.reduction,
+            )
+            yield outputs, bounds, payload
+
+    def sweep(
+        self, chunks: Iterable[tuple[np.ndarray, Any]], epsilons: tuple[float, ...] = ()
+    ) -> Iterator[tuple[list, Any]]:
+        """For each (inputs, payload) chunk, yield (evaluate_sweep() results, payload), so
+        every incremental step is covered in a single pass over the chunks"""
+        for inputs, payload in chunks:
+            yield evaluate_sweep(self.model, self.float_environment, inputs, epsilons, self.reduction), payload
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_worker_state: dict = {}
+
+
+def _init_worker(spec, float_environment, layer_environments=None, folded=False, reduction=None):
+    model, shm = attach_model(spec)
+    _worker_state.update(
+        model=model,
+        shm=shm,
+        float_environment=float_environment,
+        layer_environments=layer_environments,
+        folded=folded,
+        reduction=reduction,
+    )
+
+
+def _run_chunk(inputs, steps, epsilons):
+    return evaluate_chunk(
+        _worker_state["model"],
+        _worker_state["float_environment"],
+        inputs,
+        steps,
+        epsilons,
+        _worker_state["layer_environments"],
+        _worker_state["folded"],
+        _worker_state["reduction"],
+    )
+
+
+def _run_sweep(inputs, epsilons):
+    return evaluate_sweep(
+        _worker_state["model"], _worker_state["float_environment"], inputs, epsilons, _worker_state["reduction"]
+    )
+
+
+class ParallelSimulator(SerialSimulator):
+    def __init__(
+        self,
+        model: mlgen.Model,
+        float_environment: Optional[fp.FloatEnvironment] = None,
+        processes: Optional[int] = None,
+        layer_environments: Optional[list] = None,
+        folded: bool = False,
+        reduction: Optional[mlgen.ReductionPlanner] = None,
+    ):
+        super().__init__(model, float_environment, layer_environments, folded, reduction)
+        self.processes = processes or os.cpu_count() or 1
+        self.shared = SharedModel(model)
+        self.pool = multiprocessing.Pool(
+            self.processes, _init_worker, (self.shared.spec, float_environment, layer_environments, folded, reduction)
+        )
+
+    def _map_async(self, function, chunks, *args):
+        in_flight = collections.deque()
+
+        for inputs, payload in chunks:
+            in_flight.append((self.pool.apply_async(function, (inputs, *args)), payload))
+            if len(in_flight) >= self.processes * CHUNKS_PER_WORKER:
+                result, payload = in_flight.popleft()
+                yield result.get(), payload
+
+        while len(in_flight) > 0:
+            result, payload = in_flight.popleft()
+            yield result.get(), payload
+
+    def map(self, chunks, steps=None, epsilons=()):
+        for (outputs, bounds), payload in self._map_async(_run_chunk, chunks, steps, tuple(epsilons)):
+            yield outputs, bounds, payload
+
+    def sweep(self, chunks, epsilons=()):
+        return self._map_async(_run_sweep, chunks, tuple(epsilons))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.shared.close()
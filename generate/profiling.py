@@ -0,0 +1,277 @@
+"""Where the toolchain spends its time and memory, stage by stage.
+
+Code marks out stages with `with profiling.stage("apply", layer=index): ...`, and tools
+turn recording on with --profile (see add_arguments()). Each stage records its wall time,
+the process's resident and peak resident memory when it ends, how much it raised that
+peak, and any counts it was given or that it can take itself: the HDL wires, instances
+and assignments a module gained over it, and optionally how many Python objects were
+made. Stages nest, so a layer's apply() shows up inside generating the network.
+
+Recordings are written as JSON, with the stages in order plus totals by name, or as a
+Chrome trace (load it in chrome://tracing or https://ui.perfetto.dev) with memory as a
+counter track.
+
+While nothing is recording, stage() hands back the same do-nothing context every time,
+so stages can sit anywhere outside the innermost loops."""
+
+import contextlib
+import gc
+import json
+import os
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows, which just goes without peak memory
+    resource = None
+
+FORMATS = ["json", "chrome"]
+
+
+def rss_bytes() -> Optional[int]:
+    "Current resident memory, where /proc says"
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss_bytes() -> Optional[int]:
+    "Most resident memory the process has used so far"
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes everywhere but macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def module_counts(module) -> dict[str, int]:
+    "What an hdlgen.Module is made of so far"
+    return {
+        "wires": len(module.wires),
+        "instances": len(module.external_modules),
+        "assignments": len(module.assignments),
+        "always_blocks": len(module.always_blocks),
+        "roms": len(module.roms),
+    }
+
+
+@dataclass
+class Stage:
+    name: str
+    category: str
+    depth: int
+    start: float
+    args: dict = field(default_factory=dict)
+    counts: dict = field(default_factory=dict)
+    seconds: float = 0.0
+    rss: Optional[int] = None
+    peak_rss: Optional[int] = None
+    peak_rss_growth: Optional[int] = None
+
+    def __setitem__(self, key, value):
+        "For what's only known at the end, e.g. `span['outputs'] = len(outputs)`"
+        self.args[key] = value
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "category": self.category,
+            "depth": self.depth,
+            "start": self.start,
+            "seconds": self.seconds,
+            "rss": self.rss,
+            "peak_rss": self.peak_rss,
+            "peak_rss_growth": self.peak_rss_growth,
+            "args": self.args,
+            "counts": self.counts,
+        }
+
+
+class Profiler:
+    def __init__(self, objects: bool = False):
+        "objects counts the Python objects each stage leaves behind, which takes a gc walk at both ends"
+        self.objects = objects
+        self.origin = time.perf_counter()
+        self.stages: list[Stage] = []
+        self._open: list[Stage] = []
+
+    @contextlib.contextmanager
+    def stage(self, name: str, category: str = "", module=None, **args):
+        record = Stage(name, category, len(self._open), time.perf_counter() - self.origin, args)
+        self.stages.append(record)
+        self._open.append(record)
+
+        counts_before = module_counts(module) if module is not None else {}
+        objects_before = len(gc.get_objects()) if self.objects else 0
+        peak_before = peak_rss_bytes()
+        try:
+            yield record
+        finally:
+            record.seconds = time.perf_counter() - self.origin - record.start
+            record.rss = rss_bytes()
+            record.peak_rss = peak_rss_bytes()
+            if record.peak_rss is not None:
+                record.peak_rss_growth = record.peak_rss - peak_before
+            if module is not None:
+                record.counts.update(
+                    (key, count - counts_before[key]) for key, count in module_counts(module).items()
+                )
+            if self.objects:
+                record.counts["python_objects"] = len(gc.get_objects()) - objects_before
+            self._open.pop()
+
+    def annotate(self, **args):
+        "Add to the innermost open stage's arguments"
+        if len(self._open) > 0:
+            self._open[-1].args.update(args)
+
+    def totals(self) -> dict[str, dict]:
+        """Calls and seconds by stage name, counting nested stages of the same name (a
+        layer inside a layer) only once"""
+        totals = {}
+        open_names = []
+        for record in self.stages:
+            del open_names[record.depth:]
+            total = totals.setdefault(record.name, {"calls": 0, "seconds": 0.0, "peak_rss_growth": 0})
+            total["calls"] += 1
+            if record.name not in open_names:
+                total["seconds"] += record.seconds
+            total["peak_rss_growth"] += record.peak_rss_growth or 0
+            for key, count in record.counts.items():
+                total[key] = total.get(key, 0) + count
+            open_names.append(record.name)
+        return dict(sorted(totals.items(), key=lambda item: -item[1]["seconds"]))
+
+    def to_json(self) -> dict:
+        return {
+            "seconds": time.perf_counter() - self.origin,
+            "peak_rss": peak_rss_bytes(),
+            "totals": self.totals(),
+            "stages": [record.to_dict() for record in self.stages],
+        }
+
+    def to_chrome_trace(self) -> dict:
+        "Complete events in microseconds, and resident memory as a counter at the end of each stage"
+        pid = os.getpid()
+        events = []
+        for record in self.stages:
+            events.append({
+                "name": record.name,
+                "cat": record.category,
+                "ph": "X",
+                "ts": record.start * 1e6,
+                "dur": record.seconds * 1e6,
+                "pid": pid,
+                "tid": 0,
+                "args": {**record.args, **record.counts},
+            })
+            if record.rss is not None:
+                events.append({
+                    "name": "memory",
+                    "ph": "C",
+                    "ts": (record.start + record.seconds) * 1e6,
+                    "pid": pid,
+                    "args": {"rss_mb": record.rss / 2**20, "peak_rss_mb": (record.peak_rss or 0) / 2**20},
+                })
+        events.sort(key=lambda event: event["ts"])
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, path, format: str = "json"):
+        "To a file, or stdout for -"
+        if format not in FORMATS:
+            raise ValueError(f"Unknown profile format {format}, expected one of {FORMATS}")
+        data = self.to_chrome_trace() if format == "chrome" else self.to_json()
+        if path == "-":
+            json.dump(data, sys.stdout, indent=2, default=str)
+            print()
+        else:
+            with open(path, "w") as f:
+                json.dump(data, f, indent=2, default=str)
+
+    def summary(self, limit: int = 20) -> str:
+        lines = [f"{'stage':32} {'calls':>7} {'seconds':>10} {'peak RSS +MB':>13}"]
+        for name, total in list(self.totals().items())[:limit]:
+            lines.append(
+                f"{name:32} {total['calls']:7d} {total['seconds']:10.3f} {total['peak_rss_growth'] / 2**20:13.1f}"
+            )
+        peak = peak_rss_bytes()
+        if peak is not None:
+            lines.append(f"Peak RSS {peak / 2**20:.1f} MB")
+        return "\n".join(lines)
+
+
+class _Disabled:
+    "What stage() gives while nothing's recording: a context that ignores everything"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+    def __setitem__(self, key, value):
+        pass
+
+
+_DISABLED = _Disabled()
+_profiler: Optional[Profiler] = None
+
+
+def stage(name: str, category: str = "", module=None, **args):
+    """Context around a stage of work, recorded if a profiler is enabled. Give the
+    hdlgen.Module it adds to as module to count what it adds"""
+    if _profiler is None:
+        return _DISABLED
+    return _profiler.stage(name, category, module, **args)
+
+
+def annotate(**args):
+    "Add arguments to the stage currently running, if recording"
+    if _profiler is not None:
+        _profiler.annotate(**args)
+
+
+def enabled() -> bool:
+    return _profiler is not None
+
+
+def enable(objects: bool = False) -> Profiler:
+    global _profiler
+    _profiler = Profiler(objects)
+    return _profiler
+
+
+def disable() -> Optional[Profiler]:
+    "Stop recording, handing back what was recorded"
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+def add_arguments(parser):
+    parser.add_argument("--profile", metavar="FILE", help="record time, memory and counts for every stage and write them to FILE (- for stdout), printing a summary")
+    parser.add_argument("--profile-format", choices=FORMATS, default="json", help="--profile as plain JSON, or a Chrome trace for chrome://tracing or Perfetto")
+    parser.add_argument("--profile-objects", action="store_true", help="with --profile, also count the Python objects each stage leaves behind (slow)")
+
+
+def from_arguments(args) -> Optional[Profiler]:
+    "Start recording if add_arguments()'s options ask for it"
+    if args.profile is None:
+        return None
+    return enable(args.profile_objects)
+
+
+def finish(args):
+    "Write the recording add_arguments()'s options asked for, if any, and stop recording"
+    profiler = disable()
+    if profiler is None:
+        return
+    if args.profile != "-":
+        print(profiler.summary())
+    profiler.write(args.profile, args.profile_format)
@@ -0,0 +1,231 @@
+"""Dead logic elimination, using intervals propagated from the inputs' domain.
+
+Neurons between two dense layers whose value is always zero (typically because their
+ReLU never sees a positive input) are removed, along with everything that only exists to
+make them: their rows of the first dense layer, their biases and activations, and the
+columns of the next dense layer that read them. ReLUs whose input is never negative
+become plain wires (see ReLUStep.passthrough). The model's inputs and outputs stay as
+they are.
+
+The intervals are over the network in real arithmetic, so in principle the hardware's
+rounding could still make a removed neuron nonzero. check_hardware() compares both
+networks' bit-accurate models on samples from the domain, to make sure."""
+
+import argparse
+import shlex
+from typing import Optional
+
+import numpy as np
+
+import dataset
+import difftest
+import fp as fp
+import hdlestimate
+import ipsim
+import mlgen
+import mlgen2hdl
+import mlgenfile
+import zonotope
+
+DENSE_TYPES = (mlgen.DenseLogLayer, mlgen.DenseLayer)
+
+
+def layer_intervals(
+    model: mlgen.Model, lower, upper, domain: str = "box", max_generators: int = zonotope.MAX_GENERATORS
+) -> list[tuple[np.ndarray, np.ndarray]]:
+    """Bounds on every layer's outputs, given bounds on each of the model's inputs, as
+    boxes or zonotopes (see zonotope.layer_bounds())"""
+    lower = np.asarray(lower, dtype=np.float64).reshape(1, model.input_count)
+    upper = np.asarray(upper, dtype=np.float64).reshape(1, model.input_count)
+    return [
+        (layer_lower[0], layer_upper[0])
+        for layer_lower, layer_upper in zonotope.layer_bounds(model, lower, upper, domain, max_generators)
+    ]
+
+
+def term_count(layer) -> int:
+    "Multipliers or shifts a dense layer needs"
+    if isinstance(layer, mlgen.DenseLogLayer):
+        return len(layer.fragments)
+    return int(np.count_nonzero(layer.weight_array()))
+
+
+def layer_output_count(layer) -> int:
+    if isinstance(layer, mlgen.DenseLogLayer):
+        return layer.fragments.shape[0]
+    return layer.weight_array().shape[0]
+
+
+def select_dense(layer, rows, columns):
+    if isinstance(layer, mlgen.DenseLogLayer):
+        store = layer.fragments.select(rows, columns)
+        return type(layer).from_arrays({
+            "shape": np.array(store.shape, dtype=np.int64),
+            "offsets": store.offsets,
+            "exponents": store.exponents,
+            "signs": store.packed_signs,
+        })
+    return mlgen.DenseLayer(layer.weight_array()[np.ix_(rows, columns)])
+
+
+def select_elementwise(layer, neurons, passthrough=None):
+    "An elementwise step for a subset of its neurons, also passing some through if a ReLU"
+    if isinstance(layer, mlgen.BiasStep):
+        return mlgen.BiasStep(layer.bias_array()[neurons])
+    if isinstance(layer, mlgen.ReLUStep):
+        return mlgen.ReLUStep(None if passthrough is None else passthrough[neurons])
+    raise ValueError(f"Don't know how to prune a {type(layer).__name__}")
+
+
+def prune_model(
+    model: mlgen.Model, lower, upper, domain: str = "box", max_generators: int = zonotope.MAX_GENERATORS
+) -> tuple[mlgen.Model, dict]:
+    """The model without neurons that are always zero for inputs within the bounds, and
+    with ReLUs that never see negative inputs passed through. Also returns what was
+    removed, by layer index"""
+    bounds = layer_intervals(model, lower, upper, domain, max_generators)
+    input_bounds = [
+        (np.asarray(lower, dtype=np.float64).reshape(-1), np.asarray(upper, dtype=np.float64).reshape(-1))
+    ] + bounds[:-1]
+    dense = [index for index, layer in enumerate(model.layers) if isinstance(layer, DENSE_TYPES)]
+
+    # Rows kept of every dense layer but the last, judged at the input to the next one
+    kept_rows = {}
+    report = {"neurons": {}, "terms": {}, "relus": {}}
+    for index, next_index in zip(dense, dense[1:]):
+        if any(not isinstance(layer, (mlgen.BiasStep, mlgen.ReLUStep)) for layer in model.layers[index + 1:next_index]):
+            continue
+        feeding_lower, feeding_upper = bounds[next_index - 1]
+        alive = (feeding_lower != 0) | (feeding_upper != 0)
+        # A layer of nothing at all isn't something the generators expect
+        alive[0] |= not alive.any()
+        kept_rows[index] = np.flatnonzero(alive)
+        report["neurons"][index] = [int(len(alive) - alive.sum()), len(alive)]
+
+    layers = []
+    columns = np.arange(model.input_count)
+    for index, layer in enumerate(model.layers):
+        if isinstance(layer, DENSE_TYPES):
+            rows = kept_rows.get(index, np.arange(layer_output_count(layer)))
+            pruned = select_dense(layer, rows, columns)
+            report["terms"][index] = [term_count(layer) - term_count(pruned), term_count(layer)]
+            columns = rows
+        elif isinstance(layer, mlgen.ReLUStep):
+            passthrough = input_bounds[index][0] >= 0
+            if layer.passthrough is not None:
+                passthrough |= layer.passthrough
+            pruned = select_elementwise(layer, columns, passthrough if passthrough.any() else None)
+            report["relus"][index] = [int(passthrough[columns].sum()), len(columns)]
+        else:
+            pruned = select_elementwise(layer, columns)
+        layers.append(pruned)
+
+    return mlgen.Model(layers, model.input_count, model.output_count), report
+
+
+def require_hardware(model: mlgen.Model, generator_args):
+    "Fail early if the model can't be generated with these mlgen2hdl options"
+    if generator_args.fold is None:
+        mac_layers = [index for index, layer in enumerate(model.layers) if isinstance(layer, mlgen.DenseLayer)]
+        if len(mac_layers) > 0:
+            raise ValueError(
+                f"Layers {mac_layers} are MAC (DenseLayer) layers, which only have folded hardware: "
+                "pass e.g. --generated-with=\"--fold 4\" to model it as generated"
+            )
+
+
+def check_hardware(
+    original: mlgen.Model,
+    pruned: mlgen.Model,
+    inputs: np.ndarray,
+    float_environment: fp.FloatEnvironment,
+    folded: bool = False,
+    reduction: Optional[mlgen.ReductionPlanner] = None,
+) -> tuple[int, int]:
+    "(Outputs that differ between the two models' hardware, most ULPs any is off by)"
+    reference = difftest.Reference(float_environment, "hardware", folded, reduction)
+    words = ipsim.float_to_bits(float_environment, inputs)
+    distance = difftest.ulp_distance(float_environment, reference.outputs(pruned, words), reference.outputs(original, words))
+    return int((distance != 0).sum()), int(np.abs(distance).max(initial=0))
+
+
+def estimate(model: mlgen.Model, generator_args, float_environment: fp.FloatEnvironment) -> dict:
+    module = mlgen2hdl.build_module(model, generator_args, float_environment, "prune", verbose=False)
+    return hdlestimate.estimate_module(module, float_environment)
+
+
+def domain_from_dataset(args, input_count: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    "Per-input minimum and maximum over the dataset, and up to --check of its rows"
+    lower = np.full(input_count, np.inf)
+    upper = np.full(input_count, -np.inf)
+    samples = []
+    rows = 0
+    for inputs, _ in dataset.iter_dataset(args.dataset, input_count, args.chunk_size, dtype=args.dtype):
+        inputs = inputs * args.input_scale + args.input_offset
+        lower = np.minimum(lower, inputs.min(axis=0))
+        upper = np.maximum(upper, inputs.max(axis=0))
+        if rows < args.check:
+            samples.append(inputs[:args.check - rows])
+        rows += len(inputs)
+    return lower, upper, np.concatenate(samples) if len(samples) > 0 else np.zeros((0, input_count))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Remove neurons that are always zero, and ReLUs that never see negative inputs, over an input domain")
+    parser.add_argument("model", help="the input .mlgen model")
+    parser.add_argument("destination", help="where to write the pruned .mlgen model")
+    parser.add_argument("--input-range", type=float, nargs=2, metavar=("LOW", "HIGH"), help="every input's domain")
+    parser.add_argument("--dataset", "-d", help="take each input's domain as its range over this CSV, .npy or raw binary file instead")
+    parser.add_argument("--dtype", default="float32", help="element type of raw binary --dataset files")
+    parser.add_argument("--input-scale", type=float, default=1.0, help="multiply dataset inputs by this first")
+    parser.add_argument("--input-offset", type=float, default=0.0, help="then add this to dataset inputs")
+    parser.add_argument("--chunk-size", type=int, default=1024, help="dataset rows to read at once")
+    parser.add_argument("--domain", choices=["box", "zonotope"], default="zonotope", help="propagate the input domain as boxes, or as zonotopes (tighter after a few layers)")
+    parser.add_argument("--max-generators", type=int, default=zonotope.MAX_GENERATORS, help="with --domain zonotope, fold the smallest generators into a box past this many")
+    parser.add_argument("--check", type=int, default=2000, help="inputs from the domain to compare the two networks' hardware on")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--generated-with", default="", metavar="ARGS", help="mlgen2hdl options to estimate the area saved with, and check the hardware as, given with = as they start with -, e.g. --generated-with=\"--adder tree\"")
+    parser.add_argument("--no-estimate", action="store_true", help="skip generating both networks to estimate the area saved")
+
+    args = parser.parse_args()
+
+    if (args.input_range is None) == (args.dataset is None):
+        raise ValueError("Give the input domain with either --input-range or --dataset")
+
+    float_environment = fp.FloatEnvironment("binary16")
+    generator_args = mlgen2hdl.parser.parse_args(["prune.mlgen", "prune.sv", *shlex.split(args.generated_with)])
+
+    mlgen_model = mlgenfile.load_model(args.model)
+    require_hardware(mlgen_model, generator_args)
+    if args.dataset is not None:
+        lower, upper, samples = domain_from_dataset(args, mlgen_model.input_count)
+    else:
+        lower = np.full(mlgen_model.input_count, args.input_range[0])
+        upper = np.full(mlgen_model.input_count, args.input_range[1])
+        samples = np.random.default_rng(args.seed).uniform(lower, upper, (args.check, mlgen_model.input_count))
+
+    pruned_model, report = prune_model(mlgen_model, lower, upper, args.domain, args.max_generators)
+
+    for index, (removed, total) in report["neurons"].items():
+        print(f"Layer #{index} ({type(mlgen_model.layers[index]).__name__}): removed {removed} of {total} neurons that are always zero")
+    for index, (removed, total) in report["terms"].items():
+        print(f"Layer #{index}: removed {removed} of {total} terms")
+    for index, (through, total) in report["relus"].items():
+        print(f"Layer #{index} (ReLUStep): {through} of {total} ReLUs never see negative inputs, so are now wires")
+
+    folded = generator_args.fold is not None
+    reduction = mlgen.ReductionPlanner(generator_args.adder, generator_args.max_fan_in, generator_args.max_adder_depth, generator_args.adder_objective)
+    differ, max_ulp = check_hardware(mlgen_model, pruned_model, samples, float_environment, folded, reduction)
+    print(f"Hardware outputs differing on {len(samples)} inputs from the domain: {differ} (at most {max_ulp} ULPs)")
+
+    if not args.no_estimate:
+        before = estimate(mlgen_model, generator_args, float_environment)
+        after = estimate(pruned_model, generator_args, float_environment)
+        print(hdlestimate.format_saving(before, after))
+        for name in sorted(set(before["instances"]) | set(after["instances"])):
+            count_before = before["instances"].get(name, {}).get("count", 0)
+            count_after = after["instances"].get(name, {}).get("count", 0)
+            if count_before != count_after:
+                print(f"    {name}: {count_before} -> {count_after}")
+
+    mlgenfile.save_model(pruned_model, args.destination)
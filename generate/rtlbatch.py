@@ -0,0 +1,128 @@
+"""Python driver for the batch Verilator testbench, test/nn_tb_batch.cpp.
+
+Build it with `make obj_dir/nn_tb_batch` after generating the network into
+generated/nn.sv. The testbench loads the model once and streams raw binary16 vectors
+through it. This drives it with numpy arrays, or chunk by chunk from a dataset, through
+one long-running process: a thread feeds inputs in while the outputs are read back.
+`simulatemlgen.py --rtl obj_dir/nn_tb_batch` runs datasets through it."""
+
+import queue
+import subprocess
+import threading
+from typing import Any, Iterable, Iterator, Optional
+
+import numpy as np
+
+import fp as fp
+import ipsim
+
+WORD_DTYPE = np.dtype("=u2")
+
+
+class BatchTestbench:
+    def __init__(self, binary: str, trace: Optional[str] = None):
+        self.binary = binary
+        self.trace = trace
+
+        description = subprocess.run([binary, "--describe"], check=True, capture_output=True, text=True).stdout.split()
+        fields = dict(zip(description[::2], description[1::2]))
+        self.input_count = int(fields["inputs"])
+        self.output_count = int(fields["outputs"])
+        self.clocked = fields["clocked"] == "1"
+
+    def _command(self) -> list[str]:
+        return [self.binary] + ([] if self.trace is None else ["--trace", self.trace])
+
+    def _check_words(self, words: np.ndarray) -> np.ndarray:
+        words = np.ascontiguousarray(words, dtype=WORD_DTYPE)
+        if words.ndim != 2 or words.shape[1] != self.input_count:
+            raise ValueError(f"Expected an (N, {self.input_count}) array of input words, got shape {words.shape}")
+        return words
+
+    def run(self, words: np.ndarray) -> np.ndarray:
+        "(N, output_count) output words for an (N, input_count) array of input words"
+        words = self._check_words(words)
+        result = subprocess.run(self._command(), input=words.tobytes(), check=True, capture_output=True)
+        return self._parse(result.stdout, len(words))
+
+    def _parse(self, data: bytes, count: int) -> np.ndarray:
+        outputs = np.frombuffer(data, dtype=WORD_DTYPE)
+        if len(outputs) != count * self.output_count:
+            raise RuntimeError(f"Expected {count} output vectors from {self.binary}, got {len(outputs) / self.output_count}")
+        return outputs.reshape(count, self.output_count)
+
+    def map(self, chunks: Iterable[tuple[np.ndarray, Any]]) -> Iterator[tuple[np.ndarray, Any]]:
+        """For each (input words, payload) chunk, yield (output words, payload) in order,
+        all through one testbench process"""
+        process = subprocess.Popen(self._command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        # (vector count, payload) per chunk written, or an exception from the feeder
+        written: queue.Queue = queue.Queue()
+
+        def feed():
+            try:
+                for words, payload in chunks:
+                    words = self._check_words(words)
+                    written.put((len(words), payload))
+                    process.stdin.write(words.tobytes())
+                written.put(None)
+            except BaseException as e:
+                written.put(e)
+            finally:
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        finished = False
+        try:
+            while True:
+                item = written.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                count, payload = item
+                data = process.stdout.read(count * self.output_count * WORD_DTYPE.itemsize)
+                yield self._parse(data, count), payload
+            finished = True
+        finally:
+            if not finished:
+                # Otherwise the feeder could be stuck writing to a testbench that's stuck
+                # writing outputs nobody will read
+                process.kill()
+            feeder.join()
+            process.stdout.close()
+            if process.wait() != 0 and finished:
+                raise subprocess.CalledProcessError(process.returncode, self._command())
+
+
+class VerilatorSimulator:
+    """Runs chunks through the RTL; same interface as parallel.SerialSimulator, so it can
+    stand in for it in simulatemlgen. Inputs are rounded to binary16 words first, as
+    mlgen.Model.eval_hardware() does"""
+
+    def __init__(self, testbench: BatchTestbench, float_environment: fp.FloatEnvironment):
+        self.testbench = testbench
+        self.float_environment = float_environment
+
+    def map(self, chunks, steps=None, epsilons=()):
+        if len(epsilons) > 0:
+            raise ValueError("Intervals can't be simulated in RTL")
+        if steps is not None:
+            raise ValueError("There's no RTL for incremental log layers")
+
+        words = ((ipsim.float_to_bits(self.float_environment, inputs), payload) for inputs, payload in chunks)
+        for outputs, payload in self.testbench.map(words):
+            yield ipsim.bits_to_float(self.float_environment, outputs), None, payload
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
@@ -1,36 +1,29 @@
-import pickle
 import mlgen
+import mlgen2hdl
+import mlgenfile
 import fp as fp
+import ipsim
+import dataset
+import parallel
+import profiling
+import prune
+import rtlbatch
 import argparse, os
+import shlex
+import time
 import warnings
+import numpy as np
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
-parser = argparse.ArgumentParser(description="Simulate the given mlgen model")
-parser.add_argument("model", help="the input .mlgen array")
-parser.add_argument("--incremental-log-layers", "-inc", action="store_true")
-parser.add_argument("--simulate-intervals", "-int", action="store_true")
-parser.add_argument("--artificial-interval", "-aint", type=float, default=0.0, help="Introduce artificial interval to network inputs of +/- this number")
-#parser.add_argument("input", help="comma-separated list of inputs")
+# A single normalised MNIST digit, as fed to the samples/ models
+MNIST_SAMPLE = [-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.258611,1.026908,1.026908,1.026908,-0.105876,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.835989,2.490618,2.796088,2.808815,2.796088,1.128731,0.543247,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.708710,2.096053,2.643353,2.796088,2.796088,2.490618,2.312427,2.796088,1.510569,-0.093148,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.182244,0.950541,2.223332,2.796088,2.719720,2.236060,0.645071,0.174138,0.543247,2.719720,2.554257,0.046859,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,1.726943,2.796088,2.808815,2.796088,1.077820,-0.424074,-0.424074,-0.424074,-0.424074,1.103275,2.643353,1.370562,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.670527,2.808815,2.808815,2.821543,1.383290,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,1.306922,2.808815,1.803311,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.059587,2.376067,2.796088,2.796088,2.197876,-0.220427,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,1.905134,2.796088,1.192371,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.334979,0.301417,1.408745,2.796088,2.630625,1.879678,-0.105876,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.182244,2.248787,2.719720,0.683254,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.148682,2.796088,2.808815,2.681536,1.790583,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.263233,2.401522,2.236060,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,1.739671,2.796088,2.821543,2.325155,-0.029509,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,2.452434,2.796088,1.637848,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.301417,2.808815,2.808815,1.383290,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,2.032413,2.808815,2.096053,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.054964,2.134236,2.796088,2.796088,0.785078,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.296795,0.657799,2.617897,2.796088,0.479608,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,2.057869,2.796088,2.719720,1.077820,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.339601,2.796088,2.821543,1.548752,-0.258611,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.390512,2.643353,2.796088,2.439706,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.059587,2.452434,2.796088,1.854222,-0.309523,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.390512,2.643353,2.796088,1.434201,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.186866,1.688759,2.592441,1.001452,0.377784,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,1.026908,2.821543,2.490618,0.174138,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,1.828766,2.808815,2.490618,0.174138,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,1.026908,2.796088,2.312427,-0.054964,-0.424074,-0.424074,-0.054964,0.657799,0.861445,2.452434,2.808815,2.439706,0.237777,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,1.408745,2.796088,2.796088,2.325155,2.096053,2.108780,2.325155,2.796088,2.719720,2.070597,1.281466,0.046859,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.657799,2.363339,2.796088,2.796088,2.796088,2.808815,2.681536,2.439706,2.121508,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.059587,1.001452,1.001452,1.001452,1.014180,0.530519,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074]
 
 
-float_environment = fp.FloatEnvironment("binary16")
-
-args = parser.parse_args()
-
-f = open(args.model, "rb")
-mlgen_model: mlgen.Model = pickle.load(f)
-f.close()
-
-#last_layer = [float(x) for x in args.input.split(",")]
-
-
-num_logweight_steps = 1
-
 def abbreviate_list(l):
     # pretty ugly
     def listify(m):
-        return ", ".join(f'{float(x):.2f}' if isinstance(x,(int,float)) else str(x) for x in m)
+        return ", ".join(f'{float(x):.2f}' if isinstance(x,(int,float,np.floating)) else str(x) for x in m)
     
     trim_to_length = 15
     if len(l) <= trim_to_length:
@@ -42,35 +35,280 @@ def abbreviate_list(l):
         return first_part + " ... " + second_part + f" ({len(l)} elements)"
 
 
-while True:
-    last_layer = [-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.258611,1.026908,1.026908,1.026908,-0.105876,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.835989,2.490618,2.796088,2.808815,2.796088,1.128731,0.543247,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.708710,2.096053,2.643353,2.796088,2.796088,2.490618,2.312427,2.796088,1.510569,-0.093148,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.182244,0.950541,2.223332,2.796088,2.719720,2.236060,0.645071,0.174138,0.543247,2.719720,2.554257,0.046859,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,1.726943,2.796088,2.808815,2.796088,1.077820,-0.424074,-0.424074,-0.424074,-0.424074,1.103275,2.643353,1.370562,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.670527,2.808815,2.808815,2.821543,1.383290,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,1.306922,2.808815,1.803311,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.059587,2.376067,2.796088,2.796088,2.197876,-0.220427,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,1.905134,2.796088,1.192371,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.334979,0.301417,1.408745,2.796088,2.630625,1.879678,-0.105876,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.182244,2.248787,2.719720,0.683254,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.148682,2.796088,2.808815,2.681536,1.790583,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.263233,2.401522,2.236060,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,1.739671,2.796088,2.821543,2.325155,-0.029509,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,2.452434,2.796088,1.637848,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.301417,2.808815,2.808815,1.383290,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,2.032413,2.808815,2.096053,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.054964,2.134236,2.796088,2.796088,0.785078,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.296795,0.657799,2.617897,2.796088,0.479608,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,2.057869,2.796088,2.719720,1.077820,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.339601,2.796088,2.821543,1.548752,-0.258611,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.390512,2.643353,2.796088,2.439706,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.059587,2.452434,2.796088,1.854222,-0.309523,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.390512,2.643353,2.796088,1.434201,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.186866,1.688759,2.592441,1.001452,0.377784,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,1.026908,2.821543,2.490618,0.174138,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,1.828766,2.808815,2.490618,0.174138,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,1.026908,2.796088,2.312427,-0.054964,-0.424074,-0.424074,-0.054964,0.657799,0.861445,2.452434,2.808815,2.439706,0.237777,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,1.408745,2.796088,2.796088,2.325155,2.096053,2.108780,2.325155,2.796088,2.719720,2.070597,1.281466,0.046859,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.657799,2.363339,2.796088,2.796088,2.796088,2.808815,2.681536,2.439706,2.121508,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,0.059587,1.001452,1.001452,1.001452,1.014180,0.530519,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074,-0.424074]
-    last_interval = [(x - args.artificial_interval, x + args.artificial_interval) for x in last_layer]
+def abbreviate_intervals(lower, upper):
+    return abbreviate_list([f"({float(l):.2f}, {float(u):.2f})" for l, u in zip(lower, upper)])
+
+
+def make_artificial_intervals(inputs, epsilons) -> tuple[np.ndarray, np.ndarray]:
+    """Turn (N, input_count) inputs into boxes of +/- each epsilon around every input,
+    giving (len(epsilons) * N, input_count) lower and upper bounds grouped by epsilon"""
+    inputs = np.asarray(inputs, dtype=np.float64)
+    radii = np.repeat(np.asarray(epsilons, dtype=np.float64), len(inputs))[:, None]
+    centres = np.tile(inputs, (len(epsilons), 1))
+    return centres - radii, centres + radii
+
+
+def simulate_intervals(model: mlgen.Model, inputs, epsilons) -> tuple[np.ndarray, np.ndarray]:
+    """Propagate +/- epsilon boxes around every input vector through the model in one
+    go, for every epsilon given. Returns lower and upper output bounds shaped
+    (len(epsilons), N, output_count)"""
+    inputs = np.atleast_2d(np.asarray(inputs, dtype=np.float64))
+    lower, upper = model.eval_interval_batch(*make_artificial_intervals(inputs, epsilons))
+    shape = (len(epsilons), len(inputs), model.output_count)
+    return lower.reshape(shape), upper.reshape(shape)
+
+
+@dataclass
+class ClassificationReport:
+    class_count: int
+    epsilons: tuple[float, ...] = ()
+    confusion: np.ndarray = field(init=False)
+    robust: np.ndarray = field(init=False)
+    samples: int = 0
+    seconds: float = 0.0
+
+    def __post_init__(self):
+        # Rows are the true class, columns the predicted one
+        self.confusion = np.zeros((self.class_count, self.class_count), dtype=np.int64)
+        # Per epsilon, samples whose true class output is provably the largest
+        self.robust = np.zeros(len(self.epsilons), dtype=np.int64)
+
+    def update(self, outputs: np.ndarray, labels: np.ndarray | None, bounds=None):
+        self.samples += len(outputs)
+        if labels is None:
+            return
 
-    if args.incremental_log_layers:
-        print(f"Simulating with {num_logweight_steps} log-weight steps")
+        np.add.at(self.confusion, (labels, outputs.argmax(axis=1)), 1)
+
+        if bounds is not None:
+            lower, upper = bounds
+            rows = np.arange(len(labels))
+            others_upper = upper.copy()
+            others_upper[:, rows, labels] = -np.inf
+            self.robust += (lower[:, rows, labels] > others_upper.max(axis=2)).sum(axis=1)
+
+    def merge(self, other: "ClassificationReport"):
+        self.confusion += other.confusion
+        self.robust += other.robust
+        self.samples += other.samples
+        self.seconds += other.seconds
+
+    @property
+    def labelled(self) -> int:
+        return int(self.confusion.sum())
+
+    @property
+    def accuracy(self) -> float:
+        return float(np.trace(self.confusion) / self.labelled) if self.labelled > 0 else float("nan")
+
+    @property
+    def throughput(self) -> float:
+        return self.samples / self.seconds if self.seconds > 0 else float("inf")
+
+    def format(self) -> str:
+        lines = [f"{self.samples} samples in {self.seconds:.2f}s ({self.throughput:.1f} samples/s)"]
+        if self.labelled > 0:
+            lines.append(f"Top-1 accuracy: {self.accuracy * 100:.2f}% ({np.trace(self.confusion)}/{self.labelled})")
+            for epsilon, robust in zip(self.epsilons, self.robust):
+                lines.append(f"Provably correct within +/- {epsilon}: {robust / self.labelled * 100:.2f}% ({robust}/{self.labelled})")
+            lines.append("Confusion matrix (rows: true class, columns: predicted class):")
+            width = max(len(str(self.confusion.max())), len(str(self.class_count - 1)))
+            lines.append(" " * (width + 3) + " ".join(f"{c:>{width}}" for c in range(self.class_count)))
+            for true_class, row in enumerate(self.confusion):
+                per_class = row[true_class] / row.sum() if row.sum() > 0 else float("nan")
+                lines.append(
+                    f"{true_class:>{width}} | " + " ".join(f"{x:>{width}}" for x in row) + f"  ({per_class * 100:.1f}%)"
+                )
+        return "\n".join(lines)
+
+
+def evaluate_dataset(
+    model: mlgen.Model, chunks, simulator=None, steps: int | None = None, epsilons=()
+) -> ClassificationReport:
+    """Run (inputs, labels) chunks through a parallel.SerialSimulator/ParallelSimulator
+    (serial in doubles by default), accumulating a report. Interval bounds are only
+    computed if epsilons are given"""
+    if simulator is None:
+        simulator = parallel.SerialSimulator(model)
+
+    report = ClassificationReport(model.output_count, tuple(epsilons))
+    start = time.perf_counter()
+    with profiling.stage("simulate", "simulation", simulator=type(simulator).__name__, steps=steps) as span:
+        for outputs, bounds, labels in simulator.map(chunks, steps, tuple(epsilons)):
+            report.update(outputs, labels, bounds)
+        span["samples"] = report.samples
+    report.seconds = time.perf_counter() - start
+
+    return report
+
+
+def set_incremental_steps(model: mlgen.Model, steps: int, advance: bool) -> bool:
+    """Point every incremental log layer at the given step, returning whether any has
+    reached its maximum"""
     reached_max_steps = False
-    
-    for layer_index, layer in enumerate(mlgen_model.layers):
+    for layer in model.layers:
         if isinstance(layer, mlgen.IncrementalLogLayer):
-            if args.incremental_log_layers:
-                reached_max_steps = reached_max_steps or layer.set_steps(num_logweight_steps)
+            if advance:
+                reached_max_steps = layer.set_steps(steps) or reached_max_steps
             else:
                 warnings.warn("Encountered incremental log layer but not advancing (use --incremental-log-layers)!")
-        last_layer = layer.eval(last_layer)
-        print(f"- Layer #{layer_index} ({layer}) got {abbreviate_list(last_layer)}")
+    return reached_max_steps
+
+
+def evaluate_dataset_sweep(
+    model: mlgen.Model, chunks, simulator=None, epsilons=()
+) -> dict[int, ClassificationReport]:
+    """Like evaluate_dataset(), but for every number of incremental log-weight steps at
+    once, in a single pass over the chunks. The time taken is shared between the steps"""
+    if simulator is None:
+        simulator = parallel.SerialSimulator(model)
+
+    reports = {}
+    start = time.perf_counter()
+    with profiling.stage("simulate sweep", "simulation", simulator=type(simulator).__name__):
+        for results, labels in simulator.sweep(chunks, tuple(epsilons)):
+            for steps, outputs, bounds in results:
+                if steps not in reports:
+                    reports[steps] = ClassificationReport(model.output_count, tuple(epsilons))
+                reports[steps].update(outputs, labels, bounds)
+    seconds = time.perf_counter() - start
+
+    for report in reports.values():
+        report.seconds = seconds / len(reports)
+    return reports
+
+
+def simulate_dataset(model: mlgen.Model, args, simulator):
+    epsilons = args.artificial_interval if args.simulate_intervals else ()
+
+    chunks = dataset.iter_dataset(
+        args.dataset,
+        model.input_count,
+        args.chunk_size,
+        labels_path=args.labels,
+        label_column=args.label_column,
+        dtype=args.dtype,
+        label_dtype=args.label_dtype,
+    )
+    chunks = ((inputs * args.input_scale + args.input_offset, labels) for inputs, labels in chunks)
 
-        if args.simulate_intervals:
-            last_interval = layer.eval_interval(last_interval)
-            print(f"  - got intervals {abbreviate_list(last_interval)}")
-    
-    print(f"Output: {last_layer}")
-    if args.simulate_intervals:
-        print(f"Output intervals: {last_interval}")
-    
     if not args.incremental_log_layers:
-        break
-    if reached_max_steps:
-        print(f"Reached max steps at {num_logweight_steps} steps")
-        break
+        set_incremental_steps(model, 1, False)
+        print(evaluate_dataset(model, chunks, simulator, None, epsilons).format())
+        return
+
+    reports = evaluate_dataset_sweep(model, chunks, simulator, epsilons)
+    for steps, report in reports.items():
+        print(f"Simulating with {steps} log-weight steps")
+        print(report.format())
+    print(f"Reached max steps at {max(reports, default=0)} steps")
+
+
+def simulate_sample(
+    model: mlgen.Model,
+    args,
+    float_environment: fp.FloatEnvironment,
+    folded: bool = False,
+    reduction: mlgen.ReductionPlanner | None = None,
+):
+    num_logweight_steps = 1
+
+    while True:
+        last_layer = np.array([MNIST_SAMPLE])
+        last_lower, last_upper = make_artificial_intervals(last_layer, args.artificial_interval)
+
+        if args.incremental_log_layers:
+            print(f"Simulating with {num_logweight_steps} log-weight steps")
+        reached_max_steps = set_incremental_steps(model, num_logweight_steps, args.incremental_log_layers)
+        
+        for layer_index, layer in enumerate(model.layers):
+            if args.hardware:
+                words = ipsim.float_to_bits(float_environment, last_layer)
+                if folded:
+                    words = layer.eval_hardware_folded(words, float_environment)
+                else:
+                    words = layer.eval_hardware(words, float_environment, reduction)
+                last_layer = ipsim.bits_to_float(float_environment, words)
+            else:
+                last_layer = layer.eval_batch(last_layer)
+            print(f"- Layer #{layer_index} ({layer}) got {abbreviate_list(last_layer[0])}")
+
+            if args.simulate_intervals:
+                last_lower, last_upper = layer.eval_interval_batch(last_lower, last_upper)
+                for epsilon, lower, upper in zip(args.artificial_interval, last_lower, last_upper):
+                    print(f"  - got intervals (+/- {epsilon}) {abbreviate_intervals(lower, upper)}")
+        
+        print(f"Output: {last_layer[0].tolist()}")
+        if args.simulate_intervals:
+            for epsilon, lower, upper in zip(args.artificial_interval, last_lower, last_upper):
+                print(f"Output intervals (+/- {epsilon}): {list(zip(lower.tolist(), upper.tolist()))}")
+        
+        if not args.incremental_log_layers:
+            break
+        if reached_max_steps:
+            print(f"Reached max steps at {num_logweight_steps} steps")
+            break
+
+        num_logweight_steps += 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate the given mlgen model")
+    parser.add_argument("model", help="the input .mlgen array")
+    parser.add_argument("--incremental-log-layers", "-inc", action="store_true")
+    parser.add_argument("--simulate-intervals", "-int", action="store_true")
+    parser.add_argument("--artificial-interval", "-aint", type=float, nargs="+", default=[0.0], help="Introduce artificial interval to network inputs of +/- this number (give several to sweep them all at once)")
+    #parser.add_argument("input", help="comma-separated list of inputs")
+    parser.add_argument("--dataset", "-d", help="stream inputs from this CSV, .npy or raw binary file and report accuracy, instead of simulating one sample")
+    parser.add_argument("--labels", "-l", help="labels for --dataset, one per row, in any of the same formats")
+    parser.add_argument("--label-column", type=int, help="take labels from this column of --dataset instead (MNIST CSVs use 0)")
+    parser.add_argument("--dtype", default="float32", help="element type of raw binary --dataset files")
+    parser.add_argument("--label-dtype", default="uint8", help="element type of raw binary --labels files")
+    parser.add_argument("--chunk-size", type=int, default=1024, help="number of samples to evaluate at once")
+    parser.add_argument("--input-scale", type=float, default=1.0, help="multiply dataset inputs by this before evaluating")
+    parser.add_argument("--input-offset", type=float, default=0.0, help="then add this to dataset inputs")
+    parser.add_argument("--hardware", "-hw", action="store_true", help="bit-accurately simulate the generated hardware instead of evaluating in doubles")
+    parser.add_argument("--generated-with", default="", metavar="ARGS", help="with --hardware, the mlgen2hdl options the hardware is generated with, so the folding and adders it models match, given with = as they start with -, e.g. --generated-with=\"--adder tree\"")
+    parser.add_argument("--formats", metavar="FILE", help="with --hardware, simulate each layer in its own float format, as generated with mlgen2hdl --formats")
+    parser.add_argument("--rtl", metavar="TESTBENCH", help="run --dataset through the generated RTL instead, with a built batch testbench (e.g. obj_dir/nn_tb_batch)")
+    parser.add_argument("--processes", "-j", type=int, default=1, help="worker processes to spread --dataset chunks over (0 for one per core)")
+
+    float_environment = fp.FloatEnvironment("binary16")
+
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.from_arguments(args)
+
+    mlgen_model = mlgenfile.load_model(args.model)
+
+    generator_args = mlgen2hdl.parser.parse_args(["simulate.mlgen", "simulate.sv", *shlex.split(args.generated_with)])
+    folded = args.hardware and generator_args.fold is not None
+    reduction = mlgen.ReductionPlanner(generator_args.adder, generator_args.max_fan_in, generator_args.max_adder_depth, generator_args.adder_objective)
+    if args.hardware:
+        prune.require_hardware(mlgen_model, generator_args)
+
+    if args.dataset is not None:
+        simulation_environment = float_environment if args.hardware else None
+        layer_environments = None
+        if args.formats is not None:
+            if not args.hardware or args.incremental_log_layers:
+                raise ValueError("--formats is only for --hardware, without --incremental-log-layers")
+            layer_environments = mlgenfile.load_formats(args.formats, mlgen_model, float_environment)
+        if folded and args.incremental_log_layers:
+            raise ValueError("--incremental-log-layers can't be swept on folded hardware")
+
+        if args.rtl is not None:
+            simulator = rtlbatch.VerilatorSimulator(rtlbatch.BatchTestbench(args.rtl), float_environment)
+        elif args.processes == 1:
+            simulator = parallel.SerialSimulator(mlgen_model, simulation_environment, layer_environments, folded, reduction)
+        else:
+            simulator = parallel.ParallelSimulator(mlgen_model, simulation_environment, args.processes or None, layer_environments, folded, reduction)
+
+        with simulator:
+            simulate_dataset(mlgen_model, args, simulator)
+    else:
+        if args.rtl is not None:
+            raise ValueError("--rtl is only for --dataset")
+        simulate_sample(mlgen_model, args, float_environment, folded, reduction)
 
-    num_logweight_steps += 1
+    profiling.finish(args)
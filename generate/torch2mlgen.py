@@ -1,14 +1,17 @@
-import math
-
 import argparse
-import pickle
 import warnings
 
-from mlgen import DenseLogLayer, ReLUStep, Model, BiasStep, DenseLayer, IncrementalLogLayer, WeightFragment
+import numpy as np
+
+import mlgenfile
+import profiling
+from mlgen import DenseLogLayer, ReLUStep, Model, BiasStep, DenseLayer, IncrementalLogLayer, FragmentStore
 
 
 
 def identify_layer(layer):
+    # Only imported where torch objects are handled, so the rest works on numpy arrays without it
+    import torch
     if isinstance(layer, torch.jit.ScriptModule):
         return layer.original_name
     else:
@@ -18,7 +21,23 @@ def identify_layer(layer):
             raise NotImplementedError(f"Don't know how to deal with {layer}")
         
 
-def torch_model_to_mlgen(model, log_quantize_all = False, log_quantize_precision: float = 0.1, first_layer_log_incremental=False) -> Model:
+def torch_linear_layers(model) -> list[tuple[np.ndarray, np.ndarray]]:
+    "(weight, bias) of every layer, as numpy arrays so they can be used without torch"
+    linear_layers = []
+    for index, layer in enumerate(model.children()):
+        with profiling.stage("read layer", "conversion", layer=index, repr=repr(layer)) as span:
+            name = identify_layer(layer)
+            if name == "Linear":
+                linear_layers.append(
+                    (layer.state_dict()["weight"].detach().cpu().numpy(), layer.state_dict()["bias"].detach().cpu().numpy())
+                )
+            else:
+                raise NotImplementedError(f"Don't know how to convert {layer}")
+            span["shape"] = list(linear_layers[-1][0].shape)
+    return linear_layers
+
+
+def linear_layers_to_mlgen(linear_layers, log_quantize_all = False, log_quantize_precision: float = 0.1, first_layer_log_incremental=False, verbose=True) -> Model:
     layers = []
     # todo: don't always make auto-relu layers!
     auto_relu = True
@@ -31,71 +50,110 @@ def torch_model_to_mlgen(model, log_quantize_all = False, log_quantize_precision
     
     first_iteration = True
 
-    torch_layers = list(model.children())
-
-    for index, layer in enumerate(torch_layers):
-        last_iteration = index == (len(torch_layers) - 1)
+    for index, (weight, bias) in enumerate(linear_layers):
+        last_iteration = index == (len(linear_layers) - 1)
 
-        print(f"Processing layer #{index}...")
-        print(repr(layer))
-        print(f"Has size {len(layer.state_dict()['weight'])}x{len(layer.state_dict()['weight'][0])}")
-        name = identify_layer(layer)
-        if name == "Linear":
-            if first_iteration:
-                input_count = len(layer.state_dict()["weight"][0])
+        if first_iteration:
+            input_count = len(weight[0])
 
-            output_count = len(layer.state_dict()["weight"])
+        output_count = len(weight)
 
+        with profiling.stage("convert layer", "conversion", layer=index, shape=list(np.shape(weight))) as span:
             if first_iteration and first_layer_log_incremental:
-                print("Making incremental log layer...")
-                layers.append(IncrementalLogLayer(make_log_mult_layer(layer.state_dict()["weight"], log_quantize_precision)))
+                layers.append(IncrementalLogLayer(make_log_layer_fragments(weight, log_quantize_precision, verbose)))
             else:
                 if log_quantize_all:
-                    print("Making log-quantized layer")
-                    layers.append(DenseLogLayer(make_log_mult_layer(layer.state_dict()["weight"], log_quantize_precision)))
+                    layers.append(DenseLogLayer(make_log_layer_fragments(weight, log_quantize_precision, verbose)))
                 else:
-                    print("Making MAC layer")
-                    layers.append(DenseLayer(layer.state_dict()["weight"]))
-            
-            layers.append(BiasStep(layer.state_dict()["bias"]))
-        else:
-            raise NotImplementedError(f"Don't know how to convert {layer}")
-        if auto_relu and not last_iteration:
-            layers.append(ReLUStep())
+                    layers.append(DenseLayer(weight))
+            span["type"] = type(layers[-1]).__name__
+
+            layers.append(BiasStep(bias))
+            if auto_relu and not last_iteration:
+                layers.append(ReLUStep())
         first_iteration = False
 
     return Model(layers, input_count, output_count)
 
-def make_log_mult_layer(weights: list[list[float]], precision: float) -> list[list[list[WeightFragment]]]:
-    print("Got weights of size", len(weights), "x", len(weights[0]))
-    assert precision > 0
-
-    log_weights_signs = []
-
-    for neuron_weights in weights:
-        neuron_weights_signs = []
-        for weight in neuron_weights:
-            this_log_weights_signs = []
 
-            # Weight which must be added to achieve desired multiplication
-            target_weight = weight
-
-            while abs(target_weight) > precision:
-                exponent = math.ceil(math.log2(abs(target_weight)))
-                negate = target_weight < 0
-                this_weight_contribution = math.pow(2, exponent)
-                target_weight -= (-1 if negate else 1) * this_weight_contribution
-
-                this_log_weights_signs.append(
-                    WeightFragment(exponent=exponent, negative=negate)
-                )
-
-            neuron_weights_signs.append(this_log_weights_signs)
+def torch_model_to_mlgen(model, log_quantize_all = False, log_quantize_precision: float = 0.1, first_layer_log_incremental=False) -> Model:
+    return linear_layers_to_mlgen(torch_linear_layers(model), log_quantize_all, log_quantize_precision, first_layer_log_incremental)
+
+def make_log_mult_layer(weights, precision: float) -> FragmentStore:
+    """Greedily decompose every weight into signed powers of 2, each time taking the
+    power of 2 at or above the remaining magnitude, until what's left is within precision.
+    All weights are stepped at once, one fragment per round, in the weights' own dtype
+    (float32 for torch tensors) so the fragments match doing it one weight at a time"""
+    weights = np.asarray(weights)
+    if weights.dtype.kind != "f":
+        weights = weights.astype(np.float64)
+    assert precision > 0
 
-        log_weights_signs.append(neuron_weights_signs)
+    # Weight which must still be added to achieve desired multiplication
+    target_weights = weights.ravel().copy()
+    remaining = np.arange(target_weights.size)
+
+    round_indices = []
+    round_exponents = []
+    round_negatives = []
+
+    while True:
+        remaining = remaining[np.abs(target_weights[remaining]) > precision]
+        if len(remaining) == 0:
+            break
+
+        target = target_weights[remaining]
+        exponents = np.ceil(np.log2(np.abs(target).astype(np.float64))).astype(np.int64)
+        negatives = target < 0
+        contributions = np.ldexp(np.ones_like(target), exponents)
+        target_weights[remaining] = target - np.where(negatives, -contributions, contributions)
+
+        round_indices.append(remaining)
+        round_exponents.append(exponents)
+        round_negatives.append(negatives)
+
+    if len(round_indices) == 0:
+        return FragmentStore.from_flat(np.zeros(weights.shape, dtype=np.int64), [], [])
+
+    # Rounds are in fragment order, so a stable sort by weight puts every weight's
+    # fragments together in the order they were found
+    weight_index = np.concatenate(round_indices)
+    order = np.argsort(weight_index, kind="stable")
+
+    return FragmentStore.from_flat(
+        np.bincount(weight_index, minlength=weights.size).reshape(weights.shape),
+        np.concatenate(round_exponents)[order],
+        np.concatenate(round_negatives)[order],
+    )
+
+
+def format_fragment_histogram(fragments: FragmentStore) -> str:
+    """How many weights got each number of fragments, and the fp_multiplybypowerof2
+    instances (one per fragment) a DenseLogLayer of them will take"""
+    histogram = np.bincount(fragments.counts().ravel())
+    weight_count = fragments.shape[0] * fragments.shape[1]
+    lines = [
+        f"{count:3} fragments: {weights:8} weights ({100.0 * weights / weight_count:5.1f}%)"
+        for count, weights in enumerate(histogram)
+        if weights > 0
+    ]
+    lines.append(
+        f"{len(fragments)} fragments in total ({len(fragments) / max(weight_count, 1):.2f} per weight, "
+        f"{len(fragments) / max(fragments.shape[0], 1):.1f} per output neuron)"
+    )
+    return "\n".join(lines)
+
+
+def make_log_layer_fragments(weights, precision: float, verbose: bool = True) -> FragmentStore:
+    with profiling.stage("decompose", "conversion", precision=precision) as span:
+        fragments = make_log_mult_layer(weights, precision)
+        span["weights"] = fragments.shape[0] * fragments.shape[1]
+        span["fragments"] = len(fragments)
+    if verbose:
+        print(f"Fragment counts at precision {precision}:")
+        print(format_fragment_histogram(fragments))
+    return fragments
 
-    #print("Produced denseloglayer of size ", len(log_weights_signs), len(log_weights_signs[0]))
-    return log_weights_signs
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process some images')
@@ -105,6 +163,7 @@ if __name__ == "__main__":
     parser.add_argument("--log-quantize-all", help="", action="store_true")
     parser.add_argument("--log-quantize-precision", "-lp", type=float)
     parser.add_argument("--first-layer-log-incremental", "-i", action="store_true")
+    profiling.add_arguments(parser)
 
     args = parser.parse_args()
 
@@ -112,13 +171,13 @@ if __name__ == "__main__":
         if args.log_quantize_precision is None:
             raise ValueError("Must provide --log-quantize-precision if --log-quantize-all or --first-layer-log-incremental are used!")
 
+    profiling.from_arguments(args)
+
     # do this late to avoid ridiculous time to show --help
     import torch
-    model = torch.jit.load(args.model, map_location='cpu')
+    with profiling.stage("load torch model", "conversion", path=args.model):
+        model = torch.jit.load(args.model, map_location='cpu')
     mlgen_model = torch_model_to_mlgen(model, args.log_quantize_all, args.log_quantize_precision, args.first_layer_log_incremental)
 
-    with open(args.destination, "wb") as f:
-        pickle.dump(mlgen_model, f)
-
-# also need to import it here, for global-scope availability for use in module functions
-import torch
\ No newline at end of file
+    mlgenfile.save_model(mlgen_model, args.destination)
+    profiling.finish(args)
@@ -0,0 +1,184 @@
+"""Zonotope abstract domain, for bounds that remember how neurons relate to each other.
+
+Boxes (eval_interval_batch()) forget that neurons computed from the same inputs move
+together, so after a few dense layers and ReLUs they grow far bigger than the set of
+values the network can actually reach. A zonotope is a centre plus a weighted sum of
+noise symbols, each anywhere in [-1, 1]:
+
+    x = centre + eps @ generators,    eps in [-1, 1]^k
+
+Dense layers and biases map it exactly. ReLUs that can go either way are relaxed to the
+tightest parallelogram around them (as in DeepZ), which takes a new noise symbol for
+each such neuron. So that doesn't grow without limit, once there are more than
+max_generators the smallest are folded into a box (a generator per neuron), which only
+forgets how those parts relate.
+
+Like boxes elsewhere, zonotopes are batched: centres are (N, n) and generators (N, k, n).
+Layers map them with SequentialStepHDL.eval_zonotope(), and layer_bounds() gives every
+layer's bounds, as prune.py and floatformats.py use with --domain zonotope. Running this
+reports how much tighter they are than boxes."""
+
+import argparse
+import json
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+MAX_GENERATORS = 1024
+
+
+@dataclass
+class Zonotope:
+    centre: np.ndarray
+    generators: np.ndarray
+
+    @classmethod
+    def from_box(cls, lower, upper) -> "Zonotope":
+        "A generator per input that isn't the same at both ends of any of the boxes"
+        lower = np.asarray(lower, dtype=np.float64)
+        upper = np.asarray(upper, dtype=np.float64)
+        centre = (lower + upper) / 2
+        return cls(centre, np.zeros(centre.shape[:1] + (0,) + centre.shape[1:])).add_box((upper - lower) / 2)
+
+    def bounds(self) -> tuple[np.ndarray, np.ndarray]:
+        radius = np.abs(self.generators).sum(axis=1)
+        return self.centre - radius, self.centre + radius
+
+    def affine(self, weights: np.ndarray, bias: Optional[np.ndarray] = None) -> "Zonotope":
+        "Through an output_count x input_count matrix, then the bias if given"
+        centre = self.centre @ weights.T
+        if bias is not None:
+            centre = centre + bias
+        return Zonotope(centre, self.generators @ weights.T)
+
+    def shift(self, offset: np.ndarray) -> "Zonotope":
+        return Zonotope(self.centre + offset, self.generators)
+
+    def add_box(self, radius: np.ndarray) -> "Zonotope":
+        "Widen each neuron by +/- radius, with a new generator for each that any widens"
+        neurons = np.flatnonzero((radius > 0).any(axis=0))
+        box = np.zeros((len(radius), len(neurons), radius.shape[1]))
+        box[:, np.arange(len(neurons)), neurons] = radius[:, neurons]
+        return Zonotope(self.centre, np.concatenate([self.generators, box], axis=1))
+
+    def relu(self, passthrough: Optional[np.ndarray] = None) -> "Zonotope":
+        """Neurons that are never negative pass through, ones never positive become 0, and
+        the rest are bounded between slope * x and slope * x + 2 * offset"""
+        lower, upper = self.bounds()
+        crossing = (lower < 0) & (upper > 0)
+        slope = np.where(upper <= 0, 0.0, 1.0)
+        if passthrough is not None:
+            crossing &= ~passthrough
+            slope = np.where(passthrough, 1.0, slope)
+        slope = np.where(crossing, upper / np.where(crossing, upper - lower, 1.0), slope)
+        offset = np.where(crossing, -slope * lower / 2, 0.0)
+
+        relaxed = Zonotope(slope * self.centre + offset, self.generators * slope[:, None, :])
+        return relaxed.add_box(offset)
+
+    def reduce(self, max_generators: int = MAX_GENERATORS) -> "Zonotope":
+        """At most max(max_generators, n) generators, by folding the smallest (by L1
+        norm) into a box"""
+        count, size = self.generators.shape[1:]
+        if count <= max_generators:
+            return self
+
+        keep = max(max_generators - size, 0)
+        magnitudes = np.abs(self.generators)
+        largest = np.argsort(-magnitudes.sum(axis=2), axis=1)[:, :keep]
+        kept = np.take_along_axis(self.generators, largest[:, :, None], axis=1)
+        radius = np.maximum(magnitudes.sum(axis=1) - np.abs(kept).sum(axis=1), 0.0)
+        return Zonotope(self.centre, kept).add_box(radius)
+
+
+def layer_bounds(model, lower, upper, domain: str = "zonotope", max_generators: int = MAX_GENERATORS) -> list[tuple[np.ndarray, np.ndarray]]:
+    """(N, n) bounds on every layer's outputs given (N, input_count) boxes around the
+    inputs, as boxes or zonotopes. Zonotope bounds are cut down to the boxes' where
+    those are tighter, which they can be after ReLUs"""
+    lower = np.asarray(lower, dtype=np.float64)
+    upper = np.asarray(upper, dtype=np.float64)
+    zonotope = Zonotope.from_box(lower, upper) if domain == "zonotope" else None
+
+    bounds = []
+    for layer in model.layers:
+        lower, upper = layer.eval_interval_batch(lower, upper)
+        if zonotope is not None:
+            zonotope = layer.eval_zonotope(zonotope).reduce(max_generators)
+            zonotope_lower, zonotope_upper = zonotope.bounds()
+            lower, upper = np.maximum(lower, zonotope_lower), np.minimum(upper, zonotope_upper)
+        bounds.append((lower, upper))
+    return bounds
+
+
+def tightness(box: tuple[np.ndarray, np.ndarray], zonotope: tuple[np.ndarray, np.ndarray]) -> dict:
+    "How a layer's zonotope bounds compare with its boxes"
+    box_width = box[1] - box[0]
+    width = zonotope[1] - zonotope[0]
+    wide = box_width > 0
+    ratio = width[wide] / box_width[wide]
+    return {
+        "box_width": float(box_width.mean()) if box_width.size > 0 else 0.0,
+        "zonotope_width": float(width.mean()) if width.size > 0 else 0.0,
+        "width_ratio": float(ratio.mean()) if ratio.size > 0 else 1.0,
+        # Per neuron, so that layers of different sizes compare
+        "log2_volume_ratio": float(np.log2(np.maximum(ratio, 1e-300)).mean()) if ratio.size > 0 else 0.0,
+        "zero_width": int((width == 0).sum() - (box_width == 0).sum()),
+    }
+
+
+if __name__ == "__main__":
+    import mlgenfile
+
+    parser = argparse.ArgumentParser(description="Compare zonotope bounds on every layer with the boxes eval_interval gives")
+    parser.add_argument("model", help="the input .mlgen model")
+    parser.add_argument("--input-range", type=float, nargs=2, metavar=("LOW", "HIGH"), default=[0.0, 1.0], help="every input's domain")
+    parser.add_argument("--max-generators", type=int, default=MAX_GENERATORS, help="fold the smallest generators into a box past this many")
+    parser.add_argument("--samples", type=int, default=1000, help="random inputs from the domain to compare both with the values actually reached")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", "-o", help="write the comparison to this JSON file")
+
+    args = parser.parse_args()
+
+    mlgen_model = mlgenfile.load_model(args.model)
+    lower = np.full((1, mlgen_model.input_count), args.input_range[0])
+    upper = np.full((1, mlgen_model.input_count), args.input_range[1])
+
+    start = time.perf_counter()
+    box = layer_bounds(mlgen_model, lower, upper, "box")
+    box_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    zonotope = layer_bounds(mlgen_model, lower, upper, "zonotope", args.max_generators)
+    zonotope_seconds = time.perf_counter() - start
+
+    # What's actually reached on samples, which both bounds have to contain
+    values = np.random.default_rng(args.seed).uniform(lower, upper, (args.samples, mlgen_model.input_count))
+    reached = []
+    for layer in mlgen_model.layers:
+        values = layer.eval_batch(values)
+        reached.append((values.min(axis=0, initial=np.inf), values.max(axis=0, initial=-np.inf)))
+
+    print(f"Boxes took {box_seconds:.3f}s, zonotopes (up to {args.max_generators} generators) {zonotope_seconds:.3f}s")
+    print("Mean width per layer: box, zonotope (ratio, log2 volume ratio per neuron), reached on samples")
+    report = []
+    for index, (layer, box_bounds, zonotope_bounds, (reached_lower, reached_upper)) in enumerate(
+        zip(mlgen_model.layers, box, zonotope, reached)
+    ):
+        box_bounds = (box_bounds[0][0], box_bounds[1][0])
+        zonotope_bounds = (zonotope_bounds[0][0], zonotope_bounds[1][0])
+        entry = {"layer": index, "type": type(layer).__name__, **tightness(box_bounds, zonotope_bounds)}
+        entry["reached_width"] = float((reached_upper - reached_lower).mean()) if args.samples > 0 else None
+        report.append(entry)
+        reached_text = "" if entry["reached_width"] is None else f", {entry['reached_width']:.4g}"
+        print(
+            f"    #{index} {entry['type']}: {entry['box_width']:.4g}, {entry['zonotope_width']:.4g} "
+            f"({entry['width_ratio']:.3f}, {entry['log2_volume_ratio']:.2f}){reached_text}"
+        )
+        if args.samples > 0 and (np.any(reached_lower < zonotope_bounds[0] - 1e-9 * (1 + np.abs(reached_lower)))
+                                 or np.any(reached_upper > zonotope_bounds[1] + 1e-9 * (1 + np.abs(reached_upper)))):
+            raise RuntimeError(f"Layer #{index} reached values outside its zonotope bounds")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"seconds": {"box": box_seconds, "zonotope": zonotope_seconds}, "layers": report}, f, indent=2)
@@ -0,0 +1,74 @@
+module fp_accumulator(clk, enable, clear, argumenta, out);
+	parameter floatsize = 16;
+	parameter exponentsize = 5;
+	// Extra integer bits, so up to 2**countsize values can be added without overflowing
+	parameter countsize = 16;
+	localparam significandsize = floatsize-exponentsize-1;
+	// Every normal value is a whole number of the smallest normal's last significand
+	// places, so adding them up in a fixed point register this wide is exact
+	localparam accumulatorsize = 1 + countsize + (1 << exponentsize) + significandsize;
+	localparam indexsize = $clog2(accumulatorsize);
+
+	// Adds argumenta on every clock that enable is high, starting again from zero if
+	// clear is also high. out is the running total (as of the last clock), truncated to
+	// a float: it flushes to zero on underflow and goes to infinity on overflow. Zero
+	// exponents (zeros and subnormals) count as zero
+	input clk;
+	input enable;
+	input clear;
+	input [floatsize-1:0] argumenta;
+	output reg [floatsize-1:0] out;
+
+	wire sign_a = argumenta[floatsize-1];
+
+	wire [exponentsize-1:0] exponent_a = argumenta[floatsize-2:floatsize-1-exponentsize];
+
+	wire [significandsize-1:0] significand_a = argumenta[significandsize-1:0];
+
+	wire [accumulatorsize-1:0] magnitude_a = (exponent_a == 0) ? '{default: '0}
+		: accumulatorsize'({1'b1, significand_a}) << (exponent_a - 1'b1);
+
+	wire [accumulatorsize-1:0] term = sign_a ? -magnitude_a : magnitude_a;
+
+	reg [accumulatorsize-1:0] accumulator;
+
+	always_ff @(posedge clk) begin
+		if (enable) begin
+			accumulator <= (clear ? '{default: '0} : accumulator) + term;
+		end
+	end
+
+
+	wire sign_out = accumulator[accumulatorsize-1];
+
+	wire [accumulatorsize-1:0] magnitude_out = sign_out ? -accumulator : accumulator;
+
+	reg [indexsize-1:0] first_1_index;
+
+	always_comb begin
+		first_1_index = 0;
+		for (integer i = 0; i < accumulatorsize; i++) begin
+			if (magnitude_out[i] == 1) begin
+				first_1_index = indexsize'(i);
+			end
+		end
+	end
+
+	// The leading 1 of a value with biased exponent e is at bit e + significandsize - 1
+	wire signed [indexsize+1:0] exponent_out = $signed({2'b0, first_1_index}) - $signed((indexsize+2)'(significandsize - 1));
+
+	wire [accumulatorsize-1:0] normalised = magnitude_out << (accumulatorsize - 1 - first_1_index);
+
+	wire [significandsize-1:0] significand_out = normalised[accumulatorsize-2:accumulatorsize-1-significandsize];
+
+	always_comb begin
+		if (magnitude_out == 0 || exponent_out < 1) begin
+			out = '{default: '0};
+		end else if (exponent_out >= (1 << exponentsize) - 1) begin
+			out = {sign_out, {exponentsize{1'b1}}, {significandsize{1'b0}}};
+		end else begin
+			out = {sign_out, exponentsize'(exponent_out), significand_out};
+		end
+	end
+
+endmodule
@@ -0,0 +1,46 @@
+module fp_convert(argumenta, out);
+	parameter floatsize = 16;
+	parameter exponentsize = 5;
+	parameter infloatsize = 16;
+	parameter inexponentsize = 5;
+	localparam significandsize = floatsize-exponentsize-1;
+	localparam insignificandsize = infloatsize-inexponentsize-1;
+	localparam exponentwidth = (exponentsize > inexponentsize ? exponentsize : inexponentsize) + 2;
+	localparam rebias = ((1 << (exponentsize-1)) - 1) - ((1 << (inexponentsize-1)) - 1);
+
+	// Converts between float formats, e.g. between layers built with different ones. The
+	// exponent is rebiased and the significand truncated or padded with zeros. Zero
+	// exponents (zeros and subnormals) and exponents too small for the output give zero,
+	// ones too big give infinity, and infinities and NaNs stay so
+	input [infloatsize-1:0] argumenta;
+	output reg [floatsize-1:0] out;
+
+	wire sign_a = argumenta[infloatsize-1];
+	wire [inexponentsize-1:0] exponent_a = argumenta[infloatsize-2:insignificandsize];
+	wire [insignificandsize-1:0] significand_a = argumenta[insignificandsize-1:0];
+
+	// Two extra bits so that over- and underflow can be seen
+	wire signed [exponentwidth-1:0] exponent_out = $signed(exponentwidth'(exponent_a)) + $signed(exponentwidth'(rebias));
+
+	wire [significandsize-1:0] significand_out;
+	generate
+		if (significandsize >= insignificandsize) begin
+			assign significand_out = significandsize'(significand_a) << (significandsize - insignificandsize);
+		end else begin
+			assign significand_out = significandsize'(significand_a >> (insignificandsize - significandsize));
+		end
+	endgenerate
+
+	always_comb begin
+		if (exponent_a == {inexponentsize{1'b1}}) begin
+			out = {sign_a, {exponentsize{1'b1}}, significand_a != 0, {(significandsize-1){1'b0}}};
+		end else if (exponent_a == 0 || exponent_out < 1) begin
+			out = {sign_a, {(floatsize-1){1'b0}}};
+		end else if (exponent_out >= (1 << exponentsize) - 1) begin
+			out = {sign_a, {exponentsize{1'b1}}, {significandsize{1'b0}}};
+		end else begin
+			out = {sign_a, exponentsize'(exponent_out), significand_out};
+		end
+	end
+
+endmodule
@@ -0,0 +1,45 @@
+module fp_multiplybyvariablepowerof2(argumenta, power, negate, out);
+	parameter floatsize = 16;
+	parameter exponentsize = 5;
+	parameter powersize = 8;
+	localparam significandsize = floatsize-exponentsize-1;
+
+	// Same as fp_multiplybypowerof2, but the power and negation come in on ports, so one
+	// instance can be shared between many weight fragments. Zeros (and subnormals) give
+	// zero whatever the power, as the accumulators this feeds would otherwise add up the
+	// small normals that shifting a zero exponent up makes
+	input [floatsize-1:0] argumenta;
+	input signed [powersize-1:0] power;
+	input negate;
+	output reg [floatsize-1:0] out;
+
+	wire sign_a = argumenta[floatsize-1];
+
+	wire [exponentsize-1:0] exponent_a = argumenta[floatsize-2:floatsize-1-exponentsize];
+
+	wire [significandsize-1:0] significand_a = argumenta[significandsize-1:0];
+
+
+	wire [exponentsize-1:0] exponent_a_subtracted = exponent_a + exponentsize'(power);
+
+	wire [floatsize-1:0] affected = {negate ? ~sign_a : sign_a, exponent_a_subtracted, significand_a};
+
+	always_comb begin
+		if (exponent_a == 0) begin
+			out = '{default: '0};
+		end else if (power > 0) begin
+			if (exponent_a_subtracted < exponent_a) begin
+				out = '{default: '0};
+			end else begin
+				out = affected;
+			end
+		end else begin
+			if (exponent_a_subtracted > exponent_a) begin
+				out = '{default: '0};
+			end else begin
+				out = affected;
+			end
+		end
+	end
+
+endmodule
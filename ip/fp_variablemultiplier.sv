@@ -0,0 +1,44 @@
+module fp_variablemultiplier(argumenta, argumentb, out);
+	parameter floatsize = 16;
+	parameter exponentsize = 5;
+	localparam significandsize = floatsize-exponentsize-1;
+	localparam exponent_bias = (1 << (exponentsize-1)) - 1;
+
+	// Multiplies two runtime operands (fp_multiplier has a fixed multiplicand). Zero
+	// exponents (zeros and subnormals) count as zero, the significand is truncated, and
+	// the result flushes to zero on underflow and goes to infinity on overflow
+	input [floatsize-1:0] argumenta;
+	input [floatsize-1:0] argumentb;
+	output reg [floatsize-1:0] out;
+
+	wire sign_a = argumenta[floatsize-1];
+	wire [exponentsize-1:0] exponent_a = argumenta[floatsize-2:floatsize-1-exponentsize];
+	wire [significandsize-1:0] significand_a = argumenta[significandsize-1:0];
+
+	wire sign_b = argumentb[floatsize-1];
+	wire [exponentsize-1:0] exponent_b = argumentb[floatsize-2:floatsize-1-exponentsize];
+	wire [significandsize-1:0] significand_b = argumentb[significandsize-1:0];
+
+	// 1.a * 1.b is in [1, 4), with 2*significandsize fraction bits
+	wire [2*significandsize+1:0] significand_multiplied = {1'b1, significand_a} * {1'b1, significand_b};
+	wire significand_carry = significand_multiplied[2*significandsize+1];
+
+	wire [significandsize-1:0] significand_out = significand_carry
+		? significand_multiplied[2*significandsize:significandsize+1]
+		: significand_multiplied[2*significandsize-1:significandsize];
+
+	// Two extra bits so that over- and underflow can be seen
+	wire signed [exponentsize+1:0] exponent_out = $signed({2'b0, exponent_a}) + $signed({2'b0, exponent_b})
+		- $signed((exponentsize+2)'(exponent_bias)) + $signed({{(exponentsize+1){1'b0}}, significand_carry});
+
+	always_comb begin
+		if (exponent_a == 0 || exponent_b == 0 || exponent_out < 1) begin
+			out = '{default: '0};
+		end else if (exponent_out >= (1 << exponentsize) - 1) begin
+			out = {sign_a ^ sign_b, {exponentsize{1'b1}}, {significandsize{1'b0}}};
+		end else begin
+			out = {sign_a ^ sign_b, exponentsize'(exponent_out), significand_out};
+		end
+	end
+
+endmodule
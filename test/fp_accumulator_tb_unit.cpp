@@ -0,0 +1,37 @@
+#include <Vfp_accumulator.h>
+#include "verilated.h"
+#include "ip_vectors.hh"
+
+// Checks fp_accumulator against ipsim.fp_accumulator_segments() on vectors from stdin:
+// python generate/ipvectors.py fp_accumulator | fp_accumulator_tb_unit
+// Each vector is one clock adding argumenta (after clearing, if clear is set), and the
+// total it should then hold.
+
+int main(int argc, char** argv) {
+    VerilatedContext* contextp = new VerilatedContext;
+    contextp->commandArgs(argc, argv);
+    Vfp_accumulator* top = new Vfp_accumulator{contextp};
+
+    top->clk = 0;
+    top->enable = 0;
+    top->clear = 0;
+    top->eval();
+
+    Checker checker;
+    std::vector<uint64_t> words(3); // clear, argumenta, out
+    while (read_vector(words)) {
+        top->enable = 1;
+        top->clear = words[0];
+        top->argumenta = words[1];
+        top->clk = 1;
+        top->eval();
+        checker.check(words, top->out);
+        top->clk = 0;
+        top->eval();
+    }
+
+    top->final();
+    delete top;
+    delete contextp;
+    return checker.finish("fp_accumulator");
+}
@@ -0,0 +1,25 @@
+#include <Vfp_activation_relu.h>
+#include "verilated.h"
+#include "ip_vectors.hh"
+
+// Checks fp_activation_relu against ipsim.fp_activation_relu() on vectors from stdin:
+// python generate/ipvectors.py fp_activation_relu | fp_activation_relu_tb_unit
+
+int main(int argc, char** argv) {
+    VerilatedContext* contextp = new VerilatedContext;
+    contextp->commandArgs(argc, argv);
+    Vfp_activation_relu* top = new Vfp_activation_relu{contextp};
+
+    Checker checker;
+    std::vector<uint64_t> words(2); // argumenta, out
+    while (read_vector(words)) {
+        top->argumenta = words[0];
+        top->eval();
+        checker.check(words, top->out);
+    }
+
+    top->final();
+    delete top;
+    delete contextp;
+    return checker.finish("fp_activation_relu");
+}
@@ -0,0 +1,26 @@
+#include <Vfp_adder.h>
+#include "verilated.h"
+#include "ip_vectors.hh"
+
+// Checks fp_adder against ipsim.fp_adder() on vectors from stdin:
+// python generate/ipvectors.py fp_adder | fp_adder_tb_unit
+
+int main(int argc, char** argv) {
+    VerilatedContext* contextp = new VerilatedContext;
+    contextp->commandArgs(argc, argv);
+    Vfp_adder* top = new Vfp_adder{contextp};
+
+    Checker checker;
+    std::vector<uint64_t> words(3); // argumenta, argumentb, out
+    while (read_vector(words)) {
+        top->argumenta = words[0];
+        top->argumentb = words[1];
+        top->eval();
+        checker.check(words, top->out);
+    }
+
+    top->final();
+    delete top;
+    delete contextp;
+    return checker.finish("fp_adder");
+}
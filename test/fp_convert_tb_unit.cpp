@@ -0,0 +1,26 @@
+#include <Vfp_convert.h>
+#include "verilated.h"
+#include "ip_vectors.hh"
+
+// Checks fp_convert against ipsim.fp_convert() on vectors from stdin, given the same
+// parameters it was built with, e.g.
+// python generate/ipvectors.py fp_convert -Ginfloatsize=32 -Ginexponentsize=8 | fp_convert_tb_unit
+
+int main(int argc, char** argv) {
+    VerilatedContext* contextp = new VerilatedContext;
+    contextp->commandArgs(argc, argv);
+    Vfp_convert* top = new Vfp_convert{contextp};
+
+    Checker checker;
+    std::vector<uint64_t> words(2); // argumenta, out
+    while (read_vector(words)) {
+        top->argumenta = words[0];
+        top->eval();
+        checker.check(words, top->out);
+    }
+
+    top->final();
+    delete top;
+    delete contextp;
+    return checker.finish("fp_convert");
+}
@@ -0,0 +1,26 @@
+#include <Vfp_multiplybypowerof2.h>
+#include "verilated.h"
+#include "ip_vectors.hh"
+
+// Checks fp_multiplybypowerof2 against ipsim.fp_multiplybypowerof2() on vectors from
+// stdin, given the same power and negate it was built with, e.g.
+// python generate/ipvectors.py fp_multiplybypowerof2 -Gpower=-3 -Gnegate=1 | fp_multiplybypowerof2_tb_unit
+
+int main(int argc, char** argv) {
+    VerilatedContext* contextp = new VerilatedContext;
+    contextp->commandArgs(argc, argv);
+    Vfp_multiplybypowerof2* top = new Vfp_multiplybypowerof2{contextp};
+
+    Checker checker;
+    std::vector<uint64_t> words(2); // argumenta, out
+    while (read_vector(words)) {
+        top->argumenta = words[0];
+        top->eval();
+        checker.check(words, top->out);
+    }
+
+    top->final();
+    delete top;
+    delete contextp;
+    return checker.finish("fp_multiplybypowerof2");
+}
@@ -0,0 +1,27 @@
+#include <Vfp_multiplybyvariablepowerof2.h>
+#include "verilated.h"
+#include "ip_vectors.hh"
+
+// Checks fp_multiplybyvariablepowerof2 against ipsim.fp_multiplybypowerof2() on vectors
+// from stdin: python generate/ipvectors.py fp_multiplybyvariablepowerof2 | fp_multiplybyvariablepowerof2_tb_unit
+
+int main(int argc, char** argv) {
+    VerilatedContext* contextp = new VerilatedContext;
+    contextp->commandArgs(argc, argv);
+    Vfp_multiplybyvariablepowerof2* top = new Vfp_multiplybyvariablepowerof2{contextp};
+
+    Checker checker;
+    std::vector<uint64_t> words(4); // argumenta, power (two's complement), negate, out
+    while (read_vector(words)) {
+        top->argumenta = words[0];
+        top->power = words[1];
+        top->negate = words[2];
+        top->eval();
+        checker.check(words, top->out);
+    }
+
+    top->final();
+    delete top;
+    delete contextp;
+    return checker.finish("fp_multiplybyvariablepowerof2");
+}
@@ -1,11 +1,37 @@
 #include <cassert>
 #include "fp_sum_tb.hh"
+#include "ip_vectors.hh"
 #include <stdlib.h>
 
+// Without arguments, checks fp_sum against ipsim.fp_sum() on vectors from stdin instead,
+// given the same parameters it was built with, e.g.
+// python generate/ipvectors.py fp_sum -Ginputcount=4 | fp_sum_tb_unit
+int check_vectors() {
+    VerilatedContext* contextp = new VerilatedContext;
+    Vfp_sum* top = new Vfp_sum{contextp};
+    size_t inputcount = sizeof(top->argument_array)/sizeof(top->argument_array[0]);
+
+    Checker checker;
+    std::vector<uint64_t> words(inputcount + 1); // argument_array, out
+    while (read_vector(words)) {
+        for (size_t i=0; i<inputcount; i++) {
+            top->argument_array[i] = words[i];
+        }
+        top->eval();
+        checker.check(words, top->out);
+    }
+
+    top->final();
+    delete top;
+    delete contextp;
+    return checker.finish("fp_sum");
+}
+
 int main(int argc, char** argv) {
     
-    
-    assert(argc >= 2);
+    if (argc < 2) {
+        return check_vectors();
+    }
 
     int set_inputs = argc - 1; // argv[0] is just program name
 
@@ -0,0 +1,26 @@
+#include <Vfp_variablemultiplier.h>
+#include "verilated.h"
+#include "ip_vectors.hh"
+
+// Checks fp_variablemultiplier against ipsim.fp_variablemultiplier() on vectors from
+// stdin: python generate/ipvectors.py fp_variablemultiplier | fp_variablemultiplier_tb_unit
+
+int main(int argc, char** argv) {
+    VerilatedContext* contextp = new VerilatedContext;
+    contextp->commandArgs(argc, argv);
+    Vfp_variablemultiplier* top = new Vfp_variablemultiplier{contextp};
+
+    Checker checker;
+    std::vector<uint64_t> words(3); // argumenta, argumentb, out
+    while (read_vector(words)) {
+        top->argumenta = words[0];
+        top->argumentb = words[1];
+        top->eval();
+        checker.check(words, top->out);
+    }
+
+    top->final();
+    delete top;
+    delete contextp;
+    return checker.finish("fp_variablemultiplier");
+}
@@ -0,0 +1,56 @@
+#ifndef IP_VECTORS_HH
+#define IP_VECTORS_HH
+
+#include <cstdint>
+#include <cstdio>
+#include <cstdlib>
+#include <stdexcept>
+#include <string>
+#include <vector>
+
+// Reading the vectors generate/ipvectors.py writes: one per line, hex words with the
+// inputs in port order and then the output ipsim expects.
+
+// Mismatches printed before only counting the rest
+const long MAX_PRINTED_MISMATCHES = 20;
+
+bool read_vector(std::vector<uint64_t>& words) {
+    for (size_t i=0; i<words.size(); i++) {
+        char text[32];
+        int got = scanf("%31s", text);
+        if (got != 1 && i == 0) {
+            return false;
+        }
+        if (got != 1) {
+            throw std::runtime_error(std::string("Input ended part way through a vector of ") + std::to_string(words.size()) + std::string(" words"));
+        }
+        words[i] = strtoull(text, nullptr, 16);
+    }
+    return true;
+}
+
+struct Checker {
+    long vectors = 0;
+    long mismatches = 0;
+
+    void check(const std::vector<uint64_t>& words, uint64_t actual) {
+        uint64_t expected = words.back();
+        if (actual != expected && mismatches < MAX_PRINTED_MISMATCHES) {
+            printf("Vector %ld:", vectors);
+            for (size_t i=0; i+1<words.size(); i++) {
+                printf(" %llx", (unsigned long long)words[i]);
+            }
+            printf(" gave %llx, expected %llx\n", (unsigned long long)actual, (unsigned long long)expected);
+        }
+        mismatches += actual != expected;
+        vectors++;
+    }
+
+    // The exit status: nonzero on any mismatch, or if nothing was checked
+    int finish(const char* name) {
+        printf("%s: %ld of %ld vectors mismatched\n", name, mismatches, vectors);
+        return mismatches > 0 || vectors == 0;
+    }
+};
+
+#endif
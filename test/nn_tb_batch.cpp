@@ -0,0 +1,198 @@
+#include <Vnn.h>
+#include "verilated.h"
+#include "verilated_vcd_c.h"
+#include <cstdint>
+#include <cstdio>
+#include <cstring>
+#include <stdexcept>
+#include <string>
+#include <vector>
+
+// Runs many input vectors through one instance of the generated network. Vectors are
+// raw binary16 words (input_count per vector, host byte order) read from a file or
+// stdin, and the outputs are written the same way, one vector per input, in order.
+// Clocked designs (--pipeline or --fold) are driven through their valid/ready
+// handshake, taking inputs as fast as the design accepts them.
+//
+// Usage: nn_tb_batch [--input FILE] [--output FILE] [--trace FILE.vcd] [--describe]
+// --describe prints "inputs <count> outputs <count> clocked <0|1>" and exits.
+
+// Clocks with nothing going in or out before a clocked design is taken to be stuck
+const long MAX_IDLE_CLOCKS = 10000000;
+
+struct Batch {
+    VerilatedContext* contextp;
+    Vnn* top;
+    VerilatedVcdC* tfp = nullptr;
+    FILE* in;
+    FILE* out;
+    size_t inputs;
+    size_t outputs;
+    std::vector<SData> words;
+    uint64_t time = 0;
+
+    bool read_vector() {
+        size_t got = fread(words.data(), sizeof(SData), inputs, in);
+        if (got == 0 && feof(in)) {
+            return false;
+        }
+        if (got != inputs) {
+            throw std::runtime_error(std::string("Input ended part way through a vector of ") + std::to_string(inputs) + std::string(" words"));
+        }
+        return true;
+    }
+
+    void set_inputs() {
+        for (size_t i=0; i<inputs; i++) {
+            top->input_array[i] = words[i];
+        }
+    }
+
+    void write_outputs() {
+        std::vector<SData> result(outputs);
+        for (size_t i=0; i<outputs; i++) {
+            result[i] = top->output_array[i];
+        }
+        fwrite(result.data(), sizeof(SData), outputs, out);
+    }
+
+    void eval() {
+        top->eval();
+        if (tfp) {
+            tfp->dump(time);
+        }
+        time++;
+    }
+};
+
+// Combinational designs: one eval per vector
+template <typename T>
+void run(Batch& batch, T* top, long) {
+    while (batch.read_vector()) {
+        batch.set_inputs();
+        batch.eval();
+        batch.write_outputs();
+    }
+}
+
+// Clocked designs, picked by overload resolution whenever the model has in_valid
+template <typename T>
+auto run(Batch& batch, T* top, int) -> decltype(top->in_valid, void()) {
+    top->clk = 0;
+    top->rst = 1;
+    top->in_valid = 0;
+    top->out_ready = 1;
+    for (int i=0; i<2; i++) {
+        top->clk = 0;
+        batch.eval();
+        top->clk = 1;
+        batch.eval();
+    }
+    top->rst = 0;
+
+    bool have_input = batch.read_vector();
+    long in_flight = 0;
+    long idle = 0;
+    while (have_input || in_flight > 0) {
+        top->in_valid = have_input;
+        if (have_input) {
+            batch.set_inputs();
+        }
+        top->clk = 0;
+        batch.eval();
+
+        // Both sides of the handshake are sampled before the rising edge
+        bool output = top->out_valid;
+        bool accepted = have_input && top->in_ready;
+        if (output) {
+            batch.write_outputs();
+            in_flight--;
+        }
+
+        top->clk = 1;
+        batch.eval();
+
+        if (accepted) {
+            in_flight++;
+            have_input = batch.read_vector();
+        }
+
+        idle = (output || accepted) ? 0 : idle + 1;
+        if (idle > MAX_IDLE_CLOCKS) {
+            throw std::runtime_error(std::string("No progress in ") + std::to_string(MAX_IDLE_CLOCKS) + std::string(" clocks, with ") + std::to_string(in_flight) + std::string(" vectors in flight"));
+        }
+    }
+}
+
+template <typename T>
+auto is_clocked(T* top, int) -> decltype(top->in_valid, true) { return true; }
+
+template <typename T>
+bool is_clocked(T* top, long) { return false; }
+
+int main(int argc, char** argv) {
+    const char* input_path = nullptr;
+    const char* output_path = nullptr;
+    const char* trace_path = nullptr;
+    bool describe = false;
+
+    for (int i=1; i<argc; i++) {
+        std::string arg = argv[i];
+        if (arg == "--describe") {
+            describe = true;
+        } else if ((arg == "--input" || arg == "--output" || arg == "--trace") && i + 1 < argc) {
+            const char* value = argv[++i];
+            if (arg == "--input") input_path = value;
+            else if (arg == "--output") output_path = value;
+            else trace_path = value;
+        } else {
+            fprintf(stderr, "Usage: %s [--input FILE] [--output FILE] [--trace FILE.vcd] [--describe]\n", argv[0]);
+            return 2;
+        }
+    }
+
+    VerilatedContext* contextp = new VerilatedContext;
+    // Tracing slows everything down, so is only switched on when asked for
+    contextp->traceEverOn(trace_path != nullptr);
+    Vnn* top = new Vnn{contextp};
+
+    Batch batch;
+    batch.contextp = contextp;
+    batch.top = top;
+    batch.inputs = sizeof(top->input_array)/sizeof(top->input_array[0]);
+    batch.outputs = sizeof(top->output_array)/sizeof(top->output_array[0]);
+    batch.words.resize(batch.inputs);
+
+    if (describe) {
+        printf("inputs %zu outputs %zu clocked %d\n", batch.inputs, batch.outputs, (int)is_clocked(top, 0));
+        delete top;
+        delete contextp;
+        return 0;
+    }
+
+    if (trace_path) {
+        batch.tfp = new VerilatedVcdC;
+        top->trace(batch.tfp, 100);
+        batch.tfp->open(trace_path);
+    }
+
+    batch.in = input_path && strcmp(input_path, "-") != 0 ? fopen(input_path, "rb") : stdin;
+    batch.out = output_path && strcmp(output_path, "-") != 0 ? fopen(output_path, "wb") : stdout;
+    if (!batch.in || !batch.out) {
+        fprintf(stderr, "Couldn't open %s\n", batch.in ? output_path : input_path);
+        return 1;
+    }
+
+    run(batch, top, 0);
+
+    fflush(batch.out);
+    if (batch.tfp) {
+        batch.tfp->close();
+        delete batch.tfp;
+    }
+    top->final();
+    delete top;
+    delete contextp;
+
+    return 0;
+}